@@ -9,26 +9,20 @@ according to your preference:
     or
   https://pypi.python.org/pypi/hidapi-cffi
 
+Without hardware the in-process emulator can be used instead by setting
+HID_BACKEND=emulator (see hidemu.py).
+
+Many commands can run in one process with --script, reading them from a
+file or the standard input and printing JSON results (see xtscript.py).
+
 """
 
 from __future__ import unicode_literals
 from __future__ import print_function
+import os
 import sys
-import struct
-_usingHid = False
-try:
-    import hid
-    _usingHid = True
-except (ImportError, OSError):
-    try:
-        import hidapi
-    except (ImportError, OSError):
-        print('Please ensure that you have hidapi or hidapi-cffi installed,')
-        print('any of them are supported.')
-        print('If you are confortable with Python, it should be as simple as:')
-        print('\tpip install --user hidapi')
-        raise
-
+from hidtransport import PacketEngine, TransportTimeout, DeviceRegistry, packet_struct, get_backend
+from hidmetrics import Metrics, write_prometheus
 __version__ = '0.0.1'
 
 # XMas_Tree device USB VID
@@ -43,6 +37,9 @@ XMas_Tree_USB_TIMEOUT = 1000  # timeout in ms
 XMas_Tree_USB_PACKET_SIZE = 64
 XMas_Tree_USB_PACKET_PAYLOAD_SIZE = 20
 
+# Optional file where the device registry persists the firmware versions
+XMas_Tree_CACHE_ENV = 'XMAS_TREE_CACHE'
+
 # XMas_Tree device protocol status declarations
 XMas_Tree_PROTO_OK_STATUS = 1
 
@@ -52,16 +49,70 @@ XMas_Tree_PORT_STATE_DOWN = 0
 XMas_Tree_PORT_STATE_ERROR = 255
 XMas_Tree_PORT_STATE_DICT = {0: 'DOWN', 1: 'UP', 255: 'ERROR'}
 
+# Precompiled single opcode command packet
+_OPCODE_PACKET = packet_struct('<B', XMas_Tree_USB_PACKET_SIZE)
 
-def hid_enumerate(vid=0, pid=0):
-    '''HID enumerate wrapper function'''
-    for info in hid.enumerate(vid, pid) if _usingHid else hidapi.enumerate(vid, pid):
-        if _usingHid:
-            ret = info
-        else:
-            # unfortunately there is no __dict__ attr in the cffi DeviceInfo object
-            ret = dict([(p, getattr(info, p)) for p in info.__slots__])
-        yield ret
+# Maximum number of commands in flight during a batch, kept well below the
+# input report queue of the HID drivers so that no reply gets dropped
+XMas_Tree_BATCH_WINDOW = 16
+
+
+def _decode_status(recvbytes):
+    return recvbytes[0] == XMas_Tree_PROTO_OK_STATUS
+
+
+def _decode_height(recvbytes):
+    return (recvbytes[1] << 8) + recvbytes[0]
+
+
+def _decode_version(recvbytes):
+    return (recvbytes[1], recvbytes[2]) if recvbytes[0] == XMas_Tree_PROTO_OK_STATUS else None
+
+
+# LED opcodes: (led index, state the command sets)
+_LED_OPCODES = {
+    0x40: (0, True),
+    0x41: (0, False),
+    0x50: (1, True),
+    0x51: (1, False),
+}
+
+# Reply decoder for every single opcode command
+_REPLY_DECODERS = {
+    0x40: _decode_status,
+    0x41: _decode_status,
+    0x50: _decode_status,
+    0x51: _decode_status,
+    0x60: _decode_height,
+    0xf0: _decode_version,
+}
+
+
+# opcodes answered with a status byte, the only part of a reply telling whose it may be
+_STATUS_OPCODES = frozenset((0x40, 0x41, 0x50, 0x51, 0xf0))
+_STATUS_BYTES = (0, XMas_Tree_PROTO_OK_STATUS)
+
+
+def decode_reply(opcode, recvbytes):
+    '''Decode the reply of a single opcode command the way send_many() reports it'''
+    return _REPLY_DECODERS[opcode](recvbytes)
+
+
+def hid_enumerate(vid=0, pid=0, backend=None):
+    '''HID enumerate wrapper function, backend is a name or instance as accepted by hidtransport.get_backend'''
+    return get_backend(backend).enumerate(vid, pid)
+
+
+_registries = {}
+
+
+def device_registry(backend=None):
+    '''Returns the shared registry of XMas_Tree devices (any mode) for a backend'''
+    backend = get_backend(backend)
+    if backend not in _registries:
+        _registries[backend] = DeviceRegistry(XMas_Tree_USB_VID, XMas_Tree_USB_PID_LIST + XMas_Tree_USB_PID_BL_LIST,
+                                              backend, os.environ.get(XMas_Tree_CACHE_ENV))
+    return _registries[backend]
 
 
 class XMas_TreeNotFound(Exception):
@@ -74,29 +125,85 @@ class XMas_TreeNotFound(Exception):
 class XMas_Tree(object):
     '''XMas_Tree hidapi based interface class'''
 
-    def __init__(self, serial=None, path=None):
-        '''Constructor, the algorithm will connect to the first XMas_Tree found if a path or serial number is not provided'''
+    def __init__(self, serial=None, path=None, backend=None, registry=None, shadow=False, policy=None, metrics=None,
+                 blocking=True):
+        '''Constructor, the algorithm will connect to the first XMas_Tree found if a path or serial number is not provided
+
+        Devices are looked up in the registry, the shared one of the backend unless given, so
+        opening several devices does not rescan the bus every time.  With shadow enabled the last
+        confirmed LED states are tracked and LED commands that would not change anything are skipped.
+        policy is the hidtransport.TransportPolicy of the device, it outlives reconnect() like
+        the optional hidmetrics.Metrics recording every command.  A non blocking device, when the
+        backend handles have a fileno(), can be driven by an xtmux.DeviceMux.
+        '''
+        self._policy = policy
+        self._metrics = metrics
+        self._blocking = blocking
         self._devhandle = None
+        self._engine = None
         self._firmware_major_version = None
         self._firmware_minor_version = None
         self._downstream_port_count = None
-        if path:
-            # open the provided path
-            if _usingHid:
-                # blocking by default
-                self._devhandle = hid.device()
-                self._devhandle.open_path(path)
-            else:
-                # also blocking by default but ensure it is
-                self._devhandle = hidapi.Device(path=path, blocking=True)
-        else:
+        self._shadow = [None, None] if shadow else None
+        self.shadow_hits = 0
+        self.shadow_misses = 0
+        # batches run again one command at a time after a lost or misplaced reply
+        self.resyncs = 0
+        self._registry = registry or device_registry(backend)
+        self._backend = self._registry.backend
+        if not path:
             # otherwise try to locate a device
-            for device in hid_enumerate(0, 0):
-                if device['vendor_id'] == XMas_Tree_USB_VID and device['product_id'] in XMas_Tree_USB_PID_LIST:
-                    if serial is None or serial == device['serial_number']:
-                        return self.__init__(path=device['path'])
-        if self._devhandle is None:
-            raise XMas_TreeNotFound()
+            self._device = self._registry.lookup(serial=serial, pids=XMas_Tree_USB_PID_LIST)
+            if self._device is None:
+                raise XMas_TreeNotFound()
+            path = self._device['path']
+        else:
+            # the path may not belong to an indexed device, caching is then skipped
+            self._device = self._registry.lookup(path=path)
+        self._path = path
+        self._open()
+
+    def _open(self):
+        if self._blocking:
+            self._devhandle = self._backend.open(self._path)
+        else:
+            self._devhandle = self._backend.open(self._path, blocking=False)
+        self._engine = PacketEngine(self._devhandle, self._backend.usinghid, XMas_Tree_USB_PACKET_SIZE,
+                                    XMas_Tree_USB_PACKET_PAYLOAD_SIZE, XMas_Tree_USB_TIMEOUT,
+                                    self._policy, self._metrics)
+        self._policy = self._engine.policy
+
+    def reconnect(self):
+        '''Close and reopen the device handle, the shadow state is dropped as the device may have been reset'''
+        if self._devhandle:
+            self._devhandle.close()
+            self._devhandle = None
+        self.resync()
+        self._open()
+
+    def resync(self):
+        '''Forget the shadow LED states, the next LED commands are sent unconditionally'''
+        if self._shadow is not None:
+            self._shadow[:] = [None, None]
+
+    @property
+    def shadow_state(self):
+        '''Last confirmed (LED1, LED2) states, None when unknown or shadowing is disabled'''
+        return tuple(self._shadow) if self._shadow is not None else None
+
+    @property
+    def engine(self):
+        '''The hidtransport.PacketEngine of the open handle'''
+        return self._engine
+
+    def fileno(self):
+        '''File descriptor of the device handle, None if the backend does not provide one'''
+        return self._engine.fileno()
+
+    @property
+    def metrics(self):
+        '''The hidmetrics.Metrics given to the constructor, or None'''
+        return self._metrics
 
     def __del__(self):
         '''Destructor, release the device'''
@@ -114,49 +221,230 @@ class XMas_Tree(object):
     def get_firmware_version(self):
         '''Returns a tuple with XMas_Tree firmware version in format (major, minor)'''
         if self._firmware_major_version is None:
-            status, major, minor = self._raw_sendreceive([0xf0])[:3]
+            cached = self._device and self._registry.cached(self._device, 'firmware')
+            if cached:
+                self._firmware_major_version, self._firmware_minor_version = cached
+                return self._firmware_major_version, self._firmware_minor_version
+            status, major, minor = self._command(0xf0)[:3]
             if status == XMas_Tree_PROTO_OK_STATUS:
                 self._firmware_major_version, self._firmware_minor_version = (major, minor)
             else:
                 # early devices will not recognize it, figure it out from serial
                 self._firmware_major_version = 1
                 self._firmware_minor_version = 2 if 'YK2' in self.get_serial_number_string() else 255 if 'YKD2' in self.get_serial_number_string() else 0
+            if self._device:
+                self._registry.store(self._device, 'firmware', [self._firmware_major_version, self._firmware_minor_version])
         return self._firmware_major_version, self._firmware_minor_version
 
     def _raw_sendreceive(self, packetarray):
         '''Internal method, submit a command and read the response from XMas_Tree'''
-        # build the packet according to the report packet size
-        # note: no buffer optimization was made for the sake of simplicity
-        if _usingHid:
-            packetarray = [0x00] + packetarray + [0x00] * (XMas_Tree_USB_PACKET_SIZE - len(packetarray))
-            self._devhandle.write(packetarray)
-            recvpacket = self._devhandle.read(max_length=XMas_Tree_USB_PACKET_SIZE + 1, timeout_ms=XMas_Tree_USB_TIMEOUT)
-        else:
-            packetarray = packetarray + [0x00] * (XMas_Tree_USB_PACKET_SIZE - len(packetarray))
-            packet = struct.pack('<%dB' % XMas_Tree_USB_PACKET_SIZE, *packetarray)
-            self._devhandle.write(packet)
-            recvpacket = self._devhandle.read(length=XMas_Tree_USB_PACKET_SIZE + 1, timeout_ms=XMas_Tree_USB_TIMEOUT)
-        # if not None return the bytes we actually need
-        if recvpacket is None or len(recvpacket) < XMas_Tree_USB_PACKET_PAYLOAD_SIZE:
-            return [0xff] * XMas_Tree_USB_PACKET_PAYLOAD_SIZE
-        return recvpacket[:XMas_Tree_USB_PACKET_PAYLOAD_SIZE] if _usingHid else struct.unpack('<%iB' % XMas_Tree_USB_PACKET_PAYLOAD_SIZE, recvpacket[:XMas_Tree_USB_PACKET_PAYLOAD_SIZE])
+        return self._engine.sendreceive(packetarray)
+
+    def _command(self, opcode):
+        '''Internal method, submit a single opcode command through the preallocated packet buffer'''
+        return self._engine.transact(_OPCODE_PACKET, opcode)
+
+    def _led(self, opcode):
+        '''Internal method, LED command going through the shadow state when enabled'''
+        shadow = self._shadow
+        if shadow is None:
+            return self._command(opcode)[0] == XMas_Tree_PROTO_OK_STATUS
+        led, state = _LED_OPCODES[opcode]
+        if shadow[led] == state:
+            self.shadow_hits += 1
+            return True
+        self.shadow_misses += 1
+        shadow[led] = None
+        if self._command(opcode)[0] == XMas_Tree_PROTO_OK_STATUS:
+            shadow[led] = state
+            return True
+        return False
 
     def led1_on(self):
-        return self._raw_sendreceive([0x40])[0] == XMas_Tree_PROTO_OK_STATUS
+        return self._led(0x40)
 
     def led1_off(self):
-        return self._raw_sendreceive([0x41])[0] == XMas_Tree_PROTO_OK_STATUS
+        return self._led(0x41)
 
     def led2_on(self):
-        return self._raw_sendreceive([0x50])[0] == XMas_Tree_PROTO_OK_STATUS
+        return self._led(0x50)
 
     def led2_off(self):
-        return self._raw_sendreceive([0x51])[0] == XMas_Tree_PROTO_OK_STATUS
+        return self._led(0x51)
+
+    def send_many(self, opcodes, window=XMas_Tree_BATCH_WINDOW):
+        '''Submit several commands back to back and collect the replies in order
+
+        Up to window commands are written before their replies are read, so a
+        batch costs about one round trip instead of one per command.  Returns
+        a list with the decoded reply of every command: the status as a bool
+        for the LED commands, the height for 0x60 and (major, minor) or None
+        for 0xf0.  LED commands elided by the shadow state report True.  A
+        command the device did not answer reports None, the others are still
+        returned.
+        '''
+        shadow = self._shadow
+        if shadow is None:
+            return self._pipeline(opcodes, window)
+        results = [True] * len(opcodes)
+        planned = list(shadow)
+        positions = []
+        for position, opcode in enumerate(opcodes):
+            if opcode in _LED_OPCODES:
+                led, state = _LED_OPCODES[opcode]
+                if planned[led] == state:
+                    self.shadow_hits += 1
+                    continue
+                self.shadow_misses += 1
+                planned[led] = state
+            positions.append(position)
+        sent = [opcodes[position] for position in positions]
+        for opcode in sent:
+            if opcode in _LED_OPCODES:
+                shadow[_LED_OPCODES[opcode][0]] = None
+        for position, opcode, result in zip(positions, sent, self._pipeline(sent, window)):
+            results[position] = result
+            if opcode in _LED_OPCODES:
+                # a failed command leaves the state unknown, forcing a resend next time
+                shadow[_LED_OPCODES[opcode][0]] = _LED_OPCODES[opcode][1] if result else None
+        return results
+
+    def _pipeline(self, opcodes, window):
+        '''Internal method, write up to window commands ahead of their replies
+
+        The replies do not carry the opcode, only the status byte of the LED and
+        version replies can be checked.  When a reply is missing or implausible,
+        the late replies are drained and the batch is run again one command at a
+        time: a lost reply shifts every later one, and all the opcodes are idempotent.
+        '''
+        engine = self._engine
+        results = []
+        inflight = 0
+        try:
+            for opcode in opcodes:
+                if inflight == window:
+                    expected = opcodes[len(results)]
+                    recvbytes = engine.read()
+                    if expected in _STATUS_OPCODES and recvbytes[0] not in _STATUS_BYTES:
+                        break
+                    results.append(_REPLY_DECODERS[expected](recvbytes))
+                    inflight -= 1
+                engine.load(_OPCODE_PACKET, opcode)
+                engine.write()
+                inflight += 1
+            else:
+                while inflight:
+                    expected = opcodes[len(results)]
+                    recvbytes = engine.read()
+                    if expected in _STATUS_OPCODES and recvbytes[0] not in _STATUS_BYTES:
+                        break
+                    results.append(_REPLY_DECODERS[expected](recvbytes))
+                    inflight -= 1
+                else:
+                    return results
+        except TransportTimeout:
+            pass
+        except Exception:
+            engine.flush()
+            raise
+        # a reply is missing or belongs to another command, the late ones are awaited and dropped
+        self.resyncs += 1
+        while engine.inflight and engine.poll(engine.timeout, learn=False) is not None:
+            pass
+        engine.flush()
+        return self._sequential(opcodes)
+
+    def _sequential(self, opcodes):
+        '''Internal method, run the commands one at a time, None for the unanswered ones'''
+        results = []
+        for opcode in opcodes:
+            try:
+                results.append(_REPLY_DECODERS[opcode](self._command(opcode)))
+            except TransportTimeout:
+                # not answered despite the resends, the device is not tried with the others
+                results.extend([None] * (len(opcodes) - len(results)))
+                break
+        return results
+
+    def batch(self):
+        '''Returns a context manager queuing commands until the with block exits, e.g.:
+            with XT.batch() as b:
+                b.led1_on()
+                b.led2_off()
+            print(b.results)
+        '''
+        return XMas_TreeBatch(self)
 
     def get_height(self):
-        recvbytes = self._raw_sendreceive([0x60])
-        print ((recvbytes[1] << 8) + recvbytes[0])
-        return
+        '''Returns the height sensor reading, raises TransportTimeout if the device did not answer'''
+        return _decode_height(self._command(0x60))
+
+
+class XMas_TreeBatch(object):
+    '''Commands queued on a XMas_Tree and submitted together with send_many'''
+
+    def __init__(self, xmastree):
+        self._xmastree = xmastree
+        self._opcodes = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.submit()
+
+    def _queue(self, opcode):
+        self._opcodes.append(opcode)
+        return len(self._opcodes) - 1
+
+    def submit(self):
+        '''Send the queued commands, the results list is indexed by the value each queueing method returned'''
+        opcodes, self._opcodes = self._opcodes, []
+        self.results = self._xmastree.send_many(opcodes)
+        return self.results
+
+    def led1_on(self):
+        return self._queue(0x40)
+
+    def led1_off(self):
+        return self._queue(0x41)
+
+    def led2_on(self):
+        return self._queue(0x50)
+
+    def led2_off(self):
+        return self._queue(0x51)
+
+    def get_height(self):
+        return self._queue(0x60)
+
+
+def _daemon_main(client, args):
+    '''Thin client side of main(), the LED commands go through the daemon'''
+    import xtdaemon
+    command = 'led1_on' if args.on is not None else 'led1_off'
+    try:
+        serials = [args.serial] if args.serial else client.call('-', 'list')
+        found = False
+        for serial in serials:
+            try:
+                status = client.call(serial, command)[0]
+            except xtdaemon.DeviceNotFound:
+                # unplugged since listed, or a serial not on the bus, as the direct path reports it
+                continue
+            found = True
+            print('  Serial number: %s  %s %s' % (serial, command, 'done' if status == '1' else 'failed'))
+        if not found:
+            print('no XMas_Tree devices found')
+    except (xtdaemon.DaemonError, IOError, OSError) as e:
+        print('communication error, exception details:')
+        print('  error "%s"' % e)
+        return 1
+    finally:
+        client.close()
+    return 0
 
 
 def main():
@@ -170,62 +458,87 @@ def main():
     group.add_argument('-l', '--list', help='list XMas_Tree devices', action='store_true')
     group.add_argument('-n', '--on', type=int, nargs='*', help='turn the cam on')
     group.add_argument('-f', '--off', type=int, nargs='*', help='turn the cam off')
+    group.add_argument('-d', '--daemon', help='keep the devices open and serve commands on a Unix socket', action='store_true')
+    group.add_argument('-x', '--script', metavar='FILE',
+                       help='run the commands of FILE (- for the standard input), printing one JSON result per line')
+    parser.add_argument('-m', '--metrics', default=None, help='write the transport metrics to this Prometheus text file')
+    parser.add_argument('--direct', help='open the devices even if a daemon is running', action='store_true')
+    parser.add_argument('--socket', default=None, help='daemon socket path')
 
     args = parser.parse_args()
 
+    if args.daemon:
+        import xtdaemon
+        print('serving XMas_Tree commands on %s' % (args.socket or xtdaemon.default_socket_path()))
+        try:
+            xtdaemon.serve(args.socket)
+        except (IOError, OSError) as e:
+            print('could not start the daemon: %s' % e)
+            sys.exit(1)
+        return
+    if args.script:
+        import xtscript
+        try:
+            sys.exit(xtscript.run_script(args.script, args.serial, args.socket, args.direct))
+        except (IOError, OSError) as e:
+            print('could not run the script: %s' % e, file=sys.stderr)
+            sys.exit(1)
+    if (args.on is not None or args.off is not None) and not args.direct and not args.metrics:
+        import xtdaemon
+        client = xtdaemon.connect(args.socket)
+        if client is not None:
+            sys.exit(_daemon_main(client, args))
+
     # say hello
     print('%s XMas_Tree family devices \n-------------------------------\n%s' %
           (args.list and 'listing' or 'managing',
            args.serial is None and ' ' or ' with serial number %s' % (args.serial)))
     try:
         XMas_Tree_found = False
-        for device in hid_enumerate(0, 0):
-            if device['vendor_id'] == XMas_Tree_USB_VID and device['product_id'] in XMas_Tree_USB_PID_LIST + XMas_Tree_USB_PID_BL_LIST:
-                if args.serial is None or args.serial == device['serial_number']:
-                    XMas_Tree_found = True
-                    print('  %s REV: %s  Serial number: %s' %
-                          (device['product_string'], device['release_number'], device['serial_number']))
-                    print('    system device path %s, VID 0x%.4x, PID 0x%.4x' % (device['path'].decode(), device['vendor_id'], device['product_id']))
-                    if device['product_id'] in XMas_Tree_USB_PID_BL_LIST:
-                        print('    control functions are not available, the device is working in bootloader mode')
+        collected = []
+        registry = device_registry()
+        if args.serial is None:
+            devices = registry.devices()
+        else:
+            devices = [device for device in (registry.lookup(serial=args.serial),) if device]
+        for device in devices:
+            XMas_Tree_found = True
+            print('  %s REV: %s  Serial number: %s' %
+                  (device['product_string'], device['release_number'], device['serial_number']))
+            print('    system device path %s, VID 0x%.4x, PID 0x%.4x' % (device['path'].decode(), device['vendor_id'], device['product_id']))
+            if device['product_id'] in XMas_Tree_USB_PID_BL_LIST:
+                print('    control functions are not available, the device is working in bootloader mode')
+            else:
+                XT = None
+                try:
+                    XT = XMas_Tree(path=device['path'], registry=registry,
+                                   metrics=Metrics({'serial': device['serial_number']}) if args.metrics else None)
+                    if XT.metrics:
+                        collected.append(XT.metrics)
+                    print('    Firmware v%i.%i' % (XT.get_firmware_version()))
+                except IOError:
+                    if args.list:
+                        print('    warning: could not communicate, the device may be in use or')
+                        print('    your user do not have access rights to do so, in the latter')
+                        print('    case you may work around the by using sudo, for example:')
+                        print('      sudo python pXMas_Tree.py -l')
+                        print('    if you are using the binary version:')
+                        print('      sudo pXMas_Tree -l')
                     else:
-                        XT = None
-                        try:
-                            XT = XMas_Tree()  # path=device['path'])
-                            print('    Firmware v%i.%i' % (XT.get_firmware_version()))
-                        except IOError:
-                            if args.list:
-                                print('    warning: could not communicate, the device may be in use or')
-                                print('    your user do not have access rights to do so, in the latter')
-                                print('    case you may work around the by using sudo, for example:')
-                                print('      sudo python pXMas_Tree.py -l')
-                                print('    if you are using the binary version:')
-                                print('      sudo pXMas_Tree -l')
-                            else:
-                                raise
-                        if XT:
-                            cmds = []
-                            if args.list:
-                                # list requested, attempting to get all port states
-                                t = XT.get_allports_state()
-                                # print('    downstream running power states, port 1 to %i: %s' %
-                                #      (XMas_Tree.get_downstream_port_count(), ', '.join([XMas_Tree_PORT_STATE_DICT[s] for s in t])))
-                                # XMas_Tree firmware below v2 does not support persistence functions
-                                if XT.get_firmware_version()[0] > 1:
-                                    t = XT.get_allports_persistent_state()
-                                    # if t[0] != XMas_Tree_PORT_STATE_ERROR:
-                                    # print('    downstream startup/persistent power states, port 1 to %i: %s' %
-                                    #      (XMas_Tree.get_downstream_port_count(), ', '.join([XMas_Tree_PORT_STATE_DICT[s] for s in t])))
-                            if args.on is not None:
-                                XT.led1_on()
-                            if args.off is not None:
-                                XT.led1_off()
+                        raise
+                if XT:
+                    if args.on is not None:
+                        XT.led1_on()
+                    if args.off is not None:
+                        XT.led1_off()
 
         if not XMas_Tree_found:
             print('no XMas_Tree devices found')
+        if args.metrics:
+            write_prometheus(args.metrics, collected)
     except (ValueError, IOError, OSError) as e:
         print('communication error, exception details:')
-        print('  error "%s"' % e.message)
+        print('  error "%s"' % e)
         sys.exit(1)
 
 
@@ -0,0 +1,95 @@
+# coding: utf-8
+"""
+asyncio interface for the NavVis XMas_Tree (Python 3 only)
+
+The blocking XMas_Tree calls run on a bounded thread pool shared by every
+device, while a per-device asyncio.Lock keeps the commands of one tree in
+the order they were awaited.  A single event loop can therefore drive
+many trees concurrently:
+
+    trees = await aioxmastree.open_all()
+    await asyncio.gather(*(tree.led1_on() for tree in trees))
+
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import XMas_Tree
+
+# Upper bound of blocking USB transfers running at the same time
+AIO_MAX_WORKERS = 32
+
+_defaultExecutor = None
+
+
+def default_executor():
+    '''Returns the shared bounded executor, created on first use'''
+    global _defaultExecutor
+    if _defaultExecutor is None:
+        _defaultExecutor = ThreadPoolExecutor(max_workers=AIO_MAX_WORKERS)
+    return _defaultExecutor
+
+
+class AsyncXMas_Tree(object):
+    '''Awaitable XMas_Tree interface, wraps an open XMas_Tree instance'''
+
+    def __init__(self, xmastree, executor=None):
+        self._xmastree = xmastree
+        self._executor = executor or default_executor()
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, serial=None, path=None, backend=None, registry=None, shadow=False, executor=None,
+                   policy=None, metrics=None):
+        '''Open a device without blocking the loop, same arguments as XMas_Tree'''
+        executor = executor or default_executor()
+        xmastree = await asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(XMas_Tree.XMas_Tree, serial=serial, path=path, backend=backend,
+                                        registry=registry, shadow=shadow, policy=policy, metrics=metrics))
+        return cls(xmastree, executor)
+
+    @property
+    def xmastree(self):
+        '''The wrapped blocking XMas_Tree instance'''
+        return self._xmastree
+
+    async def _call(self, func, *args):
+        # asyncio.Lock wakes its waiters in FIFO order, which keeps the per device command order
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get_product_string(self):
+        return await self._call(self._xmastree.get_product_string)
+
+    async def get_serial_number_string(self):
+        return await self._call(self._xmastree.get_serial_number_string)
+
+    async def get_firmware_version(self):
+        return await self._call(self._xmastree.get_firmware_version)
+
+    async def led1_on(self):
+        return await self._call(self._xmastree.led1_on)
+
+    async def led1_off(self):
+        return await self._call(self._xmastree.led1_off)
+
+    async def led2_on(self):
+        return await self._call(self._xmastree.led2_on)
+
+    async def led2_off(self):
+        return await self._call(self._xmastree.led2_off)
+
+    async def get_height(self):
+        return await self._call(self._xmastree.get_height)
+
+    async def send_many(self, opcodes):
+        return await self._call(self._xmastree.send_many, opcodes)
+
+
+async def open_all(backend=None, shadow=False, executor=None):
+    '''Open every XMas_Tree in application mode found on the bus'''
+    registry = XMas_Tree.device_registry(backend)
+    devices = [device for device in registry.devices() if device['product_id'] in XMas_Tree.XMas_Tree_USB_PID_LIST]
+    return list(await asyncio.gather(*(AsyncXMas_Tree.open(path=device['path'], registry=registry, shadow=shadow, executor=executor)
+                                       for device in devices)))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+AsyncXMas_Tree scaling benchmark against the emulated backend
+
+Every emulated tree answers after a fixed latency, the benchmark reports the
+aggregate commands per second one event loop reaches as the device count
+grows.
+
+Usage:
+    python benchmarks/bench_async.py [-n COMMANDS] [-l LATENCY] [-d 1,2,4,...]
+
+"""
+
+import os
+import sys
+import time
+import asyncio
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import hidemu  # noqa: E402
+import aioxmastree  # noqa: E402
+
+
+async def _drive(backend, commands):
+    trees = await aioxmastree.open_all(backend=backend)
+
+    async def toggle(tree):
+        for i in range(commands):
+            await (tree.led1_on() if i & 1 else tree.led1_off())
+
+    start = time.perf_counter()
+    await asyncio.gather(*(toggle(tree) for tree in trees))
+    return len(trees) * commands / (time.perf_counter() - start)
+
+
+def run(commands=200, latency=0.001, counts=(1, 2, 4, 8, 16, 32)):
+    '''Returns the aggregate commands per second for every device count'''
+    results = {}
+    for count in counts:
+        bus = hidemu.EmulatedBus()
+        for n in range(count):
+            bus.add('xmastree', 'XT%06i' % n, latency=latency)
+        results['devices.%i' % count] = asyncio.run(_drive(hidemu.EmulatorBackend(bus), commands))
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='AsyncXMas_Tree scaling benchmark.')
+    parser.add_argument('-n', '--commands', type=int, default=200, help='commands per device')
+    parser.add_argument('-l', '--latency', type=float, default=0.001, help='emulated round trip in seconds')
+    parser.add_argument('-d', '--devices', default='1,2,4,8,16,32', help='comma separated device counts')
+    args = parser.parse_args()
+    counts = [int(c) for c in args.devices.split(',')]
+    results = run(args.commands, args.latency, counts)
+    for count in counts:
+        print('%3i devices  %10.0f cmd/s' % (count, results['devices.%i' % count]))
+
+
+if __name__ == '__main__':
+    main()
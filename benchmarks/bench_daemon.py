@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Per command latency of the XMas_Tree daemon against direct device access
+
+The direct case does what one XMas_Tree.py run does (device lookup, open,
+firmware version query, LED command, close), the daemon cases send the
+LED command through xtdaemon with a new connection per command, like the
+thin client, or over one kept connection.  With --cli whole XMas_Tree.py
+processes are also timed both ways.  Everything runs against the emulator,
+which enumerates and opens devices for free: on real hardware the direct
+case also pays the bus enumeration and the hidraw open.
+
+Usage:
+    python benchmarks/bench_daemon.py [-n COMMANDS] [-l LATENCY] [--cli]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import time
+import tempfile
+import threading
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import hidemu  # noqa: E402
+import xtdaemon  # noqa: E402
+import XMas_Tree  # noqa: E402
+from hidtransport import DeviceRegistry  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+def _direct(backend, command):
+    registry = DeviceRegistry(XMas_Tree.XMas_Tree_USB_VID, XMas_Tree.XMas_Tree_USB_PID_LIST, backend)
+    tree = XMas_Tree.XMas_Tree(registry=registry)
+    tree.get_firmware_version()
+    getattr(tree, command)()
+    tree._devhandle.close()
+    tree._devhandle = None
+
+
+def _per_command(func, commands):
+    '''Time func(command), alternating the LED states so the daemon shadow state never elides a command'''
+    start = time.perf_counter()
+    for i in range(commands):
+        func('led1_off' if i & 1 else 'led1_on')
+    return (time.perf_counter() - start) * 1e6 / commands
+
+
+def _cli(args, env, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, 'XMas_Tree.py'] + args, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[runs // 2] * 1e6
+
+
+def run(commands=500, latency=0.0005, cli=False):
+    '''Returns the microseconds per command of every case'''
+    bus = hidemu.EmulatedBus()
+    bus.add('xmastree', 'XT000001', latency=latency)
+    backend = hidemu.EmulatorBackend(bus)
+    path = os.path.join(tempfile.mkdtemp(), 'xmastree.sock')
+    server = xtdaemon.XMas_TreeServer(path, backend)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    results = {'direct': _per_command(lambda command: _direct(backend, command), commands)}
+
+    def reconnect(command):
+        client = xtdaemon.connect(path)
+        client.call('-', command)
+        client.close()
+    results['daemon.connect'] = _per_command(reconnect, commands)
+    client = xtdaemon.connect(path)
+    results['daemon.kept'] = _per_command(lambda command: client.call('-', command), commands)
+    client.close()
+    server.shutdown()
+    server.server_close()
+    if cli:
+        env = dict(os.environ, HID_BACKEND='emulator', HIDEMU_LATENCY=str(latency))
+        runs = max(5, commands // 50)
+        results['cli.direct'] = _cli(['-n'], env, runs)
+        daemon = subprocess.Popen([sys.executable, 'XMas_Tree.py', '--daemon', '--socket', path], cwd=ROOT, env=env,
+                                  stdout=subprocess.DEVNULL)
+        try:
+            while xtdaemon.connect(path) is None:
+                time.sleep(0.01)
+            results['cli.daemon'] = _cli(['-n', '--socket', path], env, runs)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='XMas_Tree daemon latency benchmark.')
+    parser.add_argument('-n', '--commands', type=int, default=500, help='commands per case')
+    parser.add_argument('-l', '--latency', type=float, default=0.0005, help='emulated round trip in seconds')
+    parser.add_argument('--cli', action='store_true', help='also time whole XMas_Tree.py runs')
+    args = parser.parse_args()
+    results = run(args.commands, args.latency, args.cli)
+    for name in ('direct', 'daemon.connect', 'daemon.kept', 'cli.direct', 'cli.daemon'):
+        if name in results:
+            print('%-16s %10.1f us/command' % (name, results[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Device lookup benchmark over large synthetic enumeration lists
+
+A synthetic backend enumerates N HID devices of which a few are
+XMas_Trees.  The benchmark compares the original lookup (enumerate the
+whole bus and filter every device in Python, on every call) with the
+DeviceRegistry rescanning the bus (forced refresh) and with the registry
+answering from its index while the hotplug token is unchanged.
+
+Usage:
+    python benchmarks/bench_enumerate.py [-d 100,1000,10000] [-n LOOKUPS]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import XMas_Tree  # noqa: E402
+from hidtransport import DeviceRegistry  # noqa: E402
+
+# matching devices among the synthetic ones
+TREES = 8
+
+
+class SyntheticBackend(object):
+    '''Enumerates a fixed device list, filtering on vid/pid like hidapi does'''
+    name = 'synthetic'
+    usinghid = True
+
+    def __init__(self, count):
+        self.devices = []
+        for n in range(count):
+            tree = n % (count // TREES or 1) == 0
+            self.devices.append({
+                'path': ('/dev/hidraw%i' % n).encode(),
+                'vendor_id': XMas_Tree.XMas_Tree_USB_VID if tree else 0x1000 + n % 64,
+                'product_id': XMas_Tree.XMas_Tree_USB_PID_LIST[0] if tree else n & 0xffff,
+                'serial_number': 'XT%06i' % n if tree else 'SN%06i' % n,
+                'release_number': 0x100,
+                'manufacturer_string': 'Synthetic',
+                'product_string': 'XMas_Tree' if tree else 'Device %i' % n,
+                'usage_page': 0,
+                'usage': 0,
+                'interface_number': 0,
+            })
+        self.serials = [device['serial_number'] for device in self.devices
+                        if device['vendor_id'] == XMas_Tree.XMas_Tree_USB_VID]
+
+    def enumerate(self, vid=0, pid=0):
+        for device in self.devices:
+            if (not vid or device['vendor_id'] == vid) and (not pid or device['product_id'] == pid):
+                yield dict(device)
+
+    def hotplug_token(self):
+        return len(self.devices)
+
+
+def legacy_lookup(backend, serial):
+    '''The original XMas_Tree constructor lookup'''
+    for device in backend.enumerate(0, 0):
+        if device['vendor_id'] == XMas_Tree.XMas_Tree_USB_VID and device['product_id'] in XMas_Tree.XMas_Tree_USB_PID_LIST:
+            if serial is None or serial == device['serial_number']:
+                return device
+    return None
+
+
+def _rate(func, serials, lookups):
+    start = time.perf_counter()
+    for n in range(lookups):
+        assert func(serials[n % len(serials)]) is not None
+    return lookups / (time.perf_counter() - start)
+
+
+def run(counts=(100, 1000, 10000), lookups=200):
+    '''Returns the lookups per second of every strategy for every device count'''
+    results = {}
+    for count in counts:
+        backend = SyntheticBackend(count)
+        registry = DeviceRegistry(XMas_Tree.XMas_Tree_USB_VID, XMas_Tree.XMas_Tree_USB_PID_LIST, backend)
+
+        def rescan(serial):
+            registry.refresh(force=True)
+            return registry.lookup(serial=serial)
+        results['legacy.%i' % count] = _rate(lambda serial: legacy_lookup(backend, serial), backend.serials, lookups)
+        results['rescan.%i' % count] = _rate(rescan, backend.serials, lookups)
+        results['indexed.%i' % count] = _rate(lambda serial: registry.lookup(serial=serial), backend.serials,
+                                              lookups * 100)
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Device lookup benchmark.')
+    parser.add_argument('-d', '--devices', default='100,1000,10000', help='comma separated device counts')
+    parser.add_argument('-n', '--lookups', type=int, default=200, help='lookups per strategy')
+    args = parser.parse_args()
+    counts = [int(n) for n in args.devices.split(',')]
+    results = run(counts, args.lookups)
+    for count in counts:
+        print('%6i devices  legacy %10.0f/s   rescan %10.0f/s   indexed %10.0f/s' %
+              (count, results['legacy.%i' % count], results['rescan.%i' % count], results['indexed.%i' % count]))
+
+
+if __name__ == '__main__':
+    main()
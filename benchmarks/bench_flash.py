@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Program and verify loop benchmark against an emulated YKUSH bootloader
+
+Runs the complete pykfirmware update flow on an emulated board for
+several image sizes and reports the program and verify phase throughput
+of the sequential flow, and the duration of the whole update both with
+the sequential phases and with the overlapped parse, erase, program and
+verify pipeline, then the rate of a whole flash readback (--dump).  With
+the default zero latency the numbers measure the host side cost of the
+loops; the latency, service time, erase time and drop rate options
+emulate a real link, where the pipeline pays off.
+
+Usage:
+    python benchmarks/bench_flash.py [-s 0x800,0x2000,0x7000] [-l LATENCY] [-t SERVICE] [-e ERASE] [-d DROP]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import io
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import hidemu  # noqa: E402
+import pykfirmware  # noqa: E402
+from bench_hex import synthetic_hex  # noqa: E402
+
+
+def _update(image, pipeline, **kwargs):
+    bus = hidemu.EmulatedBus()
+    bus.add('ykush', 'YK000001', seed=1, **kwargs)
+    updater = pykfirmware.FirmwareUpdater(io.BytesIO(image), backend=hidemu.EmulatorBackend(bus), pipeline=pipeline)
+    # the verify stage raises if the flash content does not match the image
+    updater.run()
+    return updater
+
+
+def run(sizes=(0x800, 0x2000, 0x7000), latency=0.0, service_time=0.0, erase_time=0.0, drop_rate=0.0):
+    '''Returns the sequential program and verify B/s, and the sequential and pipelined update
+    seconds for every image size in bytes, with the readback B/s of the whole flash'''
+    results = {}
+    link = {'latency': latency, 'service_time': service_time, 'erase_time': erase_time, 'drop_rate': drop_rate}
+    for size in sizes:
+        image = ''.join(synthetic_hex(size, address=0x1000)).encode()
+        updater = _update(image, False, **link)
+        phases = dict((phase.name, phase) for phase in updater.report)
+        results['program.%i' % size] = phases['program'].rate
+        results['verify.%i' % size] = phases['verify'].rate
+        results['update.%i' % size] = updater.report_dict()['duration']
+        results['pipelined.%i' % size] = _update(image, True, **link).report_dict()['duration']
+    bus = hidemu.EmulatedBus()
+    bus.add('ykush', 'YK000001', seed=1, **link)
+    updater = pykfirmware.FirmwareUpdater(None, backend=hidemu.EmulatorBackend(bus))
+    updater.run(updater.DUMP_PHASES)
+    results['dump'] = dict((phase.name, phase) for phase in updater.report)['dump'].rate
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Program and verify loop benchmark.')
+    parser.add_argument('-s', '--sizes', default='0x800,0x2000,0x7000', help='comma separated image sizes in bytes')
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help='emulated round trip in seconds')
+    parser.add_argument('-t', '--service-time', type=float, default=0.0, help='emulated seconds spent per packet')
+    parser.add_argument('-e', '--erase-time', type=float, default=0.0, help='emulated erase duration in seconds')
+    parser.add_argument('-d', '--drop-rate', type=float, default=0.0, help='fraction of replies lost')
+    args = parser.parse_args()
+    sizes = [int(s, 0) for s in args.sizes.split(',')]
+    results = run(sizes, args.latency, args.service_time, args.erase_time, args.drop_rate)
+    for size in sizes:
+        print('%6i bytes  program %10.0f B/s   verify %10.0f B/s   update %7.3f s   pipelined %7.3f s' %
+              (size, results['program.%i' % size], results['verify.%i' % size], results['update.%i' % size],
+               results['pipelined.%i' % size]))
+    print('whole flash readback %10.0f B/s' % results['dump'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Fleet rollout throughput benchmark against the emulated backend
+
+Flashes a synthetic image on N emulated YKUSH boards and reports the
+devices per minute reached with one job (the sequential baseline) and
+with concurrent jobs.
+
+Usage:
+    python benchmarks/bench_fleet.py [-n DEVICES] [-s SIZE] [-l LATENCY] [-j 1,4,8]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import hidemu  # noqa: E402
+import pykfirmware  # noqa: E402
+from bench_hex import synthetic_hex  # noqa: E402
+
+
+def run(devices=8, size=0x800, latency=0.001, jobs=(1, 4, 8)):
+    '''Returns the devices per minute of a rollout for every job count'''
+    image = ''.join(synthetic_hex(size, address=0x1000)).encode()
+    results = {}
+    for count in jobs:
+        bus = hidemu.EmulatedBus()
+        for n in range(devices):
+            bus.add('ykush', 'YK%06i' % n, latency=latency)
+        rollout = pykfirmware.FleetRollout(io.BytesIO(image), jobs=count, backend=hidemu.EmulatorBackend(bus))
+        start = time.perf_counter()
+        summary = rollout.run()
+        elapsed = time.perf_counter() - start
+        assert len(summary) == devices and all(result['success'] for result in summary)
+        results['jobs.%i' % count] = devices * 60 / elapsed
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Fleet rollout throughput benchmark.')
+    parser.add_argument('-n', '--devices', type=int, default=8, help='emulated YKUSH boards')
+    parser.add_argument('-s', '--size', type=lambda s: int(s, 0), default=0x800, help='image size in bytes')
+    parser.add_argument('-l', '--latency', type=float, default=0.001, help='emulated round trip in seconds')
+    parser.add_argument('-j', '--jobs', default='1,4,8', help='comma separated job counts')
+    args = parser.parse_args()
+    jobs = [int(j) for j in args.jobs.split(',')]
+    results = run(args.devices, args.size, args.latency, jobs)
+    for count in jobs:
+        print('%3i jobs  %8.1f devices/minute' % (count, results['jobs.%i' % count]))
+
+
+if __name__ == '__main__':
+    main()
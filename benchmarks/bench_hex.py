@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Intel HEX parsing benchmark on synthetic multi megabyte images
+
+Compares the original per byte int() checksum parser of pykfirmware.main
+with ykhex.IntelHexImage, and with a hit in the ykcache parsed image cache
+(hashing the file and mapping the cached image).
+
+Usage:
+    python benchmarks/bench_hex.py [-s 1,4,8] (image sizes in MiB)
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import time
+import array
+import random
+import struct
+import shutil
+import binascii
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from ykhex import IntelHexImage  # noqa: E402
+from ykcache import ImageCache  # noqa: E402
+
+
+def _record(address, rtype, data):
+    raw = bytearray([len(data), (address >> 8) & 0xff, address & 0xff, rtype]) + data
+    raw.append(-sum(raw) & 0xff)
+    return ':' + binascii.hexlify(bytes(raw)).decode().upper() + '\n'
+
+
+def synthetic_hex(size, address=0, recordsize=16, seed=0):
+    '''Returns the lines of a HEX file with size random data bytes starting at address'''
+    rnd = random.Random(seed)
+    payload = bytearray(rnd.getrandbits(8) for _ in range(min(size, 65536)))
+    lines = []
+    segment = None
+    for offset in range(0, size, recordsize):
+        current = address + offset
+        if current >> 16 != segment:
+            segment = current >> 16
+            lines.append(_record(0, 0x04, bytearray(struct.pack('>H', segment))))
+        start = offset % len(payload)
+        lines.append(_record(current & 0xffff, 0x00, payload[start:start + recordsize]))
+    lines.append(_record(0, 0x01, bytearray()))
+    return lines
+
+
+def legacy_parse(lines, devmemaddress, devmemlength, devbytesperaddress=1):
+    '''The original parsing loop of pykfirmware.main'''
+    hexrecinfo = struct.Struct('>BHB')
+    hexrecsegm = struct.Struct('>H')
+    flashbuffer = [x for x in [0x3f, 0xff] * (devmemlength // 2)]
+    segmaddr = 0
+    for rec in lines:
+        (rsize, raddr, rtype) = hexrecinfo.unpack(binascii.unhexlify(rec[1:9]))
+        raddr += segmaddr
+        rsum = 0
+        for i in range(1, 9 + rsize * 2, 2):
+            rsum += int(rec[i:(i + 2)], 16)
+        csum = (~rsum + 1) & 0xff
+        if int(rec[(9 + rsize * 2):(11 + rsize * 2)], 16) != csum:
+            raise ValueError('checksum')
+        if rtype in (0x02, 0x04):
+            segmaddr = hexrecsegm.unpack(binascii.unhexlify(rec[9:13]))[0]
+            segmaddr <<= 4 if rtype == 0x02 else 16
+        elif rtype == 0:
+            rpayload = array.array(str('B'), binascii.unhexlify(rec[9:(9 + rsize * 2)]))
+            mstart, mend = int(raddr - devmemaddress), int(raddr + len(rpayload) - devmemaddress)
+            if 0 <= mstart < devmemaddress + devmemlength:
+                if mend > devmemaddress + devmemlength:
+                    mend = devmemaddress + devmemlength
+                flashbuffer[mstart:mend] = rpayload[:mend - mstart]
+    return flashbuffer
+
+
+def run(sizes=(1, 4, 8)):
+    '''Returns the MiB/s parse rate of both parsers and of a cache hit for every image size in MiB'''
+    results = {}
+    cache = ImageCache(tempfile.mkdtemp(), max_bytes=sum(sizes) << 21)
+    for size in sizes:
+        length = size << 20
+        lines = synthetic_hex(length)
+        start = time.perf_counter()
+        legacy = legacy_parse(lines, 0, length)
+        results['legacy.%iMiB' % size] = size / (time.perf_counter() - start)
+        start = time.perf_counter()
+        image = IntelHexImage(0, length).load(lines)
+        results['ykhex.%iMiB' % size] = size / (time.perf_counter() - start)
+        assert bytes(bytearray(legacy)) == bytes(image.buffer)
+        cache.load(lines, 0, length, 1, image.chunksize)
+        start = time.perf_counter()
+        cached = cache.load(lines, 0, length, 1, image.chunksize)
+        results['cached.%iMiB' % size] = size / (time.perf_counter() - start)
+        assert cached.buffer == image.buffer
+    shutil.rmtree(cache.path)
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Intel HEX parsing benchmark.')
+    parser.add_argument('-s', '--sizes', default='1,4,8', help='comma separated image sizes in MiB')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    results = run(sizes)
+    for size in sizes:
+        before, after = results['legacy.%iMiB' % size], results['ykhex.%iMiB' % size]
+        print('%3i MiB  before %7.2f MiB/s   after %7.2f MiB/s   x%.1f   cached %8.2f MiB/s' %
+              (size, before, after, after / before, results['cached.%iMiB' % size]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Single threaded multiplexer benchmark on emulated XMas_Tree devices
+
+Drives N emulated trees from one thread, first round robin with blocking
+exchanges (one command in flight on the whole bus at a time), then with
+xtmux.DeviceMux keeping a window of commands in flight on every device.
+
+Usage:
+    python benchmarks/bench_mux.py [-n 1,2,4,8,16,32] [-c 200] [-l 0.001]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import hidemu  # noqa: E402
+import XMas_Tree  # noqa: E402
+import xtmux  # noqa: E402
+
+_OPCODES = (0x40, 0x60, 0xf0, 0x51)
+
+
+def _trees(count, latency, blocking):
+    bus = hidemu.EmulatedBus()
+    for n in range(count):
+        bus.add('xmastree', 'XTMUX%03i' % n, latency=latency)
+    registry = XMas_Tree.device_registry(hidemu.EmulatorBackend(bus))
+    return [XMas_Tree.XMas_Tree(path=device['path'], registry=registry, shadow=False, blocking=blocking)
+            for device in registry.devices()]
+
+
+def run(counts=(1, 2, 4, 8, 16, 32), commands=200, latency=0.001):
+    '''Returns the aggregate commands/s of both strategies for every device count'''
+    results = {}
+    opcodes = list(_OPCODES) * (commands // len(_OPCODES))
+    for count in counts:
+        trees = _trees(count, latency, True)
+        start = time.perf_counter()
+        for opcode in opcodes:
+            for tree in trees:
+                tree.send_many([opcode])
+        results['blocking.%i' % count] = count * len(opcodes) / (time.perf_counter() - start)
+        trees = _trees(count, latency, False)
+        mux = xtmux.DeviceMux()
+        start = time.perf_counter()
+        requests = [mux.submit(tree, opcodes) for tree in trees]
+        assert mux.run()
+        results['mux.%i' % count] = count * len(opcodes) / (time.perf_counter() - start)
+        assert all(request.error is None for request in requests)
+        mux.close()
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Single threaded multiplexer benchmark.')
+    parser.add_argument('-n', '--devices', default='1,2,4,8,16,32', help='comma separated device counts')
+    parser.add_argument('-c', '--commands', type=int, default=200, help='commands per device')
+    parser.add_argument('-l', '--latency', type=float, default=0.001, help='emulated device latency in seconds')
+    args = parser.parse_args()
+    counts = [int(n) for n in args.devices.split(',')]
+    results = run(counts, args.commands, args.latency)
+    for count in counts:
+        before, after = results['blocking.%i' % count], results['mux.%i' % count]
+        print('%3i devices  blocking %8.0f cmd/s   mux %8.0f cmd/s   x%.1f' % (count, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
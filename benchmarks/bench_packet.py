@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Packet path microbenchmark, no hardware needed
+
+Compares the original list based _raw_sendreceive implementation with the
+preallocated PacketEngine against stub handles mimicking both the hid and
+the hidapi-cffi device objects, and the engine with metrics recording on.
+
+Usage:
+    python benchmarks/bench_packet.py [-n ITERATIONS]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import time
+import struct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from hidtransport import PacketEngine, packet_struct  # noqa: E402
+from hidmetrics import Metrics  # noqa: E402
+
+PACKET_SIZE = 64
+PAYLOAD_SIZE = 20
+TIMEOUT = 1000
+
+
+class StubHidDevice(object):
+    '''Mimics hid.device, converts the written buffer and replies with a new list of ints'''
+
+    def __init__(self):
+        self._reply = [0x01] + [0x00] * (PACKET_SIZE - 1)
+
+    def write(self, buff):
+        return len(bytes(bytearray(buff)))
+
+    def read(self, max_length, timeout_ms=0):
+        return self._reply[:max_length]
+
+
+class StubHidapiDevice(object):
+    '''Mimics hidapi.Device, prepends the report id and replies with bytes'''
+
+    def __init__(self):
+        self._reply = bytes(bytearray([0x01] + [0x00] * (PACKET_SIZE - 1)))
+
+    def write(self, data, report_id=b'\0'):
+        return len(report_id + data)
+
+    def read(self, length, timeout_ms=0):
+        return self._reply[:length]
+
+
+def legacy_sendreceive(devhandle, usinghid, packetarray):
+    '''The original per call list building implementation'''
+    if usinghid:
+        packetarray = [0x00] + packetarray + [0x00] * (PACKET_SIZE - len(packetarray))
+        devhandle.write(packetarray)
+        recvpacket = devhandle.read(max_length=PACKET_SIZE + 1, timeout_ms=TIMEOUT)
+    else:
+        packetarray = packetarray + [0x00] * (PACKET_SIZE - len(packetarray))
+        packet = struct.pack('<%dB' % PACKET_SIZE, *packetarray)
+        devhandle.write(packet)
+        recvpacket = devhandle.read(length=PACKET_SIZE + 1, timeout_ms=TIMEOUT)
+    if recvpacket is None or len(recvpacket) < PAYLOAD_SIZE:
+        return [0xff] * PAYLOAD_SIZE
+    return recvpacket[:PAYLOAD_SIZE] if usinghid else struct.unpack('<%iB' % PAYLOAD_SIZE, recvpacket[:PAYLOAD_SIZE])
+
+
+def _rate(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (time.perf_counter() - start)
+
+
+def run(iterations=200000):
+    '''Returns the commands per second for every backend and implementation'''
+    results = {}
+    opcode = packet_struct('<B', PACKET_SIZE)
+    for name, usinghid, stub in (('hid', True, StubHidDevice), ('hidapi', False, StubHidapiDevice)):
+        devhandle = stub()
+        engine = PacketEngine(devhandle, usinghid, PACKET_SIZE, PAYLOAD_SIZE, TIMEOUT)
+        results['%s.legacy' % name] = _rate(
+            lambda: legacy_sendreceive(devhandle, usinghid, [0x40])[0] == 1, iterations)
+        results['%s.engine' % name] = _rate(lambda: engine.transact(opcode, 0x40)[0] == 1, iterations)
+        engine.metrics = Metrics()
+        results['%s.metrics' % name] = _rate(lambda: engine.transact(opcode, 0x40)[0] == 1, iterations)
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Packet path microbenchmark.')
+    parser.add_argument('-n', '--iterations', type=int, default=200000, help='commands per measurement')
+    args = parser.parse_args()
+    results = run(args.iterations)
+    for name in ('hid', 'hidapi'):
+        before, after = results['%s.legacy' % name], results['%s.engine' % name]
+        metrics = results['%s.metrics' % name]
+        print('%-7s before %10.0f cmd/s   after %10.0f cmd/s   x%.2f   with metrics %10.0f cmd/s (+%.2f us/cmd)' %
+              (name, before, after, after / before, metrics, 1e6 / metrics - 1e6 / after))
+
+
+if __name__ == '__main__':
+    main()
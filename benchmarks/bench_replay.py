@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Firmware update replay benchmark, runs without any device attached
+
+Records the update of one emulated YKUSH board into a HID trace, then
+replays the trace at the recorded speed (which should take as long as the
+recording) and without delays, which leaves the host side cost of the
+enumeration, program and verify code paths.
+
+Usage:
+    python benchmarks/bench_replay.py [-s SIZE] [-l LATENCY] [-t TRACE]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import hidemu  # noqa: E402
+import hidtrace  # noqa: E402
+import pykfirmware  # noqa: E402
+from bench_hex import synthetic_hex  # noqa: E402
+
+
+def _update(image, backend):
+    start = time.perf_counter()
+    summary = pykfirmware.FleetRollout(io.BytesIO(image), jobs=1, backend=backend).run()
+    elapsed = time.perf_counter() - start
+    assert len(summary) == 1 and summary[0]['success']
+    return elapsed
+
+
+def run(size=0x4000, latency=0.001, trace=None):
+    '''Returns the seconds taken by the recorded update and by its replays'''
+    image = ''.join(synthetic_hex(size, address=0x1000)).encode()
+    path = trace or os.path.join(tempfile.mkdtemp(), 'update.hidtrace')
+    bus = hidemu.EmulatedBus()
+    bus.add('ykush', 'YK000001', latency=latency)
+    recorder = hidtrace.RecordingBackend(hidemu.EmulatorBackend(bus), path)
+    results = {'record': _update(image, recorder)}
+    recorder.close()
+    results['replay.1x'] = _update(image, hidtrace.ReplayBackend(path, speed=1.0))
+    results['replay.max'] = _update(image, hidtrace.ReplayBackend(path, speed=0))
+    results['trace_bytes'] = os.path.getsize(path)
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Firmware update replay benchmark.')
+    parser.add_argument('-s', '--size', type=lambda s: int(s, 0), default=0x4000, help='image size in bytes')
+    parser.add_argument('-l', '--latency', type=float, default=0.001, help='emulated round trip in seconds')
+    parser.add_argument('-t', '--trace', help='keep the recorded trace in this file')
+    args = parser.parse_args()
+    results = run(args.size, args.latency, args.trace)
+    print('recorded update    %7.3f s  (%i byte trace)' % (results['record'], results['trace_bytes']))
+    print('replay, 1x speed   %7.3f s' % results['replay.1x'])
+    print('replay, no delays  %7.3f s' % results['replay.max'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Per command cost of XMas_Tree.py processes against one script mode process
+
+The process case spawns XMas_Tree.py for every LED change, as shell driven
+orchestration does, paying the interpreter start, the enumeration and the
+device open each time.  The script case pipes the same LED changes to a
+single "XMas_Tree.py --script -" process and reads its JSON results, also
+reporting the mean and worst command time measured by the script runner.
+Both run against the emulator in child processes, --direct keeps a
+running daemon out of the measurement.
+
+Usage:
+    python benchmarks/bench_script.py [-n COMMANDS] [-l LATENCY]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+def _processes(env, runs):
+    start = time.perf_counter()
+    for i in range(runs):
+        subprocess.check_call([sys.executable, 'XMas_Tree.py', '--direct', '-f' if i & 1 else '-n'], cwd=ROOT,
+                              env=env, stdout=subprocess.DEVNULL)
+    return (time.perf_counter() - start) * 1e6 / runs
+
+
+def _script(env, commands):
+    # alternate the LED states so the shadow state never elides a command
+    script = ''.join('led1 %s\n' % ('off' if i & 1 else 'on') for i in range(commands))
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, 'XMas_Tree.py', '--direct', '--script', '-'], cwd=ROOT,
+                                     env=env, input=script.encode())
+    elapsed = time.perf_counter() - start
+    records = [json.loads(line) for line in output.decode().splitlines()]
+    assert len(records) == commands and all(record['ok'] for record in records)
+    seconds = [record['seconds'] for record in records]
+    return elapsed * 1e6 / commands, sum(seconds) * 1e6 / commands, max(seconds) * 1e6
+
+
+def run(commands=2000, latency=0.0005):
+    '''Returns the microseconds per command of both cases, with the script mode command mean and maximum'''
+    env = dict(os.environ, HID_BACKEND='emulator', HIDEMU_LATENCY=str(latency))
+    env.pop('HIDEMU_DEVICES', None)
+    results = {'process': _processes(env, max(5, commands // 100))}
+    results['script'], results['script.command'], results['script.worst'] = _script(env, commands)
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='XMas_Tree script mode benchmark.')
+    parser.add_argument('-n', '--commands', type=int, default=2000, help='LED commands of the script')
+    parser.add_argument('-l', '--latency', type=float, default=0.0005, help='emulated round trip in seconds')
+    args = parser.parse_args()
+    results = run(args.commands, args.latency)
+    print('process per command  %10.1f us/command' % results['process'])
+    print('script mode          %10.1f us/command  (%.1f us in the runner, worst %.1f us)' %
+          (results['script'], results['script.command'], results['script.worst']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Long light show benchmark, Python timeline against a compiled show file
+
+Builds a multi-hour show of short frames both as an xtanimation.Timeline
+and as a compiled xtshow file, then compares the load time, the memory
+allocated by loading and the playback rate.  Playback runs on a zero
+latency emulated tree with a virtual clock advanced by the sleeps, so the
+rate measures the player cost per frame rather than the show timing.
+
+Usage:
+    python benchmarks/bench_show.py [-H HOURS] [-f FRAME]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import hidemu  # noqa: E402
+import XMas_Tree  # noqa: E402
+import xtanimation  # noqa: E402
+import xtshow  # noqa: E402
+
+
+class _VirtualClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _show(hours, frame):
+    '''Frames of the show, the LEDs alternate with a slowly sweeping duty cycle'''
+    for n in range(int(hours * 3600 / (2 * frame))):
+        sweep = frame * 0.1 * (n % 10) / 10
+        yield xtanimation.Frame(True, False, frame + sweep)
+        yield xtanimation.Frame(False, True, frame - sweep)
+
+
+def _play(player_class, show):
+    bus = hidemu.EmulatedBus()
+    bus.add('xmastree', 'XT000001')
+    tree = XMas_Tree.XMas_Tree(registry=XMas_Tree.device_registry(hidemu.EmulatorBackend(bus)))
+    virtual = _VirtualClock()
+    start = time.perf_counter()
+    stats = player_class(tree, clock=virtual.clock, sleep=virtual.sleep).play(show)
+    return stats.frames / (time.perf_counter() - start)
+
+
+def _measure(load):
+    tracemalloc.start()
+    start = time.perf_counter()
+    show = load()
+    elapsed = time.perf_counter() - start
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return show, elapsed, allocated
+
+
+def run(hours=4.0, frame=0.05):
+    '''Returns the load seconds, loaded bytes and played frames/s of both representations'''
+    path = os.path.join(tempfile.mkdtemp(), 'show.xts')
+    start = time.perf_counter()
+    xtshow.compile_timeline(xtanimation.Timeline(_show(hours, frame)), path)
+    results = {'compile_seconds': time.perf_counter() - start, 'file_bytes': os.path.getsize(path)}
+    timeline, results['timeline.load'], results['timeline.bytes'] = _measure(
+        lambda: xtanimation.Timeline(_show(hours, frame)))
+    results['timeline.fps'] = _play(xtanimation.Animator, timeline)
+    del timeline
+    show, results['show.load'], results['show.bytes'] = _measure(lambda: xtshow.ShowFile(path))
+    results['show.fps'] = _play(xtshow.ShowPlayer, show)
+    show.close()
+    os.unlink(path)
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Long light show benchmark.')
+    parser.add_argument('-H', '--hours', type=float, default=4.0, help='show length in hours')
+    parser.add_argument('-f', '--frame', type=float, default=0.05, help='mean frame duration in seconds')
+    args = parser.parse_args()
+    results = run(args.hours, args.frame)
+    print('compiled %i bytes in %.2f s' % (results['file_bytes'], results['compile_seconds']))
+    for name in ('timeline', 'show'):
+        print('%-8s  load %8.4f s  %10i bytes allocated  play %8.0f frames/s' %
+              (name, results[name + '.load'], results[name + '.bytes'], results[name + '.fps']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Command line startup benchmark
+
+Runs fresh interpreters and reports the median wall time of a bare
+interpreter, of importing each tool, of their --help and of the first
+command sent to an emulated device (import, backend selection, device
+lookup and one round trip).
+
+Usage:
+    python benchmarks/bench_startup.py [-n RUNS]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import time
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+CASES = (
+    ('python', ['-c', 'pass']),
+    ('import XMas_Tree', ['-c', 'import XMas_Tree']),
+    ('import pykfirmware', ['-c', 'import pykfirmware']),
+    ('XMas_Tree.py --help', ['XMas_Tree.py', '--help']),
+    ('pykfirmware.py --help', ['pykfirmware.py', '--help']),
+    ('XMas_Tree first command', ['-c', 'import XMas_Tree; XMas_Tree.XMas_Tree().led1_on()']),
+    ('pykfirmware first command', ['-c', 'import pykfirmware; pykfirmware.YKUSH_ex().get_firmware_version_APP_MODE_ONLY()']),
+)
+
+
+def _time(args, env):
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable] + args, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def run(runs=10):
+    '''Returns the median wall time in ms of every case'''
+    env = dict(os.environ, HID_BACKEND='emulator')
+    results = {}
+    for name, args in CASES:
+        times = sorted(_time(args, env) for _ in range(runs))
+        results[name] = times[len(times) // 2] * 1000
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Command line startup benchmark.')
+    parser.add_argument('-n', '--runs', type=int, default=10, help='interpreters started per case')
+    args = parser.parse_args()
+    results = run(args.runs)
+    for name, args in CASES:
+        print('%-28s %8.1f ms' % (name, results[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Lossy link benchmark of the transport timeout policies
+
+An emulated XMas_Tree drops a fraction of its replies.  The benchmark
+compares the time N commands take with the former fixed 1 s timeout and
+with the adaptive TransportPolicy, both resending unanswered commands.
+
+Usage:
+    python benchmarks/bench_timeout.py [-n COMMANDS] [-l LATENCY] [-d 0.01,0.05]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import hidemu  # noqa: E402
+import XMas_Tree  # noqa: E402
+from hidtransport import TransportPolicy  # noqa: E402
+
+POLICIES = {
+    'fixed': lambda: TransportPolicy(initial_timeout=1.0, min_timeout=1.0, max_timeout=1.0, retries=5),
+    'adaptive': lambda: TransportPolicy(retries=5),
+}
+
+
+def run(commands=200, latency=0.001, drops=(0.01, 0.05)):
+    '''Returns the mean command time in ms for every policy and drop rate'''
+    results = {}
+    for drop in drops:
+        for name, policy in sorted(POLICIES.items()):
+            bus = hidemu.EmulatedBus()
+            bus.add('xmastree', 'XT000001', latency=latency, drop_rate=drop, seed=1)
+            XT = XMas_Tree.XMas_Tree(backend=hidemu.EmulatorBackend(bus), policy=policy())
+            start = time.perf_counter()
+            for i in range(commands):
+                XT.led1_on() if i & 1 else XT.led1_off()
+            results['%s.%g' % (name, drop)] = (time.perf_counter() - start) * 1000 / commands
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Lossy link timeout policy benchmark.')
+    parser.add_argument('-n', '--commands', type=int, default=200, help='commands per run')
+    parser.add_argument('-l', '--latency', type=float, default=0.001, help='emulated round trip in seconds')
+    parser.add_argument('-d', '--drops', default='0.01,0.05', help='comma separated reply drop rates')
+    args = parser.parse_args()
+    drops = [float(d) for d in args.drops.split(',')]
+    results = run(args.commands, args.latency, drops)
+    for drop in drops:
+        print('drop %4.1f%%  fixed %8.2f ms/cmd   adaptive %8.2f ms/cmd' %
+              (drop * 100, results['fixed.%g' % drop], results['adaptive.%g' % drop]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Benchmark suite runner with JSON results and regression comparison
+
+Runs the benchmarks of this directory with short settings, no hardware
+needed (stub handles, synthetic backends and the emulator), and writes
+every metric with the direction in which it improves to a JSON file.
+Two result files can then be compared, metrics which got worse by more
+than the threshold are flagged and make the command exit with status 1.
+
+    python benchmarks/suite.py run -o baseline.json
+    ... change the code ...
+    python benchmarks/suite.py run -o current.json
+    python benchmarks/suite.py compare baseline.json current.json [-t 0.1]
+
+The default set covers the packet path, HEX parsing, the program and
+verify loop, device lookup over large enumerations and command line
+startup; --all adds the emulator scaling and lossy link benchmarks.
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import fnmatch
+import platform
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SUITE_FORMAT = 1
+
+HIGHER = 'higher'
+LOWER = 'lower'
+
+# name, module, run() arguments, (metric pattern, better) rules, in the default set
+BENCHMARKS = (
+    ('packet', 'bench_packet', {'iterations': 50000}, (('*', HIGHER),), True),
+    ('hex', 'bench_hex', {'sizes': (1, 4)}, (('*', HIGHER),), True),
+    ('flash', 'bench_flash', {}, (('update.*', LOWER), ('pipelined.*', LOWER), ('*', HIGHER)), True),
+    ('enumerate', 'bench_enumerate', {'lookups': 500}, (('*', HIGHER),), True),
+    ('startup', 'bench_startup', {'runs': 5}, (('*', LOWER),), True),
+    ('mux', 'bench_mux', {'counts': (1, 8), 'commands': 100}, (('*', HIGHER),), False),
+    ('async', 'bench_async', {'commands': 100, 'counts': (1, 8)}, (('*', HIGHER),), False),
+    ('fleet', 'bench_fleet', {'jobs': (1, 4)}, (('*', HIGHER),), False),
+    ('timeout', 'bench_timeout', {'commands': 100}, (('*', LOWER),), False),
+    ('daemon', 'bench_daemon', {'commands': 200}, (('*', LOWER),), False),
+    ('script', 'bench_script', {'commands': 500}, (('*', LOWER),), False),
+    ('replay', 'bench_replay', {}, (('*', LOWER),), False),
+    ('show', 'bench_show', {'hours': 0.5}, (('*.fps', HIGHER), ('*', LOWER)), False),
+)
+
+
+def _better(rules, metric):
+    for pattern, better in rules:
+        if fnmatch.fnmatchcase(metric, pattern):
+            return better
+    return HIGHER
+
+
+def run(names=None, repeat=1, log=None):
+    '''Run the named benchmarks (the default set if None), returns the JSON serializable results
+
+    With repeat above 1 every metric keeps its best value over the runs.
+    '''
+    selected = [entry for entry in BENCHMARKS if (entry[0] in names if names else entry[4])]
+    unknown = set(names or ()) - set(entry[0] for entry in BENCHMARKS)
+    if unknown:
+        raise ValueError('unknown benchmark %s' % ', '.join(sorted(unknown)))
+    results = {'format': SUITE_FORMAT, 'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'python': platform.python_version(), 'platform': platform.platform(), 'benchmarks': {}}
+    for name, module, kwargs, rules, default in selected:
+        if log:
+            log('running %s' % name)
+        bench = __import__(module)
+        start = time.perf_counter()
+        metrics = {}
+        for _ in range(repeat):
+            for metric, value in bench.run(**kwargs).items():
+                better = _better(rules, metric)
+                if metric in metrics:
+                    value = (max if better == HIGHER else min)(value, metrics[metric]['value'])
+                metrics[metric] = {'value': value, 'better': better}
+        results['benchmarks'][name] = {'seconds': time.perf_counter() - start, 'metrics': metrics}
+    return results
+
+
+def compare(baseline, current, threshold=0.1):
+    '''Returns (benchmark, metric, old, new, relative change, status) rows, status being
+    regression, improvement, new, missing or an empty string'''
+    rows = []
+    for name in sorted(set(baseline['benchmarks']) | set(current['benchmarks'])):
+        old = baseline['benchmarks'].get(name, {}).get('metrics', {})
+        new = current['benchmarks'].get(name, {}).get('metrics', {})
+        for metric in sorted(set(old) | set(new)):
+            if metric not in old:
+                rows.append((name, metric, None, new[metric]['value'], None, 'new'))
+                continue
+            if metric not in new:
+                rows.append((name, metric, old[metric]['value'], None, None, 'missing'))
+                continue
+            before, after = old[metric]['value'], new[metric]['value']
+            change = (after - before) / float(before) if before else 0.0
+            # a positive gain is an improvement whatever the direction
+            gain = change if new[metric]['better'] == HIGHER else -change
+            status = 'regression' if gain < -threshold else 'improvement' if gain > threshold else ''
+            rows.append((name, metric, before, after, change, status))
+    return rows
+
+
+def _value(value):
+    return '-' if value is None else '%.6g' % value
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Benchmark suite runner.')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('run', help='run the benchmarks and write the JSON results')
+    command.add_argument('-o', '--output', help='JSON results file (default: standard output)')
+    command.add_argument('-b', '--benchmarks', help='comma separated benchmarks (%s)' %
+                         ','.join(entry[0] for entry in BENCHMARKS))
+    command.add_argument('-a', '--all', action='store_true', help='run every benchmark')
+    command.add_argument('-r', '--repeat', type=int, default=1, help='runs per benchmark, the best value is kept')
+    command = commands.add_parser('compare', help='compare two result files')
+    command.add_argument('baseline', help='JSON results of the reference run')
+    command.add_argument('current', help='JSON results of the run to check')
+    command.add_argument('-t', '--threshold', type=float, default=0.1,
+                         help='relative change flagged as a regression (default: 0.1)')
+    command.add_argument('-q', '--quiet', action='store_true', help='only print the flagged metrics')
+    args = parser.parse_args()
+    if args.command == 'run':
+        names = [entry[0] for entry in BENCHMARKS] if args.all else \
+            args.benchmarks.split(',') if args.benchmarks else None
+        try:
+            results = run(names, args.repeat, log=lambda message: print(message, file=sys.stderr))
+        except ValueError as e:
+            parser.exit(2, 'Error: %s\n' % e)
+        text = json.dumps(results, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
+    elif args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        rows = compare(baseline, current, args.threshold)
+        for name, metric, before, after, change, status in rows:
+            if args.quiet and status != 'regression':
+                continue
+            print('%-10s %-32s %12s %12s %8s  %s' % (name, metric, _value(before), _value(after),
+                                                     '-' if change is None else '%+.1f%%' % (change * 100), status))
+        regressions = sum(1 for row in rows if row[5] == 'regression')
+        print('%i regression(s) over %i metrics, threshold %.0f%%' % (regressions, len(rows), args.threshold * 100))
+        sys.exit(1 if regressions else 0)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,443 @@
+# coding: utf-8
+"""
+In-process XMas_Tree and Yepkit bootloader device emulator
+
+Provides an HID backend (see hidtransport.get_backend) whose devices live
+in the Python process, so the command line tools, the firmware flasher and
+the benchmarks can run on any box without hardware plugged in.
+
+Emulated application mode opcodes:
+    0x40/0x41 LED1 on/off, 0x50/0x51 LED2 on/off, 0x60 height,
+    0xf0 firmware version, 0xfd enter bootloader mode
+Emulated bootloader commands:
+    QUERY_DEVICE, UNLOCK_CONFIG, ERASE_DEVICE, PROGRAM_DEVICE,
+    PROGRAM_COMPLETE, GET_DATA, SIGN_FLASH, RESET_DEVICE
+
+Timing model: a reply becomes readable `latency` seconds after its command
+was written, and the device itself needs `service_time` seconds per packet,
+so back to back writes are pipelined the way a real USB device would.
+Faults can be injected per packet with the drop_rate (no reply, the read
+times out), error_rate (the write raises IOError) and corrupt_rate (the
+status byte is cleared) probabilities.
+
+Bootloader devices commit programmed data to the flash right away unless
+write_row is set: the data is then buffered a row of write_row bytes at a
+time, the row being written once a program packet moves to another row or
+on PROGRAM_COMPLETE, as the real bootloader does.
+
+Like the hidraw backend, handles have a fileno(): a pipe the emulator
+writes one byte to whenever a reply becomes readable, so emulated devices
+can be multiplexed with select.
+
+The default bus is configured from the environment:
+    HIDEMU_DEVICES   comma separated kind:serial list, kind is xmastree or ykush
+                     (default: xmastree:XT000001,ykush:YK000001)
+    HIDEMU_LATENCY   per packet latency in seconds (default: 0)
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import time
+import heapq
+import random
+import struct
+import threading
+import collections
+
+_clock = getattr(time, 'monotonic', time.time)
+
+EMU_USB_VID = 0x04d8
+EMU_USB_PACKET_SIZE = 64
+
+# kind: (product string, application mode PID, bootloader mode PID)
+EMU_DEVICE_KINDS = {
+    'xmastree': ('XMas_Tree', 0xf2fe, 0xf11c),
+    'ykush': ('YKUSH', 0xf2ff, 0xf11c),
+}
+
+# Bootloader commands, mirrors pykfirmware.YKBL_CMD_*
+_BL_QUERY_DEVICE = 0x02
+_BL_UNLOCK_CONFIG = 0x03
+_BL_ERASE_DEVICE = 0x04
+_BL_PROGRAM_DEVICE = 0x05
+_BL_PROGRAM_COMPLETE = 0x06
+_BL_GET_DATA = 0x07
+_BL_RESET_DEVICE = 0x08
+_BL_SIGN_FLASH = 0x09
+
+_BL_QUERY_REPLY = struct.Struct('<4B2LB')
+_BL_DATA_HEADER = struct.Struct('<BLB')
+_BL_DATA_OFFSET = 8
+
+
+def _set_nonblocking(fd):
+    import fcntl
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class EmulatedDevice(object):
+    '''The simulated hardware, shared by every handle opened on it'''
+
+    def __init__(self, kind='xmastree', serial='XT000001', firmware=(2, 1), height=0,
+                 memaddress=0x1000, memlength=0x7000, bytesperaddress=1,
+                 latency=0.0, service_time=0.0, jitter=0.0, reenum_delay=0.05, erase_time=0.0,
+                 drop_rate=0.0, error_rate=0.0, corrupt_rate=0.0, timeout_scale=1.0, write_row=0, seed=None):
+        self.kind = kind
+        self.product, self.app_pid, self.bl_pid = EMU_DEVICE_KINDS[kind]
+        self.serial = serial
+        self.firmware = firmware
+        self.height = height
+        self.memaddress = memaddress
+        self.memlength = memlength
+        self.bytesperaddress = bytesperaddress
+        self.latency = latency
+        self.service_time = service_time
+        self.jitter = jitter
+        self.reenum_delay = reenum_delay
+        self.erase_time = erase_time
+        self.drop_rate = drop_rate
+        self.error_rate = error_rate
+        self.corrupt_rate = corrupt_rate
+        self.timeout_scale = timeout_scale
+        self.leds = [False, False]
+        self.flash = bytearray(b'\xff') * memlength
+        self.write_row = write_row
+        # (row offset, data) of the row being buffered, with write_row set
+        self._row = None
+        self.signed = False
+        self.bootloader = False
+        self.packets = 0
+        self._attachat = 0.0
+        self._busyuntil = 0.0
+        self._generation = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def pid(self):
+        return self.bl_pid if self.bootloader else self.app_pid
+
+    @property
+    def path(self):
+        return ('emu:%s:%s' % (self.serial, 'bl' if self.bootloader else 'app')).encode()
+
+    @property
+    def attached(self):
+        return _clock() >= self._attachat
+
+    def reenumerate(self, bootloader):
+        '''Drop off the bus and come back after reenum_delay in the requested mode'''
+        self.bootloader = bootloader
+        self._generation += 1
+        self._attachat = _clock() + self.reenum_delay
+
+    def info(self):
+        '''Returns the enumeration dictionary in the hid module format'''
+        return {
+            'path': self.path,
+            'vendor_id': EMU_USB_VID,
+            'product_id': self.pid,
+            'serial_number': self.serial,
+            'release_number': 0x0100,
+            'manufacturer_string': 'Emulated',
+            'product_string': self.product,
+            'usage_page': 0xff00,
+            'usage': 1,
+            'interface_number': 0,
+        }
+
+    def schedule(self, now, work=0.0):
+        '''Returns the time the reply to a packet written now, keeping the device busy work seconds, becomes readable'''
+        with self._lock:
+            start = max(now, self._busyuntil)
+            self._busyuntil = start + self.service_time + work
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+            return self._busyuntil + delay
+
+    def fault(self, rate):
+        return rate and self._random.random() < rate
+
+    def handle(self, packet):
+        '''Process one 64 bytes report, returns the reply report or None'''
+        self.packets += 1
+        if self.bootloader:
+            return self._handle_bootloader(packet)
+        return self._handle_app(packet)
+
+    def _handle_app(self, packet):
+        reply = bytearray(EMU_USB_PACKET_SIZE)
+        opcode = packet[0]
+        if opcode in (0x40, 0x41, 0x50, 0x51):
+            self.leds[0 if opcode < 0x50 else 1] = not opcode & 0x01
+            reply[0] = 1
+        elif opcode == 0x60:
+            height = self.height() if callable(self.height) else self.height
+            reply[0], reply[1] = height & 0xff, (height >> 8) & 0xff
+        elif opcode == 0xf0:
+            reply[0:3] = bytearray([1, self.firmware[0], self.firmware[1]])
+        elif opcode == 0xfd:
+            reply[0] = 1
+            self.reenumerate(bootloader=True)
+        return reply
+
+    def _program(self, offset, value):
+        if not self.write_row:
+            # like real flash, programming can only clear bits
+            self.flash[offset] &= value
+            return
+        row = offset - offset % self.write_row
+        if self._row is None or self._row[0] != row:
+            self._commit()
+            self._row = (row, bytearray(b'\xff') * self.write_row)
+        self._row[1][offset - row] &= value
+
+    def _commit(self):
+        '''Write the buffered row to the flash'''
+        if self._row is not None:
+            row, data = self._row
+            for i, value in enumerate(data[:self.memlength - row]):
+                self.flash[row + i] &= value
+            self._row = None
+
+    def _handle_bootloader(self, packet):
+        reply = bytearray(EMU_USB_PACKET_SIZE)
+        command = packet[0]
+        reply[0] = command
+        if command == _BL_QUERY_DEVICE:
+            _BL_QUERY_REPLY.pack_into(reply, 0, command, 56, self.bytesperaddress, 1,
+                                      self.memaddress, self.memlength, 0xff)
+        elif command == _BL_ERASE_DEVICE:
+            # erase_time is accounted as busy time when the packet is scheduled
+            self.flash[:] = b'\xff' * self.memlength
+            self.signed = False
+            self._row = None
+        elif command == _BL_PROGRAM_DEVICE:
+            address, size = _BL_DATA_HEADER.unpack_from(packet)[1:]
+            start, length = address - self.memaddress, size // self.bytesperaddress
+            for i in range(min(length, self.memlength - start) if start >= 0 else 0):
+                self._program(start + i, packet[_BL_DATA_OFFSET + i])
+        elif command == _BL_PROGRAM_COMPLETE:
+            self._commit()
+        elif command == _BL_GET_DATA:
+            address, size = _BL_DATA_HEADER.unpack_from(packet)[1:]
+            start = address - self.memaddress
+            _BL_DATA_HEADER.pack_into(reply, 0, command, address, size)
+            data = self.flash[max(0, start):max(0, start + size)]
+            reply[_BL_DATA_OFFSET:_BL_DATA_OFFSET + len(data)] = data
+        elif command == _BL_SIGN_FLASH:
+            self.signed = True
+        elif command == _BL_RESET_DEVICE:
+            # the device reboots right away, nothing is sent back
+            self.reenumerate(bootloader=False)
+            return None
+        return reply
+
+
+class _Notifier(object):
+    '''Background thread signalling handles when their scheduled replies become readable'''
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        thread = threading.Thread(target=self._run, name='hidemu-notifier')
+        thread.daemon = True
+        thread.start()
+
+    def schedule(self, when, handle):
+        with self._condition:
+            self._sequence += 1
+            heapq.heappush(self._heap, (when, self._sequence, handle))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                when, sequence, handle = self._heap[0]
+                wait = when - _clock()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+            handle._signal()
+
+
+_notifier = None
+_notifierLock = threading.Lock()
+
+
+def _notify(when, handle):
+    global _notifier
+    if when <= _clock():
+        handle._signal()
+        return
+    with _notifierLock:
+        if _notifier is None:
+            _notifier = _Notifier()
+    _notifier.schedule(when, handle)
+
+
+class EmulatedHandle(object):
+    '''Open device handle, same interface as hid.device'''
+
+    def __init__(self, device):
+        self._device = device
+        self._generation = device._generation
+        self._pending = collections.deque()
+        self._closed = False
+        self._pipe = None
+
+    def fileno(self):
+        '''Readable end of the notification pipe, created on first use'''
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            for fd in self._pipe:
+                _set_nonblocking(fd)
+        return self._pipe[0]
+
+    def _signal(self):
+        pipe = self._pipe
+        if pipe is not None:
+            try:
+                os.write(pipe[1], b'\0')
+            except OSError:
+                # closed in the meantime
+                pass
+
+    def _check(self):
+        if self._closed:
+            raise ValueError('not open')
+        if self._generation != self._device._generation:
+            raise IOError('device disconnected')
+
+    def write(self, buff):
+        self._check()
+        device = self._device
+        if device.fault(device.error_rate):
+            raise IOError('emulated write error')
+        # drop the report id, the emulated device has a single report
+        packet = bytearray(buff)[1:EMU_USB_PACKET_SIZE + 1]
+        erasing = device.bootloader and packet[0] == _BL_ERASE_DEVICE
+        readyat = device.schedule(_clock(), device.erase_time if erasing else 0.0)
+        reply = device.handle(packet)
+        if reply is not None and not device.fault(device.drop_rate):
+            if device.fault(device.corrupt_rate):
+                reply[0] = 0
+            self._pending.append((readyat, reply))
+            if self._pipe is not None:
+                _notify(readyat, self)
+        return len(buff)
+
+    def read(self, max_length, timeout_ms=0):
+        if self._closed:
+            raise ValueError('not open')
+        if self._pipe is not None:
+            # clear the notifications first, a reply getting ready from now on signals again
+            try:
+                while os.read(self._pipe[0], 64):
+                    pass
+            except OSError:
+                pass
+        if not self._pending:
+            if timeout_ms:
+                time.sleep(timeout_ms * self._device.timeout_scale / 1000.0)
+            return []
+        readyat, reply = self._pending[0]
+        wait = readyat - _clock()
+        if wait > 0:
+            if 0 <= timeout_ms < wait * 1000.0:
+                time.sleep(timeout_ms / 1000.0)
+                return []
+            time.sleep(wait)
+        self._pending.popleft()
+        if self._pipe is not None and self._pending and self._pending[0][0] <= _clock():
+            # keep the pipe readable while replies are waiting
+            self._signal()
+        return list(reply[:max_length])
+
+    def get_product_string(self):
+        return self._device.product
+
+    def get_manufacturer_string(self):
+        return 'Emulated'
+
+    def get_serial_number_string(self):
+        return self._device.serial
+
+    def close(self):
+        self._closed = True
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
+
+
+class EmulatedBus(object):
+    '''A set of emulated devices, enumerated and opened like the real bus'''
+
+    def __init__(self, devices=()):
+        self.devices = list(devices)
+
+    def add(self, *args, **kwargs):
+        '''Create a device with the EmulatedDevice arguments and attach it'''
+        device = EmulatedDevice(*args, **kwargs)
+        self.devices.append(device)
+        return device
+
+    def find(self, serial):
+        for device in self.devices:
+            if device.serial == serial:
+                return device
+        return None
+
+    def hotplug_token(self):
+        return tuple(device.path for device in self.devices if device.attached)
+
+    def enumerate(self, vid=0, pid=0):
+        for device in self.devices:
+            if device.attached and vid in (0, EMU_USB_VID) and pid in (0, device.pid):
+                yield device.info()
+
+    def open(self, path, blocking=True):
+        # replies are always scheduled, blocking only matters to the real backends
+        for device in self.devices:
+            if device.attached and device.path == path:
+                return EmulatedHandle(device)
+        raise IOError('open failed')
+
+
+class EmulatorBackend(object):
+    '''HID backend serving an EmulatedBus, uses the hid module calling convention'''
+    name = 'emulator'
+    usinghid = True
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def hotplug_token(self):
+        return self.bus.hotplug_token()
+
+    def enumerate(self, vid=0, pid=0):
+        return self.bus.enumerate(vid, pid)
+
+    def open(self, path, blocking=True):
+        return self.bus.open(path, blocking)
+
+
+_defaultBus = None
+
+
+def default_bus():
+    '''Returns the process wide bus built from HIDEMU_DEVICES and HIDEMU_LATENCY'''
+    global _defaultBus
+    if _defaultBus is None:
+        latency = float(os.environ.get('HIDEMU_LATENCY', 0))
+        _defaultBus = EmulatedBus()
+        for spec in os.environ.get('HIDEMU_DEVICES', 'xmastree:XT000001,ykush:YK000001').split(','):
+            kind, serial = spec.strip().split(':')
+            _defaultBus.add(kind, serial, latency=latency)
+    return _defaultBus
@@ -0,0 +1,219 @@
+# coding: utf-8
+"""
+Per opcode transport metrics for the XMas_Tree and Yepkit tools
+
+A Metrics object attached to a PacketEngine (metrics= argument of
+XMas_Tree, YKUSH_ex or PacketEngine) records for every opcode the number
+of commands, timeouts, retries, bytes sent and received, and a latency
+histogram.  The histogram uses HDR style log buckets: microsecond values
+below 8 get their own bucket, every power of two above is split into 8
+linear sub buckets, so any recorded latency is known within 12.5% while
+the whole range up to an hour fits in 240 counters.
+
+    metrics = Metrics({'serial': 'XT000001'})
+    XT = XMas_Tree.XMas_Tree(metrics=metrics)
+    XT.led1_on()
+    print(metrics.snapshot())
+    write_prometheus('/var/lib/node_exporter/xmastree.prom', [metrics])
+
+Without metrics the engine only tests one attribute against None per
+command, so leaving the hook in place costs nothing measurable.
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+from array import array
+
+# Sub buckets per power of two, as a bit count
+HISTOGRAM_SUB_BITS = 3
+# Largest tracked value is 2 ** HISTOGRAM_MAX_BITS - 1 microseconds, larger ones are clamped
+HISTOGRAM_MAX_BITS = 32
+# Bucket upper bounds in seconds exported to Prometheus
+PROMETHEUS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                      0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_SUB_COUNT = 1 << HISTOGRAM_SUB_BITS
+_SUB_MASK = _SUB_COUNT - 1
+_MAX_VALUE = (1 << HISTOGRAM_MAX_BITS) - 1
+
+# os.rename does not replace an existing file on Windows, os.replace is Python 3.3+
+_replace = getattr(os, 'replace', os.rename)
+
+
+class LatencyHistogram(object):
+    '''Log bucketed histogram of durations, recorded in seconds with microsecond resolution'''
+
+    def __init__(self):
+        self.counts = array(str('L'), [0]) * ((HISTOGRAM_MAX_BITS - HISTOGRAM_SUB_BITS + 1) * _SUB_COUNT)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def bucket(value):
+        '''Index of the bucket holding value microseconds'''
+        if value < _SUB_COUNT:
+            return value
+        shift = value.bit_length() - HISTOGRAM_SUB_BITS - 1
+        return ((shift + 1) << HISTOGRAM_SUB_BITS) + ((value >> shift) & _SUB_MASK)
+
+    @staticmethod
+    def bounds(index):
+        '''(lowest, highest) microsecond values of a bucket'''
+        if index < _SUB_COUNT:
+            return index, index
+        shift = (index >> HISTOGRAM_SUB_BITS) - 1
+        low = (_SUB_COUNT + (index & _SUB_MASK)) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, seconds):
+        value = min(_MAX_VALUE, max(0, int(seconds * 1000000)))
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        '''Upper bound in seconds of the bucket holding the p-th percentile (nearest rank)'''
+        if not self.count:
+            return 0.0
+        rank = max(1, int(p * self.count / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bounds(index)[1] / 1000000.0, self.max)
+        return self.max
+
+    def cumulative(self, bounds=PROMETHEUS_BUCKETS):
+        '''Returns the count of values at or below every bound in seconds
+
+        A bucket straddling a bound is counted above it, like a value rounded up.
+        '''
+        result = []
+        seen = 0
+        index = 0
+        size = len(self.counts)
+        for bound in bounds:
+            limit = bound * 1000000
+            while index < size and self.bounds(index)[1] <= limit:
+                seen += self.counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+
+class OpcodeStats(object):
+    '''Counters of one opcode'''
+
+    __slots__ = ('commands', 'timeouts', 'retries', 'bytes_sent', 'bytes_received', 'latency')
+
+    def __init__(self):
+        self.commands = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = LatencyHistogram()
+
+    def as_dict(self, percentiles=(50, 90, 99, 99.9)):
+        latency = self.latency
+        result = {'commands': self.commands, 'timeouts': self.timeouts, 'retries': self.retries,
+                  'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                  'error_rate': float(self.timeouts) / (self.commands + self.timeouts)
+                  if self.commands + self.timeouts else 0.0,
+                  'latency': {'count': latency.count, 'mean': latency.mean, 'min': latency.min, 'max': latency.max}}
+        for p in percentiles:
+            result['latency']['p%s' % p] = latency.percentile(p)
+        return result
+
+
+class Metrics(object):
+    '''Transport metrics of one device, labels are exported with every Prometheus sample'''
+
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        self.opcodes = {}
+
+    def _stats(self, opcode):
+        stats = self.opcodes.get(opcode)
+        if stats is None:
+            stats = self.opcodes[opcode] = OpcodeStats()
+        return stats
+
+    def command(self, opcode, seconds, sent, received):
+        '''Account an answered command'''
+        stats = self._stats(opcode)
+        stats.commands += 1
+        stats.bytes_sent += sent
+        stats.bytes_received += received
+        stats.latency.record(seconds)
+
+    def timeout(self, opcode, sent):
+        '''Account a command left unanswered'''
+        stats = self._stats(opcode)
+        stats.timeouts += 1
+        stats.bytes_sent += sent
+
+    def retry(self, opcode):
+        '''Account a command being resent'''
+        self._stats(opcode).retries += 1
+
+    def snapshot(self):
+        '''Returns the labels and the per opcode counters and latency summary as plain dictionaries'''
+        return {'labels': dict(self.labels),
+                'opcodes': dict(('0x%.2x' % opcode, stats.as_dict()) for opcode, stats in sorted(self.opcodes.items()))}
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in sorted(labels.items()))
+
+
+def prometheus_text(metrics, prefix='hid'):
+    '''Returns the Prometheus text exposition of a list of Metrics'''
+    samples = []
+    for device in metrics:
+        for opcode, stats in sorted(device.opcodes.items()):
+            labels = dict(device.labels, opcode='0x%.2x' % opcode)
+            samples.append((labels, stats))
+    lines = []
+    for name, kind, help_text, attribute in (
+            ('commands_total', 'counter', 'Answered commands', 'commands'),
+            ('timeouts_total', 'counter', 'Reads timing out', 'timeouts'),
+            ('retries_total', 'counter', 'Commands resent', 'retries'),
+            ('sent_bytes_total', 'counter', 'Report bytes written', 'bytes_sent'),
+            ('received_bytes_total', 'counter', 'Report bytes read', 'bytes_received')):
+        lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+        lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+        for labels, stats in samples:
+            lines.append('%s_%s{%s} %i' % (prefix, name, _labels(labels), getattr(stats, attribute)))
+    name = '%s_command_latency_seconds' % prefix
+    lines.append('# HELP %s Command round trip time' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for labels, stats in samples:
+        latency = stats.latency
+        for bound, count in zip(PROMETHEUS_BUCKETS, latency.cumulative()):
+            lines.append('%s_bucket{%s} %i' % (name, _labels(dict(labels, le='%g' % bound)), count))
+        lines.append('%s_bucket{%s} %i' % (name, _labels(dict(labels, le='+Inf')), latency.count))
+        lines.append('%s_sum{%s} %.9f' % (name, _labels(labels), latency.total))
+        lines.append('%s_count{%s} %i' % (name, _labels(labels), latency.count))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, metrics, prefix='hid'):
+    '''Write the Prometheus text exposition to path, replaced atomically for the textfile collectors'''
+    temporary = '%s.%i.tmp' % (path, os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(prometheus_text(metrics, prefix))
+    _replace(temporary, path)
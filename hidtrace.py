@@ -0,0 +1,412 @@
+# coding: utf-8
+"""
+Record and replay of the HID traffic of the XMas_Tree and Yepkit tools
+
+RecordingBackend wraps any HID backend and appends every enumeration,
+open, written report, received report and close to a compact binary
+trace.  ReplayBackend serves such a trace back: enumerations return the
+recorded device lists, written reports are checked against the recorded
+ones and reads return the recorded replies after the recorded delay,
+divided by speed (0 replays as fast as possible).  Performance tests of
+the LED and flashing code paths can so run deterministically on machines
+without any device attached.
+
+Both are selected from the environment:
+    HID_TRACE=run.hidtrace python pykfirmware.py fw.hex       record
+    HID_BACKEND=replay HID_REPLAY=run.hidtrace python pykfirmware.py fw.hex
+    HID_REPLAY_SPEED     replay speed factor (default: 1, 0 means no delays)
+    python hidtrace.py run.hidtrace                          dump a trace
+
+Trace format: the 8 byte magic "HIDTRACE", a version byte, then records
+made of a little endian header (kind u8, handle u16, seconds since the
+recording started f64, payload length u16) and the payload.  Reports are
+stored as written/read by the backend; enumerations, opens and the META
+record holding the backend name and calling convention are stored as
+JSON.  Empty reads (timeouts, non blocking polls) are not recorded: a
+replayed read returns a reply only when the next event of its handle is
+one, so timing dependent polling replays consistently.
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import json
+import time
+import atexit
+import bisect
+import struct
+import binascii
+import threading
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# environment variables: trace to record to, trace to replay and replay speed factor
+HID_TRACE_ENV = 'HID_TRACE'
+HID_REPLAY_ENV = 'HID_REPLAY'
+HID_REPLAY_SPEED_ENV = 'HID_REPLAY_SPEED'
+
+TRACE_MAGIC = b'HIDTRACE'
+TRACE_VERSION = 1
+
+# record kinds
+TRACE_META = 0
+TRACE_ENUM = 1
+TRACE_OPEN = 2
+TRACE_WRITE = 3
+TRACE_READ = 4
+TRACE_CLOSE = 5
+
+TRACE_KIND_NAMES = {TRACE_META: 'META', TRACE_ENUM: 'ENUM', TRACE_OPEN: 'OPEN', TRACE_WRITE: 'WRITE',
+                    TRACE_READ: 'READ', TRACE_CLOSE: 'CLOSE'}
+
+_RECORD = struct.Struct('<BHdH')
+
+
+class TraceError(IOError):
+    '''Malformed trace, or the replayed program diverged from the recording'''
+
+
+def _encode(value):
+    '''JSON friendly copy of enumeration data, bytes (hid paths) are kept apart from text'''
+    if isinstance(value, dict):
+        return dict((key, _encode(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if isinstance(value, (bytes, bytearray)):
+        return {'bytes': binascii.hexlify(bytes(value)).decode()}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if list(value) == ['bytes']:
+            return binascii.unhexlify(value['bytes'])
+        return dict((key, _decode(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+class TraceWriter(object):
+    '''Thread safe appender of trace records'''
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(TRACE_MAGIC + struct.pack('<B', TRACE_VERSION))
+        self._lock = threading.Lock()
+        self._start = _clock()
+        self._handles = 0
+
+    def new_handle(self):
+        with self._lock:
+            self._handles += 1
+            return self._handles
+
+    def record(self, kind, handle, payload=b''):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(_RECORD.pack(kind, handle, _clock() - self._start, len(payload)))
+            self._file.write(payload)
+
+    def record_json(self, kind, handle, value):
+        self.record(kind, handle, json.dumps(_encode(value), sort_keys=True).encode('utf-8'))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_trace(path):
+    '''Returns the records of a trace as (kind, handle, seconds, payload) tuples, JSON payloads decoded'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+        raise TraceError('%s is not a HID trace' % path)
+    version = bytearray(data[len(TRACE_MAGIC):len(TRACE_MAGIC) + 1])
+    if not version or version[0] != TRACE_VERSION:
+        raise TraceError('unsupported trace version %s' % (version[0] if version else None))
+    records = []
+    offset = len(TRACE_MAGIC) + 1
+    while offset < len(data):
+        if offset + _RECORD.size > len(data):
+            raise TraceError('truncated trace record at offset %i' % offset)
+        kind, handle, seconds, length = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        payload = data[offset:offset + length]
+        if len(payload) != length:
+            raise TraceError('truncated trace record at offset %i' % offset)
+        offset += length
+        if kind in (TRACE_META, TRACE_ENUM, TRACE_OPEN):
+            payload = _decode(json.loads(payload.decode('utf-8')))
+        records.append((kind, handle, seconds, payload))
+    return records
+
+
+class RecordingHandle(object):
+    '''Device handle forwarding to the wrapped one and recording the reports'''
+
+    def __init__(self, devhandle, trace, handle):
+        self._devhandle = devhandle
+        self._trace = trace
+        self._handle = handle
+
+    def write(self, buff):
+        result = self._devhandle.write(buff)
+        self._trace.record(TRACE_WRITE, self._handle, bytes(bytearray(buff)))
+        return result
+
+    def read(self, *args, **kwargs):
+        reply = self._devhandle.read(*args, **kwargs)
+        if reply:
+            self._trace.record(TRACE_READ, self._handle, bytes(bytearray(reply)))
+        return reply
+
+    def close(self):
+        self._trace.record(TRACE_CLOSE, self._handle)
+        return self._devhandle.close()
+
+    def __getattr__(self, name):
+        # fileno, set_nonblocking and the string getters
+        return getattr(self._devhandle, name)
+
+
+class RecordingBackend(object):
+    '''HID backend wrapper writing the traffic of another backend to a trace file'''
+    name = 'record'
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.usinghid = backend.usinghid
+        self._trace = TraceWriter(path)
+        self._trace.record_json(TRACE_META, 0, {'backend': backend.name, 'usinghid': bool(backend.usinghid)})
+        atexit.register(self._trace.close)
+
+    def enumerate(self, vid=0, pid=0):
+        devices = list(self.backend.enumerate(vid, pid))
+        self._trace.record_json(TRACE_ENUM, 0, {'vid': vid, 'pid': pid, 'devices': devices})
+        return iter(devices)
+
+    def hotplug_token(self):
+        return getattr(self.backend, 'hotplug_token', lambda: None)()
+
+    def open(self, path, blocking=True):
+        devhandle = self.backend.open(path, blocking)
+        handle = self._trace.new_handle()
+        self._trace.record_json(TRACE_OPEN, handle, {'path': path, 'blocking': blocking})
+        return RecordingHandle(devhandle, self._trace, handle)
+
+    def close(self):
+        '''Flush and close the trace, later traffic is not recorded'''
+        self._trace.close()
+
+
+class ReplayHandle(object):
+    '''Device handle serving the recorded events of one opened device'''
+
+    def __init__(self, replay, events, info, blocking):
+        self._replay = replay
+        self._events = events
+        self._next = 0
+        self._info = info or {}
+        self._blocking = blocking
+        self._closed = False
+
+    def _peek(self):
+        while self._next < len(self._events) and self._events[self._next][1] == TRACE_CLOSE:
+            self._next += 1
+        return self._events[self._next] if self._next < len(self._events) else None
+
+    def write(self, buff):
+        if self._closed:
+            raise ValueError('not open')
+        packet = bytes(bytearray(buff))
+        event = self._peek()
+        if event is None or event[1] != TRACE_WRITE:
+            raise TraceError('unexpected write of %s, the recording has %s' %
+                             (binascii.hexlify(packet[:8]).decode(),
+                              'nothing left' if event is None else TRACE_KIND_NAMES[event[1]]))
+        if self._replay.strict and event[3] != packet:
+            raise TraceError('written report %s differs from the recorded %s (record %i)' %
+                             (binascii.hexlify(packet[:8]).decode(), binascii.hexlify(event[3][:8]).decode(),
+                              event[0]))
+        self._next += 1
+        self._replay.consumed(event)
+        return len(packet)
+
+    def read(self, max_length=None, timeout_ms=0, length=None):
+        if self._closed:
+            raise ValueError('not open')
+        size = max_length if max_length is not None else length
+        event = self._peek()
+        now = _clock()
+        if timeout_ms > 0:
+            limit = now + timeout_ms / 1000.0
+        else:
+            # like hid, a 0 timeout blocks on a blocking handle and returns at once otherwise
+            limit = None if self._blocking else now
+        due = self._replay.due(event) if event is not None and event[1] == TRACE_READ else None
+        if due is None or (limit is not None and due > limit):
+            # nothing will arrive within the timeout, the recorded program saw no reply either
+            if limit is None:
+                raise TraceError('blocking read with no recorded reply left')
+            if limit > now:
+                time.sleep(self._replay.scaled(limit - now))
+            return [] if self._replay.usinghid else b''
+        if due > now:
+            time.sleep(due - now)
+        self._next += 1
+        self._replay.consumed(event)
+        reply = event[3][:size]
+        return list(bytearray(reply)) if self._replay.usinghid else reply
+
+    def get_product_string(self):
+        return self._info.get('product_string', '')
+
+    def get_manufacturer_string(self):
+        return self._info.get('manufacturer_string', '')
+
+    def get_serial_number_string(self):
+        return self._info.get('serial_number', '')
+
+    def set_nonblocking(self, nonblocking):
+        self._blocking = not nonblocking
+        return 0
+
+    def close(self):
+        self._closed = True
+
+
+class ReplayBackend(object):
+    '''HID backend replaying a trace recorded by RecordingBackend
+
+    Recorded time is mapped onto the local clock at every consumed event,
+    so a reply is due its recorded delay after the write preceding it,
+    scaled by 1 / speed.  With strict set, written reports must equal the
+    recorded ones byte for byte.
+    '''
+    name = 'replay'
+
+    def __init__(self, path, speed=1.0, strict=True):
+        records = read_trace(path)
+        if not records or records[0][0] != TRACE_META:
+            raise TraceError('%s has no META record' % path)
+        meta = records[0][3]
+        self.usinghid = meta['usinghid']
+        self.recorded_backend = meta['backend']
+        self.speed = speed
+        self.strict = strict
+        self._lock = threading.Lock()
+        # (index, kind, seconds, payload) per handle, the enumerations, opens and report record indexes
+        self._handles = {}
+        self._enums = []
+        self._opens = []
+        self._traffic = []
+        for index, (kind, handle, seconds, payload) in enumerate(records):
+            if kind == TRACE_ENUM:
+                self._enums.append((index, seconds, payload))
+            elif kind == TRACE_OPEN:
+                self._opens.append((index, handle, seconds, payload))
+            elif kind in (TRACE_WRITE, TRACE_READ, TRACE_CLOSE):
+                self._handles.setdefault(handle, []).append((index, kind, seconds, payload))
+                if kind != TRACE_CLOSE:
+                    self._traffic.append(index)
+        self._enumindexes = [enum[0] for enum in self._enums]
+        self._position = 0
+        self._enum = None
+        self._anchor = None
+
+    def scaled(self, seconds):
+        return seconds / self.speed if self.speed else 0.0
+
+    def consumed(self, event):
+        '''Move the replay position and the recorded to local time anchor to an event'''
+        with self._lock:
+            self._position = max(self._position, event[0])
+            self._anchor = (event[2], _clock())
+
+    def due(self, event):
+        '''Local clock time at which a recorded event happens'''
+        anchor = self._anchor
+        if anchor is None or not self.speed:
+            return _clock()
+        return anchor[1] + max(0.0, event[2] - anchor[0]) / self.speed
+
+    def enumerate(self, vid=0, pid=0):
+        '''Returns the next recorded enumeration if no device traffic precedes it, the last one otherwise'''
+        with self._lock:
+            position = bisect.bisect_right(self._enumindexes, self._position)
+            following = self._enums[position] if position < len(self._enums) else None
+            if following is not None:
+                # reports still to replay before it mean the program enumerates more often than recorded
+                traffic = bisect.bisect_right(self._traffic, self._position)
+                if self._enum is None or traffic == len(self._traffic) or self._traffic[traffic] > following[0]:
+                    self._enum = following
+                    self._position = following[0]
+            enum = self._enum
+        if enum is None:
+            return iter([])
+        delay = self.due((enum[0], TRACE_ENUM, enum[1])) - _clock()
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            self._anchor = (enum[1], _clock())
+        return iter([device for device in enum[2]['devices']
+                     if (not vid or device['vendor_id'] == vid) and (not pid or device['product_id'] == pid)])
+
+    def hotplug_token(self):
+        # every enumeration consumes the recording, the registry only rescans when it misses a device
+        return None
+
+    def _info(self, path):
+        for enum in reversed([enum for enum in self._enums if enum[0] <= self._position] or self._enums):
+            for device in enum[2]['devices']:
+                if device['path'] == path:
+                    return device
+        return None
+
+    def open(self, path, blocking=True):
+        with self._lock:
+            for position, record in enumerate(self._opens):
+                if record[3]['path'] == path:
+                    del self._opens[position]
+                    break
+            else:
+                raise IOError('no recorded open of %s left' % (path,))
+            self._position = max(self._position, record[0])
+        return ReplayHandle(self, self._handles.get(record[1], []), self._info(path), blocking)
+
+
+def replay_backend():
+    '''ReplayBackend configured from HID_REPLAY and HID_REPLAY_SPEED'''
+    path = os.environ.get(HID_REPLAY_ENV)
+    if not path:
+        raise ValueError('the replay backend needs the %s environment variable' % HID_REPLAY_ENV)
+    return ReplayBackend(path, float(os.environ.get(HID_REPLAY_SPEED_ENV, 1.0)))
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Dump a HID trace.')
+    parser.add_argument('trace', help='trace file')
+    args = parser.parse_args()
+    for kind, handle, seconds, payload in read_trace(args.trace):
+        if kind in (TRACE_WRITE, TRACE_READ):
+            payload = binascii.hexlify(payload.rstrip(b'\0') or payload[:1]).decode()
+        elif kind == TRACE_ENUM:
+            payload = ' '.join('%.4x:%.4x/%s' % (device['vendor_id'], device['product_id'], device['serial_number'])
+                               for device in payload['devices'])
+        elif kind == TRACE_OPEN:
+            path = payload['path']
+            payload = '%s%s' % (path.decode() if isinstance(path, bytes) else path,
+                                '' if payload['blocking'] else ' non blocking')
+        elif kind == TRACE_CLOSE:
+            payload = ''
+        print('%10.6f %-5s %3i %s' % (seconds, TRACE_KIND_NAMES.get(kind, kind), handle, payload))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,742 @@
+# coding: utf-8
+"""
+HID packet engine shared by the XMas_Tree and Yepkit firmware tools
+
+Every device handle gets one PacketEngine owning a preallocated send and
+receive buffer.  Commands are packed straight into the send buffer with
+precompiled struct.Struct objects and replies are handed back as a
+memoryview on the receive buffer, so the command path neither builds
+Python lists nor compiles format strings.
+
+Note: the returned reply view is only valid until the next command is
+issued on the same engine, copy it (bytes(view)) if it must be kept.
+
+Read timeouts come from a per device TransportPolicy learning the round
+trip time (smoothed mean and deviation, as TCP does), an unanswered
+command is retried with bounded exponential backoff and raises
+TransportTimeout once the retries are exhausted.
+
+The module also owns the backend selection: hidapi and hidapi-cffi are
+only imported when the first backend is requested, then cached, so
+importing the tools or running --help never loads a HID library.  The
+in-process emulator (see hidemu.py) can be picked instead by passing
+backend='emulator' or setting the HID_BACKEND environment variable, e.g.:
+    HID_BACKEND=emulator python XMas_Tree.py -l
+On Linux backend='hidraw' talks to the /dev/hidraw nodes without any
+library and, like the emulator, gives handles with a fileno() that can
+be opened non blocking and multiplexed with select (see xtmux.py).
+HID_TRACE=<file> records the traffic of any backend and
+HID_BACKEND=replay HID_REPLAY=<file> plays it back (see hidtrace.py).
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import time
+import errno
+import functools
+import random
+import select
+import struct
+import collections
+try:
+    _stringTypes = (basestring,)  # noqa: F821
+except NameError:
+    _stringTypes = (str,)
+
+# environment variable used to select the backend when none is given explicitly
+HID_BACKEND_ENV = 'HID_BACKEND'
+# environment variable naming a trace file recording the traffic of the backend (see hidtrace.py)
+HID_TRACE_ENV = 'HID_TRACE'
+
+# Linux lists every hidraw node here and udev keeps it current on hotplug
+HIDRAW_SYSFS_DIR = '/sys/class/hidraw'
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# imported HID libraries by module name, None once an import failed
+_libraries = {}
+_libraryErrors = []
+
+
+def _library(name):
+    '''Import a HID library on first use, returns None if it is not installed'''
+    if name not in _libraries:
+        try:
+            _libraries[name] = __import__(name)
+        except (ImportError, OSError) as e:
+            _libraries[name] = None
+            _libraryErrors.append(e)
+    return _libraries[name]
+
+
+def hidraw_token():
+    '''Returns a cheap snapshot of the hidraw nodes, None where hidraw is not available'''
+    try:
+        names = os.listdir(HIDRAW_SYSFS_DIR)
+    except OSError:
+        return None
+    # node names get reused, the inode tells a replugged device apart
+    return tuple(sorted((name, os.lstat(os.path.join(HIDRAW_SYSFS_DIR, name)).st_ino) for name in names))
+
+
+def _backend_missing():
+    print('Please ensure that you have hidapi or hidapi-cffi installed,')
+    print('any of them are supported.')
+    print('If you are confortable with Python, it should be as simple as:')
+    print('\tpython -m pip install --user hidapi')
+    return _libraryErrors[-1] if _libraryErrors else ImportError('no HID backend available')
+
+
+class HidBackend(object):
+    '''cython hidapi backend, reports are written with a leading report id'''
+    name = 'hid'
+    usinghid = True
+
+    def __init__(self):
+        self._hid = _library('hid')
+        if self._hid is None:
+            raise _backend_missing()
+
+    def enumerate(self, vid=0, pid=0):
+        return iter(self._hid.enumerate(vid, pid))
+
+    def hotplug_token(self):
+        return hidraw_token()
+
+    def open(self, path, blocking=True):
+        devhandle = self._hid.device()
+        devhandle.open_path(path)
+        if not blocking:
+            devhandle.set_nonblocking(1)
+        return devhandle
+
+
+class HidapiBackend(object):
+    '''hidapi-cffi backend, the library prepends the report id itself'''
+    name = 'hidapi'
+    usinghid = False
+
+    def __init__(self):
+        self._hidapi = _library('hidapi')
+        if self._hidapi is None:
+            raise _backend_missing()
+
+    def enumerate(self, vid=0, pid=0):
+        for info in self._hidapi.enumerate(vid, pid):
+            # unfortunately there is no __dict__ attr in the cffi DeviceInfo object
+            yield dict([(p, getattr(info, p)) for p in info.__slots__])
+
+    def hotplug_token(self):
+        return hidraw_token()
+
+    def open(self, path, blocking=True):
+        # also blocking by default but ensure it is
+        return self._hidapi.Device(path=path, blocking=blocking)
+
+
+def _sysfs_read(directory, name, default=''):
+    try:
+        with open(os.path.join(directory, name)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+class HidrawDevice(object):
+    '''Linux hidraw node opened directly, same interface as hid.device plus fileno()
+
+    The file descriptor can be registered with select/poll, the node being
+    opened non blocking unless blocking is set.
+    '''
+
+    def __init__(self, path, info, blocking=True):
+        self._fd = os.open(path, os.O_RDWR | (0 if blocking else os.O_NONBLOCK))
+        self._info = info or {}
+
+    def fileno(self):
+        return self._fd
+
+    def write(self, buff):
+        # byte 0 is the report number, 0 for the single report devices
+        return os.write(self._fd, bytes(bytearray(buff)))
+
+    def read(self, max_length, timeout_ms=0):
+        '''Returns a list of ints, empty on timeout; like hid, a 0 timeout follows the blocking mode'''
+        if timeout_ms > 0 and not select.select([self._fd], [], [], timeout_ms / 1000.0)[0]:
+            return []
+        try:
+            return list(bytearray(os.read(self._fd, max_length)))
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise
+
+    def get_product_string(self):
+        return self._info.get('product_string', '')
+
+    def get_manufacturer_string(self):
+        return self._info.get('manufacturer_string', '')
+
+    def get_serial_number_string(self):
+        return self._info.get('serial_number', '')
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class HidrawBackend(object):
+    '''Linux hidraw backend, needs no HID library and gives selectable non blocking handles
+
+    Devices are enumerated from sysfs, reports are written with a leading report id.
+    '''
+    name = 'hidraw'
+    usinghid = True
+
+    def __init__(self):
+        if not os.path.isdir(HIDRAW_SYSFS_DIR):
+            raise ImportError('hidraw is not available on this system')
+
+    def _info(self, name):
+        hiddir = os.path.realpath(os.path.join(HIDRAW_SYSFS_DIR, name, 'device'))
+        uevent = dict(line.split('=', 1) for line in _sysfs_read(hiddir, 'uevent').splitlines() if '=' in line)
+        try:
+            bus, vid, pid = [int(field, 16) for field in uevent.get('HID_ID', '').split(':')]
+        except ValueError:
+            return None
+        # the USB device holding the descriptors sits above the interface directory
+        interface = os.path.dirname(hiddir)
+        usbdir = os.path.dirname(interface)
+        return {
+            'path': ('/dev/%s' % name).encode(),
+            'vendor_id': vid,
+            'product_id': pid,
+            'serial_number': uevent.get('HID_UNIQ') or _sysfs_read(usbdir, 'serial'),
+            'release_number': int(_sysfs_read(usbdir, 'bcdDevice', '0'), 16),
+            'manufacturer_string': _sysfs_read(usbdir, 'manufacturer'),
+            'product_string': _sysfs_read(usbdir, 'product') or uevent.get('HID_NAME', ''),
+            'usage_page': 0,
+            'usage': 0,
+            'interface_number': int(_sysfs_read(interface, 'bInterfaceNumber', '0'), 16),
+        }
+
+    def enumerate(self, vid=0, pid=0):
+        for name in sorted(os.listdir(HIDRAW_SYSFS_DIR)):
+            info = self._info(name)
+            if info and (not vid or info['vendor_id'] == vid) and (not pid or info['product_id'] == pid):
+                yield info
+
+    def hotplug_token(self):
+        return hidraw_token()
+
+    def open(self, path, blocking=True):
+        if not isinstance(path, _stringTypes):
+            path = path.decode()
+        return HidrawDevice(path, self._info(os.path.basename(path)), blocking)
+
+
+def _emulator_backend():
+    import hidemu
+    return hidemu.EmulatorBackend(hidemu.default_bus())
+
+
+def _replay_backend():
+    import hidtrace
+    return hidtrace.replay_backend()
+
+
+_backendFactories = {
+    'hid': HidBackend,
+    'hidapi': HidapiBackend,
+    'hidraw': HidrawBackend,
+    'emulator': _emulator_backend,
+    'replay': _replay_backend,
+}
+_backends = {}
+
+
+def register_backend(name, factory):
+    '''Make a backend selectable by name, factory is called once on first use'''
+    _backendFactories[name] = factory
+    _backends.pop(name, None)
+
+
+def get_backend(backend=None):
+    '''Returns the backend instance for a name, an instance or the environment/installed default
+
+    The default is the cython hid library, hidapi-cffi if hid is not installed.
+    Backends created by name are wrapped in a hidtrace.RecordingBackend when
+    the HID_TRACE environment variable names a trace file.
+    '''
+    if backend is not None and not isinstance(backend, _stringTypes):
+        return backend
+    name = backend or os.environ.get(HID_BACKEND_ENV) or ('hid' if _library('hid') is not None else 'hidapi')
+    if name not in _backends:
+        if name not in _backendFactories:
+            raise ValueError('unknown HID backend %s' % name)
+        instance = _backendFactories[name]()
+        if os.environ.get(HID_TRACE_ENV) and name != 'replay':
+            import hidtrace
+            instance = hidtrace.RecordingBackend(instance, os.environ[HID_TRACE_ENV])
+        _backends[name] = instance
+    return _backends[name]
+
+
+class DeviceRegistry(object):
+    '''Indexed view of the devices of one vendor, the bus is only rescanned on hotplug
+
+    Devices are indexed by serial number and path.  The backend hotplug
+    token (the hidraw node listing on Linux) is checked before every lookup
+    and a lookup miss forces a rescan, so plugged devices are found without
+    enumerating the bus on every call.  Backends without a token (None, as
+    off Linux or when replaying) cannot tell about hotplug, their scan is
+    trusted for ttl seconds only.  Per device values such as the
+    firmware version can be cached and optionally persisted to a JSON file.
+    The backend is resolved and the cache file read on first use.
+    '''
+
+    def __init__(self, vid, pids, backend=None, cache_path=None, ttl=1.0):
+        self._vid = vid
+        self._pids = tuple(pids)
+        self._backendspec = backend
+        self._backend = None
+        self._cache_path = cache_path
+        self.ttl = ttl
+        self._token = None
+        self._scanned = False
+        self._scannedat = 0.0
+        self._devices = []
+        self._byserial = {}
+        self._bypath = {}
+        self._cache = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_backend(self._backendspec)
+        return self._backend
+
+    def _loadcache(self):
+        if self._cache is None:
+            self._cache = {}
+            if self._cache_path and os.path.exists(self._cache_path):
+                import json
+                try:
+                    with open(self._cache_path) as f:
+                        self._cache = json.load(f)
+                except (IOError, OSError, ValueError):
+                    self._cache = {}
+        return self._cache
+
+    def refresh(self, force=False):
+        '''Rescan the bus if forced, never scanned, the hotplug token changed or, without a token, ttl expired'''
+        backend = self.backend
+        token = getattr(backend, 'hotplug_token', lambda: None)()
+        if not force and self._scanned and token == self._token and \
+                (token is not None or _clock() - self._scannedat < self.ttl):
+            return False
+        self._token = token
+        self._scanned = True
+        self._scannedat = _clock()
+        self._devices = [device for device in backend.enumerate(self._vid, 0)
+                         if device['vendor_id'] == self._vid and device['product_id'] in self._pids]
+        self._byserial = dict((device['serial_number'], device) for device in self._devices)
+        self._bypath = dict((device['path'], device) for device in self._devices)
+        return True
+
+    def devices(self):
+        '''Returns the enumeration dictionaries of the matching devices'''
+        self.refresh()
+        return list(self._devices)
+
+    def lookup(self, serial=None, path=None, pids=None):
+        '''Returns the device with the given path or serial (any device if both are None) or None'''
+        rescanned = self.refresh()
+        while True:
+            if path is not None:
+                device = self._bypath.get(path)
+            elif serial is not None:
+                device = self._byserial.get(serial)
+            else:
+                device = next((d for d in self._devices if pids is None or d['product_id'] in pids), None)
+            if device is not None and (pids is None or device['product_id'] in pids):
+                return device
+            if rescanned:
+                return None
+            # the token may not cover every hotplug event, try once more on a fresh scan
+            rescanned = self.refresh(force=True)
+
+    def _cachekey(self, device):
+        return '%s@%s' % (device['serial_number'], device['release_number'])
+
+    def cached(self, device, name):
+        '''Returns a value cached for the device or None, entries follow the device release number'''
+        return self._loadcache().get(self._cachekey(device), {}).get(name)
+
+    def store(self, device, name, value):
+        '''Cache a JSON serializable value for the device and persist the cache if a path was given'''
+        self._loadcache().setdefault(self._cachekey(device), {})[name] = value
+        if self._cache_path:
+            import json
+            try:
+                with open(self._cache_path, 'w') as f:
+                    json.dump(self._cache, f)
+            except (IOError, OSError):
+                pass
+
+
+class WaitTimeout(IOError):
+    '''The awaited device did not show up before the deadline'''
+
+
+def _udev_monitor():
+    '''Returns a started pyudev hidraw monitor, None if pyudev or netlink are not available'''
+    try:
+        import pyudev
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by('hidraw')
+        monitor.start()
+        return monitor
+    except Exception:
+        return None
+
+
+def wait_for_device(vid, pids, serial=None, timeout=10.0, backend=None, since=None, interval=0.02, rescan=0.25):
+    '''Wait until a device matching vid, pids and serial (any if None) is enumerated
+
+    Returns (device info, latency) where latency is the time elapsed since the
+    since clock value (the call itself by default), e.g. the moment a reset was
+    requested.  The bus is enumerated again when udev reports a hidraw event,
+    when the hotplug token changes (polled every interval seconds when udev is
+    not available) and every rescan seconds as a safety net, since a node may
+    appear before it can be opened.  Raises WaitTimeout after timeout seconds.
+    '''
+    backend = get_backend(backend)
+    tokenfunc = getattr(backend, 'hotplug_token', lambda: None)
+    start = _clock()
+    since = start if since is None else since
+    deadline = start + timeout
+    native = backend
+    while getattr(native, 'backend', None) is not None:
+        # wrappers (hidtrace.RecordingBackend, the fleet serialization) expose the backend they wrap
+        native = native.backend
+    monitor = _udev_monitor() if tokenfunc() is not None and isinstance(native, (HidBackend, HidapiBackend)) else None
+    lasttoken, lastscan = object(), None
+    while True:
+        now = _clock()
+        token = tokenfunc()
+        if token is None or token != lasttoken or now - lastscan >= rescan:
+            lasttoken, lastscan = token, now
+            for device in backend.enumerate(vid, 0):
+                if device['vendor_id'] == vid and device['product_id'] in pids and \
+                        (serial is None or serial == device['serial_number']):
+                    return device, _clock() - since
+        remaining = deadline - _clock()
+        if remaining <= 0:
+            raise WaitTimeout('device 0x%.4x:%s %s did not show up within %.1f s' %
+                              (vid, '/'.join('0x%.4x' % pid for pid in pids), serial or '', timeout))
+        if monitor is not None:
+            # the monitor socket is closed when garbage collected
+            monitor.poll(timeout=min(remaining, rescan))
+        else:
+            time.sleep(min(remaining, interval))
+
+
+class TransportTimeout(IOError):
+    '''The device did not answer within the transport timeout'''
+
+    def __init__(self, message, timeout=None, attempts=1):
+        IOError.__init__(self, message)
+        self.timeout = timeout
+        self.attempts = attempts
+
+
+class TransportPolicy(object):
+    '''Round trip estimator deriving read timeouts and retry delays for one device
+
+    The timeout is srtt + k * rttvar clamped to [min_timeout, max_timeout]
+    (seconds), initial_timeout is used until the first reply is measured.
+    Every timeout doubles the current timeout until a reply is measured
+    again.  Retry n waits a random delay up to backoff_base * 2 ** n, capped
+    at backoff_max.  Giving the same min and max timeout disables adaptation.
+    '''
+
+    def __init__(self, initial_timeout=1.0, min_timeout=0.02, max_timeout=1.0, retries=3,
+                 backoff_base=0.002, backoff_max=0.1, alpha=0.125, beta=0.25, k=4, seed=None):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._alpha = alpha
+        self._beta = beta
+        self._k = k
+        self._backoff = 1
+        self._random = random.Random(seed)
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self.timeouts = 0
+        self._update(initial_timeout)
+
+    def _update(self, base):
+        # the engine reads timeout_ms on every command, keep it precomputed
+        self._base = base
+        self.timeout = min(self.max_timeout, max(self.min_timeout, base) * self._backoff)
+        self.timeout_ms = max(1, int(self.timeout * 1000 + 0.5))
+
+    def sample(self, rtt):
+        '''Account a measured round trip in seconds'''
+        self.samples += 1
+        srtt = self.srtt
+        if srtt is None:
+            srtt, rttvar = rtt, rtt / 2.0
+        else:
+            delta = rtt - srtt
+            rttvar = self.rttvar
+            rttvar += self._beta * ((delta if delta > 0 else -delta) - rttvar)
+            srtt += self._alpha * delta
+        self.srtt, self.rttvar = srtt, rttvar
+        if self._backoff != 1:
+            self._backoff = 1
+        # called once per command, the clamping of _update() is inlined
+        base = srtt + self._k * rttvar
+        timeout = self.min_timeout if base < self.min_timeout else base
+        if timeout > self.max_timeout:
+            timeout = self.max_timeout
+        self._base = base
+        self.timeout = timeout
+        self.timeout_ms = int(timeout * 1000 + 0.5) or 1
+
+    def expired(self):
+        '''Account a read timeout, the next timeouts are doubled until a reply is measured'''
+        self.timeouts += 1
+        if self.timeout < self.max_timeout:
+            self._backoff *= 2
+            self._update(self._base)
+
+    def backoff(self, attempt):
+        '''Delay in seconds before the given retry (0 based), full jitter'''
+        return self._random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+def reply_buffer(reply):
+    '''Returns a reply as a buffer struct and slice assignments accept, the hid backend replies are lists'''
+    return bytearray(reply) if isinstance(reply, list) else reply
+
+
+def packet_struct(fmt, packetsize):
+    '''Returns a precompiled struct padded with zeros up to the packet size'''
+    size = struct.calcsize(fmt)
+    if size > packetsize:
+        raise ValueError('format %s does not fit in a %i bytes packet' % (fmt, packetsize))
+    return struct.Struct('%s%ix' % (fmt, packetsize - size))
+
+
+class PacketEngine(object):
+    '''Reusable send/receive buffers bound to one open HID handle
+
+    timeout (ms) is the initial read timeout of the default TransportPolicy,
+    metrics an optional hidmetrics.Metrics recording every command.  Without
+    metrics exchange() only times one command in sample_interval to feed the
+    policy, the others skip the clock reads and the in flight bookkeeping.
+    '''
+    sample_interval = 8
+
+    def __init__(self, devhandle, usinghid, packetsize, payloadsize, timeout, policy=None, metrics=None):
+        self._devhandle = devhandle
+        self._usinghid = usinghid
+        self._packetsize = packetsize
+        self._payloadsize = payloadsize
+        self.policy = policy or TransportPolicy(initial_timeout=timeout / 1000.0, max_timeout=timeout / 1000.0)
+        self.metrics = metrics
+        # reports written and commands resent so far, handy for instrumentation
+        self.packets = 0
+        self.retries = 0
+        # exchanges left before the next timed one, the first one is always timed
+        self._untimed = 0
+        # (write time, opcode) of the reports still waiting for their reply
+        self._sent = collections.deque(maxlen=256)
+        # byte 0 holds the report id, hidapi-cffi prepends its own so it only gets the report itself
+        self._sendbuf = bytearray(packetsize + 1)
+        self._sendview = memoryview(self._sendbuf)
+        self._body = self._sendview[1:]
+        self._outpacket = self._sendview if usinghid else self._body
+        self._zeros = bytearray(packetsize)
+        # the device may answer with up to one extra byte, never let the buffer grow
+        self._recvbuf = bytearray(packetsize + 1)
+        self._reply = memoryview(self._recvbuf)[:payloadsize]
+        self._errorreply = memoryview(bytearray([0xff] * payloadsize))
+        # _read(timeout_ms): the size comes first in both the hid and the hidapi-cffi read()
+        self._read = functools.partial(devhandle.read, packetsize + 1)
+
+    @property
+    def timeout(self):
+        '''Current read timeout in ms'''
+        return self.policy.timeout_ms
+
+    def load(self, st, *values):
+        '''Pack a command into the send buffer, st must come from packet_struct()'''
+        st.pack_into(self._sendbuf, 1, *values)
+
+    def load_payload(self, offset, data):
+        '''Copy data into the send buffer at the given report offset'''
+        self._sendbuf[1 + offset:1 + offset + len(data)] = data
+
+    def write(self):
+        '''Write the send buffer without waiting for the reply'''
+        self.packets += 1
+        self._sent.append((_clock(), self._sendbuf[1]))
+        self._devhandle.write(self._outpacket)
+
+    def read(self, timeout=None):
+        '''Read one reply, returns the list read as is on the hid backend, else a view on the receive buffer
+
+        Raises TransportTimeout if nothing arrives within the policy timeout, or
+        the given timeout in seconds (such a read is not used to learn the
+        round trip).  A truncated reply gives the 0xff error reply.
+        '''
+        timeout_ms = self.policy.timeout_ms if timeout is None else max(1, int(timeout * 1000 + 0.5))
+        recvpacket = self._read(timeout_ms)
+        if not recvpacket:
+            raise self._expired(timeout_ms)
+        return self._received(recvpacket, timeout is None)
+
+    def _expired(self, timeout_ms):
+        '''Account a read timeout, returns the TransportTimeout to raise'''
+        self.policy.expired()
+        if self.metrics is not None:
+            self.metrics.timeout(self._sent[0][1] if self._sent else self._sendbuf[1], self._packetsize)
+        return TransportTimeout('no reply within %i ms' % timeout_ms, timeout_ms / 1000.0)
+
+    def _received(self, recvpacket, learn):
+        size = len(recvpacket)
+        if self._sent:
+            sent, opcode = self._sent.popleft()
+            rtt = _clock() - sent
+            if learn:
+                self.policy.sample(rtt)
+            if self.metrics is not None:
+                self.metrics.command(opcode, rtt, self._packetsize, size)
+        if size < self._payloadsize:
+            return self._errorreply
+        if self._usinghid:
+            # a new list on every read, indexing it costs less than copying it into the buffer
+            return recvpacket
+        self._recvbuf[:size] = recvpacket
+        return self._reply
+
+    def fileno(self):
+        '''File descriptor becoming readable with the replies, None if the handle has none'''
+        fileno = getattr(self._devhandle, 'fileno', None)
+        return fileno() if fileno else None
+
+    def poll(self, timeout_ms=0, learn=True):
+        '''Reply view if one arrives within timeout_ms, None otherwise, without any timeout accounting
+
+        A 0 timeout returns at once on non blocking handles only, it blocks on the others.
+        With learn unset the round trip is not fed to the policy, as for slow commands.
+        '''
+        recvpacket = self._read(timeout_ms)
+        if not recvpacket:
+            return None
+        return self._received(recvpacket, learn)
+
+    @property
+    def inflight(self):
+        '''Number of written reports still waiting for their reply'''
+        return len(self._sent)
+
+    @property
+    def deadline(self):
+        '''Time the oldest unanswered report times out at, None if nothing is in flight'''
+        return self._sent[0][0] + self.policy.timeout if self._sent else None
+
+    def expire(self):
+        '''Give up on the reports in flight, accounting a timeout like read() does'''
+        self.policy.expired()
+        if self.metrics is not None and self._sent:
+            self.metrics.timeout(self._sent[0][1], self._packetsize)
+        self.flush()
+
+    def flush(self):
+        '''Discard the replies already received and forget the ones in flight, returns the discarded count'''
+        discarded = 0
+        # a 0 ms timeout would block on a blocking handle
+        while self._read(1):
+            discarded += 1
+        self._sent.clear()
+        return discarded
+
+    def exchange(self, timeout=None, retries=None):
+        '''Write the send buffer and read the reply, returns the reply as read() does
+
+        Unanswered commands are resent up to policy.retries times, or the given retries,
+        waiting the policy backoff in between; late replies are flushed before resending.
+        The devices do not number their replies: once a resent command is answered, the
+        answers to its earlier attempts are awaited and discarded, so that none of them is
+        taken for the reply to the next command.
+        '''
+        if self._untimed and self.metrics is None and not self._sent:
+            # nothing to measure nor to track, the common case kept as short as possible
+            self._untimed -= 1
+            self.packets += 1
+            self._devhandle.write(self._outpacket)
+            timeout_ms = self.policy.timeout_ms if timeout is None else max(1, int(timeout * 1000 + 0.5))
+            recvpacket = self._read(timeout_ms)
+            if recvpacket:
+                if len(recvpacket) < self._payloadsize:
+                    return self._errorreply
+                if self._usinghid:
+                    return recvpacket
+                self._recvbuf[:len(recvpacket)] = recvpacket
+                return self._reply
+            self._expired(timeout_ms)
+        else:
+            self._untimed = self.sample_interval - 1
+            self.write()
+            try:
+                return self.read(timeout)
+            except TransportTimeout:
+                pass
+        return self._resend(timeout, self.policy.retries if retries is None else retries)
+
+    def _resend(self, timeout, retries):
+        policy = self.policy
+        attempt = 0
+        while True:
+            if attempt >= retries:
+                raise TransportTimeout('no reply after %i attempts' % (attempt + 1), policy.timeout, attempt + 1)
+            time.sleep(policy.backoff(attempt))
+            self.flush()
+            attempt += 1
+            self.retries += 1
+            if self.metrics is not None:
+                self.metrics.retry(self._sendbuf[1])
+            self.write()
+            timeout_ms = policy.timeout_ms if timeout is None else max(1, int(timeout * 1000 + 0.5))
+            recvpacket = self._read(timeout_ms)
+            if recvpacket:
+                # up to attempt more answers may still come, one per earlier write
+                for _ in range(attempt):
+                    if not self._read(timeout_ms):
+                        break
+                # the attempt answered is unknown, the round trip is not learnt from
+                return self._received(recvpacket, False)
+            self._expired(timeout_ms)
+
+    def transact(self, st, *values):
+        '''Pack a command with a precompiled struct, send it and return the reply'''
+        st.pack_into(self._sendbuf, 1, *values)
+        return self.exchange()
+
+    def sendreceive(self, packetarray):
+        '''Send a list of byte values, kept for callers building packets by hand'''
+        if len(packetarray) > self._packetsize:
+            raise ValueError('packet exceeds %i bytes' % self._packetsize)
+        self._body[:] = self._zeros
+        self._sendbuf[1:1 + len(packetarray)] = packetarray
+        return self.exchange()
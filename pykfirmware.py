@@ -16,67 +16,74 @@ according to your preference:
     or
   https://pypi.python.org/pypi/hidapi-cffi
 
-For now the use of You will also need the future module to 
-
 Copyright 2016, 2013 Yepkit Lda and other contributors
 Released under the MIT license, please read the file LICENSE.txt
 
 Date: 2016-11-02
 
 Usage:
-    usage: pykfirmware.py [-h] [-s SERIAL] infile
+    usage: pykfirmware.py [-h] [-s SERIAL] [-r REPORT] [-a] [-j JOBS] [-m METRICS] [--sequential]
+                          [--verify-lag CHUNKS] [--cache CACHE] [--no-cache] [--dump DUMP] [infile]
 
     Yepkit firmware update tool **YKUSH PREVIEW VERSION**
 
     positional arguments:
-      infile                the input Intel HEX filename
+      infile                the input Intel HEX filename, optional with --dump
 
     optional arguments:
       -h, --help            show this help message and exit
       -s SERIAL, --serial SERIAL
-                            the USB device serial number string
+                            the USB device serial number string, repeat it to
+                            update several devices
+      -r REPORT, --report REPORT
+                            write the per phase timing report to this JSON file
+      -a, --all             update every device found (fleet rollout)
+      -j JOBS, --jobs JOBS  devices updated concurrently in a fleet rollout
+      -m METRICS, --metrics METRICS
+                            write the transport metrics to this Prometheus text
+                            file
+      --sequential          run parse, erase, program and verify one after the
+                            other instead of overlapping them
+      --verify-lag CHUNKS   read every chunk back once CHUNKS more chunks were
+                            programmed, it must cover the bootloader flash row
+                            (default: after programming completes)
+      --cache CACHE         parsed image cache directory (default:
+                            $YKUSH_IMAGE_CACHE or ~/.cache/pykfirmware)
+      --no-cache            always parse the HEX file, without using the cache
+      --dump DUMP           read the device flash back into this raw binary
+                            file instead of updating it, then compare it to
+                            infile if given
+
+    The update flow is also available as a library through the FirmwareUpdater class.
 
 Notes:
   * This is a work in progress that started as a collage code with several chained
     and superfluous transformations, please be warned about the code performance.
   * The code supports both Python 2 and 3
   * Works on Linux, Windows and Mac
+  * Set HID_BACKEND=emulator to flash an emulated device (see hidemu.py)
 
 """
 
 from __future__ import unicode_literals
 from __future__ import print_function
-try:
-    from future.utils import bytes_to_native_str
-except (ImportError):
-    # python -m pip install --user future
-    print('Please ensure that you have the future module installed.')
-    print('If you are confortable with Python, it should be as simple as:')
-    print('\tpython -m pip install --user future')
-    raise
 import sys
+import mmap
 import time
-import array
+import zlib
 import struct
-import binascii
-import argparse
-_usingHid = False
-try:
-    import hid
-    _usingHid = True
-except (ImportError, OSError):
-    try:
-        import hidapi
-    except (ImportError, OSError):
-        print('Please ensure that you have hidapi or hidapi-cffi installed,')
-        print('any of them are supported.')
-        print('If you are confortable with Python, it should be as simple as:')
-        print('\tpython -m pip install --user cython')
-        print('\tpython -m pip install --user hidapi')
-        raise
-
+import itertools
+import threading
+import collections
+from hidtransport import PacketEngine, TransportTimeout, WaitTimeout, packet_struct, reply_buffer, get_backend, \
+    wait_for_device
+from ykhex import IntelHexImage, IntelHexError
+from ykcache import ImageCache, default_cache_dir, digest as ykcache_digest
+from hidmetrics import Metrics, write_prometheus
 __version__ = '0.0.1'
 
+_clock = getattr(time, 'monotonic', time.time)
+
 # YKUSH device USB VID
 YKUSH_USB_VID = 0x04d8
 # YKUSH PIDs when in normal operation mode: YKUSH beta, YKUSH, YKUSH3
@@ -86,6 +93,9 @@ YKUSH_USB_PID_BL_LIST = (0xf11c, 0xf0cd)
 
 # YKUSH device USB comm declarations
 YKUSH_USB_TIMEOUT = 1000  # timeout in ms
+YKBL_ERASE_TIMEOUT = 10.0  # erasing takes far longer than any other command, timeout in s
+# fixed timeout in s of the commands writing the flash (program complete, sign), never resent
+YKBL_COMMAND_TIMEOUT = YKUSH_USB_TIMEOUT / 1000.0
 YKUSH_USB_PACKET_SIZE = 64
 YKUSH_USB_PACKET_PAYLOAD_SIZE = YKUSH_USB_PACKET_SIZE
 
@@ -103,6 +113,19 @@ YKBL_CMD_RESET_DEVICE = 0x08
 YKBL_CMD_SIGN_FLASH = 0x09  # The host PC application should send this command after the verify operation has completed successfully.  If checksums are used instead of a true verify (due to ALLOW_GET_DATA_COMMAND being commented), then the host PC application should send SIGN_FLASH command after is has verified the checksums are as exected. The firmware will then program the SIGNATURE_WORD into flash at the SIGNATURE_ADDRESS.
 YKBL_CMD_QUERY_EXTENDED_INFO = 0x0C  # Used by host PC app to get additional info about the device, beyond the basic NVM layout provided by the query device command
 
+# Precompiled bootloader packets and replies
+YKBL_OPCODE_PACKET = packet_struct('<B', YKUSH_USB_PACKET_SIZE)
+YKBL_PROGRAM_PACKET = packet_struct('<BLBBB', YKUSH_USB_PACKET_SIZE)  # command, address, size, 2 pad bytes, data
+YKBL_PROGRAM_DATA_OFFSET = 8  # the data follows the 8 bytes header
+YKBL_GET_DATA_PACKET = packet_struct('<BLB', YKUSH_USB_PACKET_SIZE)  # command, address, size
+YKBL_GET_DATA_REPLY_OFFSET = 8  # the data is returned after an 8 bytes header
+YKBL_QUERY_REPLY = struct.Struct('<4B2L')
+YKBL_CHUNK_SIZE = 56  # flash bytes carried by a program or get data packet
+YKBL_PIPELINE_WINDOW = 8  # program and get data packets in flight during a pipelined update
+YKBL_PARSE_BATCH = 64  # HEX data records parsed between two looks at the erase reply
+YKBL_VERIFY_PAGE_SIZE = 1024  # flash bytes covered by one CRC-32 when comparing the read back flash
+YKBL_MISMATCH_GAP = 16  # bytes left erased by the image that end a mismatching range
+
 
 # Not the most pythonic way to print to the terminal but we do prefer it to avoid weird future imports, flush or
 # compatibility issues
@@ -120,15 +143,9 @@ def printerr(str='', end='\n', flush=True):
 
 
 # simple hidapi and hidapi_cffi function wrapper helper
-def hid_enumerate(vid=0, pid=0):
-    '''HID enumerate wrapper function'''
-    for info in hid.enumerate(vid, pid) if _usingHid else hidapi.enumerate(vid, pid):
-        if _usingHid:
-            ret = info
-        else:
-            # unfortunately there is no __dict__ attr in the cffi DeviceInfo object
-            ret = dict([(p, getattr(info, p)) for p in info.__slots__])
-        yield ret
+def hid_enumerate(vid=0, pid=0, backend=None):
+    '''HID enumerate wrapper function, backend is a name or instance as accepted by hidtransport.get_backend'''
+    return get_backend(backend).enumerate(vid, pid)
 
 
 # device not found exception
@@ -139,31 +156,131 @@ class YKUSHNotFound(Exception):
         return 'YKUSH device not found'
 
 
+# firmware update exceptions, the phase attribute names the FirmwareUpdater phase that failed
+class FirmwareUpdateError(Exception):
+    '''Base firmware update exception'''
+
+    def __init__(self, message, phase=None):
+        Exception.__init__(self, message)
+        self.phase = phase
+
+
+class BootloaderNotFound(FirmwareUpdateError):
+    '''No device running in bootloader mode could be opened'''
+
+
+class FirmwareImageError(FirmwareUpdateError):
+    '''The Intel HEX file could not be imported'''
+
+
+class ProgramError(FirmwareUpdateError):
+    '''Too many communication errors while programming'''
+
+
+class DeviceTimeout(FirmwareUpdateError):
+    '''The device stopped answering, even after the transport retries, address is the one being read if known'''
+
+    def __init__(self, message, phase=None, address=None):
+        FirmwareUpdateError.__init__(self, message, phase)
+        self.address = address
+
+
+class VerifyError(FirmwareUpdateError):
+    '''The flash content read back differs from the image, ranges lists every (address, length) mismatch'''
+
+    def __init__(self, message, phase=None, address=None, ranges=None):
+        FirmwareUpdateError.__init__(self, message, phase)
+        self.address = address
+        self.ranges = ranges or []
+
+
+def _chained(error, cause):
+    '''Returns error with cause as its __cause__, what raise ... from does on Python 3'''
+    error.__cause__ = cause
+    return error
+
+
+def page_crcs(buffer, pagesize=YKBL_VERIFY_PAGE_SIZE):
+    '''CRC-32 of every pagesize bytes page of buffer'''
+    view = memoryview(buffer)
+    return [zlib.crc32(view[pos:pos + pagesize]) & 0xffffffff for pos in range(0, len(view), pagesize)]
+
+
+def mismatch_ranges(expected, actual, pagesize=YKBL_VERIFY_PAGE_SIZE, gap=YKBL_MISMATCH_GAP):
+    '''Returns the (offset, length) ranges where actual differs from the expected image
+
+    The pages are compared through their CRC-32, only the pages whose CRC differs are
+    compared byte by byte.  The bytes the image leaves erased (0xff or 0x3f) may read
+    back differently: they never mismatch, and less than gap of them do not split a range.
+    A matching programmed byte or a matching page ends a range.
+
+    >>> mismatch_ranges(b'\\x01\\xff\\x02\\x03\\x04', b'\\x00\\xff\\x00\\x03\\x00')
+    [(0, 3), (4, 1)]
+    >>> mismatch_ranges(b'\\x01' * 10 + b'\\xff' * 2048 + b'\\x02' * 10, b'\\x00' * 2068)
+    [(0, 10), (2058, 10)]
+    >>> mismatch_ranges(b'\\x01' + b'\\xff' * 16 + b'\\x02', b'\\x00' * 18)
+    [(0, 1), (17, 1)]
+    '''
+    expected, actual = memoryview(expected), memoryview(actual)
+    ranges = []
+    start = end = None
+    for page, (want, got) in enumerate(zip(page_crcs(expected, pagesize), page_crcs(actual, pagesize))):
+        if want == got:
+            if start is not None:
+                ranges.append((start, end - start))
+                start = None
+            continue
+        pos = page * pagesize
+        for offset, (i, j) in enumerate(zip(expected[pos:pos + pagesize], actual[pos:pos + pagesize]), pos):
+            if i == 0xff or i == 0x3f:
+                # only erased bytes since end, a programmed byte extends or ends the range
+                if start is not None and offset + 1 - end >= gap:
+                    ranges.append((start, end - start))
+                    start = None
+            elif i != j:
+                if start is None:
+                    start = offset
+                end = offset + 1
+            elif start is not None:
+                ranges.append((start, end - start))
+                start = None
+    if start is not None:
+        ranges.append((start, end - start))
+    return ranges
+
+
+def mismatch_count(expected, actual, ranges):
+    '''Count of the programmed bytes of expected that differ in actual within the (offset, length) ranges'''
+    expected, actual = memoryview(expected), memoryview(actual)
+    return sum(1 for offset, length in ranges
+               for i, j in zip(expected[offset:offset + length], actual[offset:offset + length])
+               if i != j and i != 0xff and i != 0x3f)
+
+
 # YKUSH_ex class definition
 class YKUSH_ex(object):
     '''YKUSH_ex hidapi based interface class'''
 
-    def __init__(self, serial=None, path=None):
+    def __init__(self, serial=None, path=None, backend=None, policy=None, metrics=None):
         '''Constructor, the algorithm will connect to the first YKUSH found if a path or serial number is not provided'''
         self._devhandle = None
+        self._engine = None
         self._firmware_major_version = None
         self._firmware_minor_version = None
         self._downstream_port_count = None
+        self._backend = get_backend(backend)
         if path:
             # open the provided path
-            if _usingHid:
-                # blocking by default
-                self._devhandle = hid.device()
-                self._devhandle.open_path(path)
-            else:
-                # also blocking by default but ensure it is
-                self._devhandle = hidapi.Device(path=path, blocking=True)
+            self._devhandle = self._backend.open(path)
+            self._engine = PacketEngine(self._devhandle, self._backend.usinghid, YKUSH_USB_PACKET_SIZE,
+                                        YKUSH_USB_PACKET_PAYLOAD_SIZE, YKUSH_USB_TIMEOUT, policy, metrics)
         else:
             # otherwise try to locate a device
-            for device in hid_enumerate(0, 0):
+            for device in self._backend.enumerate(0, 0):
                 if device['vendor_id'] == YKUSH_USB_VID and device['product_id'] in YKUSH_USB_PID_LIST:
                     if serial is None or serial == device['serial_number']:
-                        return self.__init__(path=device['path'])
+                        return self.__init__(path=device['path'], backend=self._backend, policy=policy,
+                                             metrics=metrics)
         if self._devhandle is None:
             raise YKUSHNotFound()
 
@@ -175,7 +292,7 @@ class YKUSH_ex(object):
     def get_firmware_version_APP_MODE_ONLY(self):
         '''Returns a tuple with YKUSH firmware version in format (major, minor)'''
         if self._firmware_major_version is None:
-            status, major, minor = self._raw_sendreceive([0xf0])[:3]
+            status, major, minor = self._command(0xf0)[:3]
             if status == YKUSH_PROTO_OK_STATUS:
                 self._firmware_major_version, self._firmware_minor_version = (major, minor)
             else:
@@ -186,189 +303,878 @@ class YKUSH_ex(object):
 
     def _raw_sendreceive(self, packetarray):
         '''Internal method, submit a command and read the response from YKUSH'''
-        # build the packet according to the report packet size
-        # note: no buffer optimization was made for the sake of simplicity
-        if _usingHid:
-            packetarray = [0x00] + packetarray + [0x00] * (YKUSH_USB_PACKET_SIZE - len(packetarray))
-            self._devhandle.write(packetarray)
-            recvpacket = self._devhandle.read(max_length=YKUSH_USB_PACKET_SIZE + 1, timeout_ms=YKUSH_USB_TIMEOUT)
-        else:
-            packetarray = packetarray + [0x00] * (YKUSH_USB_PACKET_SIZE - len(packetarray))
-            packet = struct.pack('<%dB' % YKUSH_USB_PACKET_SIZE, *packetarray)
-            self._devhandle.write(packet)
-            recvpacket = self._devhandle.read(length=YKUSH_USB_PACKET_SIZE + 1, timeout_ms=YKUSH_USB_TIMEOUT)
-        # if not None return the bytes we actually need
-        if recvpacket is None or len(recvpacket) < YKUSH_USB_PACKET_PAYLOAD_SIZE:
-            return [0xff] * YKUSH_USB_PACKET_PAYLOAD_SIZE
-        return recvpacket[:YKUSH_USB_PACKET_PAYLOAD_SIZE] if _usingHid else struct.unpack('<%iB' % YKUSH_USB_PACKET_PAYLOAD_SIZE, recvpacket[:YKUSH_USB_PACKET_PAYLOAD_SIZE])
+        return self._engine.sendreceive(packetarray)
 
+    def _command(self, opcode, timeout=None, retries=None):
+        '''Internal method, submit a single opcode command through the preallocated packet buffer
 
-def main():
-    # Parser definition
-    parser = argparse.ArgumentParser(description='Yepkit firmware update tool **YKUSH PREVIEW VERSION**')
-    parser.add_argument('infile', type=argparse.FileType('r'), help='the input Intel HEX filename')
-    parser.add_argument('-s', '--serial', default=None, help='the USB device serial number string')
-    args = parser.parse_args()
-    printout('%s\n%s' % (parser.description, 'Progress status (9 steps):'))
-    # find the device and enter bootloader mode if located
-    printout('1. Enumerating devices...', end='')
-    yk_app = None
-    for device in hid_enumerate(0, 0):
-        if device['vendor_id'] == YKUSH_USB_VID and device['product_id'] in YKUSH_USB_PID_LIST:
-            if args.serial is None or args.serial == device['serial_numnber']:
-                yk_app = YKUSH_ex(path=device['path'])
-                if yk_app.get_firmware_version_APP_MODE_ONLY()[0] >= 2:
-                    # enter bootloader mode
-                    yk_app._raw_sendreceive([0xfd])
-                    # leave the loop
-                    break
-    if yk_app:
-        printout('device located, bootloader operating more requested.')
-        # settle down a sec before enumerate again
-        time.sleep(3)
-    else:
-        printout('done.')
-    # now locate the device running in bootloader mode
-    printout('2. Opening device in bootloader mode...', end='')
-    yk_bl = None
-    yk_sn = ''
-    for device in hid_enumerate(0, 0):
-        if device['vendor_id'] == YKUSH_USB_VID and device['product_id'] in YKUSH_USB_PID_BL_LIST:
-            if args.serial is None or args.serial == device['serial_numnber']:
-                yk_bl = YKUSH_ex(path=device['path'])
-                yk_sn = device['serial_number']
-    if yk_bl is None:
-        printout('no devices located.')
-        printerr('> No YKUSH devices found in bootloader mode')
-        printerr('> Note: the tool only works on early development firmware versions (>=v2)')
-        sys.exit(1)
-    else:  # device located
-        printout('selected device serial number = %s' % yk_sn)
-        # query device bootloader settings
-        devbytesperaddress, devmemaddress, devmemlength = 0, 0, 0
-        recvpacket = yk_bl._raw_sendreceive([YKBL_CMD_QUERY_DEVICE])
-        (bogus, devpacketdatafieldsize, devbytesperaddress, devmemtype, devmemaddress, devmemlength) = \
-            struct.unpack_from('<4B2L', struct.pack('<%iB' % 16, *recvpacket[:16]))
-        printout('3. Device programmable region: 0x%x to 0x%x' % (devmemaddress, devmemaddress + devmemlength))
-        # Parse the Intel HEX file
-        printout('4. Importing .hex file...', end='')
-        hexrecinfo = struct.Struct('>BHB')  # Big-endian modifier and the formatting structs
-        hexrecsegm = struct.Struct('>H')
-        flashbuffer = [x for x in [0x3f, 0xff] * (devmemlength // 2)]
-        ln = 0  # Line number reference
-        segmaddr = 0  # Segment address reference
-        for rec in args.infile.readlines():  # For each .hex file line
-            ln += 1  # Keep the line number info in case we need to report an error
-            if rec[0] != ':':  # Minimalistic consistency checks
-                printout()
-                printerr('> Unrecognized Intel HEX format, affected line: %i' % ln)
-                sys.exit(1)
-            (rsize, raddr, rtype) = hexrecinfo.unpack(binascii.unhexlify(rec[1:9]))  # Get the record size, address and type
-            raddr += segmaddr
-            rsum = 0  # Sum the record bytes according to the proposed format
-            for i in range(1, 9 + rsize * 2, 2):
-                rsum += int(rec[i:(i + 2)], 16)
-            csum = (~rsum + 1) & 0xff  # Compute the checksum based on the two's complement and ensure the result is a byte
-            if int(rec[(9 + rsize * 2):(11 + rsize * 2)], 16) != csum:  # A few more validations before proceed
-                # Oops, checksum mismatch
-                printout()
-                printerr('> Checksum mismatch, affected line: %i' % ln)
-                return 1
-            elif rsize % devbytesperaddress:
-                # Unaligned records
-                printout()
-                printerr('> Expecting a multiple of %i byte(s) record, affected line: %i' % ln)
-                return 1
-            if rtype in (0x02, 0x04):
-                # Segment or linear addresses
-                segmaddr = hexrecsegm.unpack(binascii.unhexlify(rec[9:13]))[0]
-                if rtype == 0x02:
-                    segmaddr <<= 4
+        timeout overrides the learnt transport timeout (seconds) for slow commands, retries
+        the transport resend count for the commands that must not run twice.
+        '''
+        self._engine.load(YKBL_OPCODE_PACKET, opcode)
+        return self._engine.exchange(timeout, retries)
+
+    def _program(self, address, size, data):
+        '''Internal method, submit a bootloader program packet with the data copied in place'''
+        self._engine.load(YKBL_PROGRAM_PACKET, YKBL_CMD_PROGRAM_DEVICE, address, size, 0, 0)
+        self._engine.load_payload(YKBL_PROGRAM_DATA_OFFSET, data)
+        return self._engine.exchange()
+
+    def _send(self, opcode):
+        '''Internal method, submit a single opcode command without waiting for a reply'''
+        self._engine.load(YKBL_OPCODE_PACKET, opcode)
+        self._engine.write()
+
+    def read_flash(self, address, chunks, buffer, window=YKBL_PIPELINE_WINDOW, phase='verify'):
+        '''Read the (offset, size) chunks of the flash at address into buffer, at the same offsets
+
+        Up to window get data requests are in flight and the replies are copied straight into
+        buffer, a bytearray or a writable mmap.  A reply for another address, a late answer to
+        a request sent again, is dropped.  On an error or a missing reply the requests in flight
+        are sent again after the policy backoff, giving up after policy.retries attempts in a row
+        with a DeviceTimeout, or a VerifyError on write errors, for the given phase and the
+        address being read.
+        '''
+        engine = self._engine
+        pending, inflight = collections.deque(chunks), collections.deque()
+        failures = 0
+        while pending or inflight:
+            try:
+                while pending and len(inflight) < window:
+                    pos, size = pending[0]
+                    engine.load(YKBL_GET_DATA_PACKET, YKBL_CMD_GET_DATA, address + pos, size)
+                    engine.write()
+                    inflight.append(pending.popleft())
+                reply = reply_buffer(engine.read())
+            except (IOError, OSError) as e:
+                if failures >= engine.policy.retries:
+                    failed = address + (inflight or pending)[0][0]
+                    if isinstance(e, TransportTimeout):
+                        raise DeviceTimeout('The device did not answer reading the address: 0x%x (%s)' % (failed, e),
+                                            phase, failed)
+                    raise VerifyError('Got an error reading the device at address: 0x%x (%s)' % (failed, e),
+                                      phase, failed)
+                time.sleep(engine.policy.backoff(failures))
+                failures += 1
+                engine.flush()
+                engine.retries += 1
+                if engine.metrics is not None:
+                    engine.metrics.retry(YKBL_CMD_GET_DATA)
+                inflight.extend(pending)
+                inflight, pending = collections.deque(), inflight
+                continue
+            pos, size = inflight[0]
+            if YKBL_GET_DATA_PACKET.unpack_from(reply)[1] != address + pos:
+                continue
+            inflight.popleft()
+            failures = 0
+            buffer[pos:pos + size] = reply[YKBL_GET_DATA_REPLY_OFFSET:YKBL_GET_DATA_REPLY_OFFSET + size]
+
+
+class PhaseReport(object):
+    '''Measurements of one firmware update phase'''
+
+    def __init__(self, name, total=1):
+        self.name = name
+        self.total = total
+        self.duration = 0.0
+        self.packets = 0
+        self.retries = 0
+        self.bytes = 0
+        # device re-enumeration latency, for the phases waiting for the device to come back
+        self.latency = None
+        # time shared with the previous phases, for the overlapped stages of a pipelined update
+        self.overlap = 0.0
+
+    @property
+    def rate(self):
+        '''Bytes per second'''
+        return self.bytes / self.duration if self.duration else 0.0
+
+    def as_dict(self):
+        return {'phase': self.name, 'duration': self.duration, 'packets': self.packets,
+                'retries': self.retries, 'bytes': self.bytes, 'bytes_per_second': self.rate,
+                'latency': self.latency, 'overlap': self.overlap}
+
+
+def _overlap(span, spans):
+    '''Seconds of the (start, end) span covered by the union of the other spans'''
+    covered, reach = 0.0, span[0]
+    for start, end in sorted(spans):
+        start, end = max(start, reach), min(end, span[1])
+        if end > start:
+            covered += end - start
+            reach = end
+    return covered
+
+
+class FirmwareImageSet(object):
+    '''HEX records read once and parsed once per device memory layout
+
+    The images are shared read-only between the updaters of a fleet rollout.
+    With an ykcache.ImageCache they are taken from the cache when present.
+    '''
+
+    def __init__(self, infile, cache=None):
+        self._lines = infile.readlines()
+        self._cache = cache
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def get(self, address, length, bytesperaddress):
+        key = (address, length, bytesperaddress)
+        with self._lock:
+            if key not in self._images:
+                if self._cache is not None:
+                    self._images[key] = self._cache.load(self._lines, address, length, bytesperaddress,
+                                                         YKBL_CHUNK_SIZE)
                 else:
-                    segmaddr <<= 16
-            elif rtype == 0:
-                # Data type record
-                devaddr = raddr
-                # Get the payload
-                # print(rec[9:(9 + rsize * 2)])
-                rpayload = array.array(bytes_to_native_str(b'B'), binascii.unhexlify(rec[9:(9 + rsize * 2)]))
-                # print(rpayload)
-                mstart, mend = int(devaddr - devmemaddress), int(devaddr + len(rpayload) - devmemaddress)
-                # print(rpayload)
-                # print(mstart, mend)
-                # Fill the buffer if between boundaries
-                if 0 <= mstart < devmemaddress + devmemlength:
-                    if mend > devmemaddress + devmemlength:
-                        mend = devmemaddress + devmemlength
-                    flashbuffer[mstart:mend] = rpayload[:mend - mstart]
-        printout('done.')
-
-        # Erase device
-        printout('5. Erasing device before programming...', end='')
-        yk_bl._raw_sendreceive([YKBL_CMD_ERASE_DEVICE])
-        printout('done.')
-
-        # Program device
-        printout('6. Programming device, please wait..', end='')
-        cosmeticprogress = 0
-        writeerror = 0
-        offset = devmemaddress
-        for chunk in (flashbuffer[pos:pos + 56] for pos in
-                      range(0, len(flashbuffer), 56)):
-            if cosmeticprogress % 3 == 0:
-                printout('.', end='')
-            sendpacket = struct.pack('<BLBBB%iB' % len(chunk), YKBL_CMD_PROGRAM_DEVICE, offset,
-                                     len(chunk) * devbytesperaddress, 0, 0, *chunk)
-            for retry in range(3, -1, -1):
+                    self._images[key] = IntelHexImage(address, length, bytesperaddress,
+                                                      chunksize=YKBL_CHUNK_SIZE).load(self._lines)
+            return self._images[key]
+
+
+class FirmwareUpdater(object):
+    '''Firmware update flow split in phases, each one a method that can be run on its own
+
+    progress(phase, done, total) is called with done=0 when a phase starts, with the
+    chunk counts during program, and with done=total once the phase ends.
+    Every phase appends a PhaseReport to the report list.
+
+    With pipeline set (the default) run() replaces the parse, erase, program and verify
+    phases by the overlapped flash phase, which reports the four stages with the time
+    each one shared with the previous ones.  The flash phase notifies the count of
+    program packets answered so far, total being None until it ends.  With an ykcache.ImageCache
+    a HEX file already parsed for the device memory layout is not parsed again.
+
+    verify_lag is the count of chunks the pipelined flash programs before reading a
+    chunk back.  The bootloader buffers the data of the flash row being written and only
+    writes it once the row is left or on PROGRAM_COMPLETE, so the lag must cover a row:
+    row bytes // YKBL_CHUNK_SIZE + 1 chunks at least.  The QUERY reply does not tell the
+    row size, by default (None) every chunk is read back after PROGRAM_COMPLETE.
+
+    Verification reads the programmed chunks back and compares whole pages through
+    their CRC-32, a VerifyError lists every mismatching range.  run(DUMP_PHASES) only
+    reads the whole programmable region back, into dump_path if set.
+    '''
+    PHASES = ('enumerate', 'enter_bootloader', 'query', 'parse', 'erase', 'program', 'verify', 'sign', 'reset')
+    PIPELINE_PHASES = ('enumerate', 'enter_bootloader', 'query', 'flash', 'sign', 'reset')
+    DUMP_PHASES = ('enumerate', 'enter_bootloader', 'query', 'dump', 'reset')
+    # exception raised by run() for a communication error in a phase, FirmwareUpdateError for the others
+    PHASE_ERRORS = {'enter_bootloader': BootloaderNotFound, 'parse': FirmwareImageError, 'query': ProgramError,
+                    'erase': ProgramError, 'program': ProgramError, 'flash': ProgramError, 'sign': ProgramError,
+                    'verify': VerifyError, 'dump': VerifyError}
+    MAX_PROGRAM_ERRORS = 20
+
+    def __init__(self, infile, serial=None, backend=None, progress=None, reenumerate_timeout=10.0, wait_reset=True,
+                 images=None, metrics=None, pipeline=True, window=YKBL_PIPELINE_WINDOW, cache=None, dump_path=None,
+                 verify_lag=None):
+        self.infile = infile
+        self.dump_path = dump_path
+        # the flash read back by the dump phase, when not written to dump_path
+        self.dump_buffer = None
+        self.cache = cache
+        # whether the image came from the cache, None without a cache
+        self.cache_hit = None
+        self.pipeline = pipeline
+        self.window = window
+        self.verify_lag = verify_lag
+        self.images = images
+        self.metrics = metrics
+        self.serial = serial
+        self.reenumerate_timeout = reenumerate_timeout
+        self.wait_reset = wait_reset
+        self.backend = get_backend(backend)
+        self.progress = progress
+        self.report = []
+        self.app = None
+        self.bootloader = None
+        self.device_serial = None
+        self.image = None
+        self.chunks = []
+        self.bytesperaddress, self.memaddress, self.memlength = 0, 0, 0
+
+    def run(self, phases=None):
+        '''Run the given phases (by default all the update ones) in order, returns the report
+
+        Transport errors are raised as the FirmwareUpdateError of the phase (see PHASE_ERRORS),
+        a DeviceTimeout for a missing reply, the original error being the __cause__.
+        '''
+        for phase in phases or (self.PIPELINE_PHASES if self.pipeline else self.PHASES):
+            try:
+                getattr(self, phase)()
+            except TransportTimeout as e:
+                raise _chained(DeviceTimeout('The device did not answer, %s' % e, phase), e)
+            except (IOError, OSError) as e:
+                error = self.PHASE_ERRORS.get(phase, FirmwareUpdateError)
+                raise _chained(error('Communication error, %s' % e, phase), e)
+        return self.report
+
+    def report_dict(self):
+        '''The structured report, ready for JSON serialization'''
+        report = {'serial': self.device_serial, 'phases': [phase.as_dict() for phase in self.report],
+                  'duration': sum(phase.duration - phase.overlap for phase in self.report)}
+        if self.cache_hit is not None:
+            report['cache_hit'] = self.cache_hit
+        if self.metrics is not None:
+            report['metrics'] = self.metrics.snapshot()
+        return report
+
+    def _packets(self):
+        return sum(dev._engine.packets for dev in (self.app, self.bootloader) if dev is not None)
+
+    def _retries(self):
+        return sum(dev._engine.retries for dev in (self.app, self.bootloader) if dev is not None)
+
+    def _notify(self, phase, done, total):
+        if self.progress:
+            self.progress(phase, done, total)
+
+    def _begin(self, name, total=1):
+        phase = PhaseReport(name, total)
+        self.report.append(phase)
+        self._notify(name, 0, total)
+        # the counters are turned into per phase deltas by _end
+        phase.duration = _clock()
+        phase.packets = self._packets()
+        phase.retries = -self._retries()
+        return phase
+
+    def _end(self, phase):
+        phase.duration = _clock() - phase.duration
+        phase.packets = self._packets() - phase.packets
+        phase.retries += self._retries()
+        self._notify(phase.name, phase.total, phase.total)
+
+    def _matches(self, device, pids):
+        return device['vendor_id'] == YKUSH_USB_VID and device['product_id'] in pids and \
+            (self.serial is None or self.serial == device['serial_number'])
+
+    def enumerate(self):
+        '''Locate the device running its application, if any'''
+        phase = self._begin('enumerate')
+        for device in self.backend.enumerate(YKUSH_USB_VID, 0):
+            if self._matches(device, YKUSH_USB_PID_LIST):
+                self.app = YKUSH_ex(path=device['path'], backend=self.backend, metrics=self.metrics)
+                self.device_serial = device['serial_number']
+                if self.app.get_firmware_version_APP_MODE_ONLY()[0] >= 2:
+                    break
+                self.app = None
+        self._end(phase)
+
+    def enter_bootloader(self):
+        '''Request bootloader mode from the located application, then open the bootloader device'''
+        phase = self._begin('enter_bootloader')
+        timeout, requested = 0, None
+        if self.app:
+            requested = _clock()
+            # the application drops off the bus to reboot, its reply is not awaited
+            self.app._send(0xfd)
+            timeout = self.reenumerate_timeout
+        try:
+            device, latency = wait_for_device(YKUSH_USB_VID, YKUSH_USB_PID_BL_LIST, self.device_serial or self.serial,
+                                              timeout, self.backend, since=requested)
+        except WaitTimeout:
+            raise BootloaderNotFound('No YKUSH devices found in bootloader mode', 'enter_bootloader')
+        if timeout:
+            phase.latency = latency
+        self.bootloader = YKUSH_ex(path=device['path'], backend=self.backend, metrics=self.metrics)
+        self.device_serial = device['serial_number']
+        self._end(phase)
+
+    def query(self):
+        '''Query the programmable region layout'''
+        phase = self._begin('query')
+        recvpacket = self.bootloader._command(YKBL_CMD_QUERY_DEVICE)
+        (bogus, devpacketdatafieldsize, self.bytesperaddress, devmemtype, self.memaddress, self.memlength) = \
+            YKBL_QUERY_REPLY.unpack_from(reply_buffer(recvpacket))
+        self._end(phase)
+
+    def parse(self):
+        '''Import the Intel HEX file into a flash image'''
+        phase = self._begin('parse')
+        try:
+            if self.images is not None:
+                self.image = self.images.get(self.memaddress, self.memlength, self.bytesperaddress)
+            elif self.cache is not None:
+                hits = self.cache.hits
+                self.image = self.cache.load(self.infile.readlines(), self.memaddress, self.memlength,
+                                             self.bytesperaddress, YKBL_CHUNK_SIZE)
+                self.cache_hit = self.cache.hits > hits
+            else:
+                self.image = IntelHexImage(self.memaddress, self.memlength, self.bytesperaddress,
+                                           chunksize=YKBL_CHUNK_SIZE).load(self.infile)
+        except IntelHexError as e:
+            raise FirmwareImageError(str(e), 'parse')
+        # only the chunks holding image data are programmed and verified, the rest stays erased
+        self.chunks = self.image.populated_chunks()
+        phase.bytes = self.image.data_bytes
+        self._end(phase)
+
+    def erase(self):
+        phase = self._begin('erase')
+        self.bootloader._command(YKBL_CMD_ERASE_DEVICE, YKBL_ERASE_TIMEOUT)
+        self._end(phase)
+
+    def program(self):
+        '''Program the populated chunks, retrying on communication errors
+
+        Unanswered packets are resent by the transport, write errors are retried here with the
+        same backoff.  The update is aborted once MAX_PROGRAM_ERRORS retries were needed overall.
+        '''
+        phase = self._begin('program', len(self.chunks))
+        flashview = memoryview(self.image.buffer)
+        engine = self.bootloader._engine
+        errors = -engine.retries
+        for n, (pos, size) in enumerate(self.chunks):
+            offset = self.memaddress + pos
+            for attempt in range(4):
                 try:
-                    recvpacket = yk_bl._raw_sendreceive(list(struct.unpack('<%iB' % len(sendpacket), sendpacket)))
+                    self.bootloader._program(offset, size * self.bytesperaddress, flashview[pos:pos + size])
                     break
                 except (IOError, OSError) as e:
-                    time.sleep(.1)
-                    writeerror += 1
-                    if writeerror > 20:
-                        print('too many errors:', writeerror)
-                        # sys.exit(1)
-                    if not retry:
-                        printout()
-                        printerr('> Got an error trying to program the device at address: 0x%x' % offset)
-                        if e.message is not None and e.message != '':
-                            printerr('> Error message: %s' % e.message)
-                        # sys.exit(1)
-            offset += 56
-            cosmeticprogress += 1
-
+                    errors += 1
+                    if isinstance(e, TransportTimeout) or attempt == 3 or \
+                            errors + engine.retries > self.MAX_PROGRAM_ERRORS:
+                        raise ProgramError('Got an error trying to program the device at address: 0x%x (%s)' %
+                                           (offset, e), 'program')
+                    phase.retries += 1
+                    time.sleep(engine.policy.backoff(attempt))
+            if errors + engine.retries > self.MAX_PROGRAM_ERRORS:
+                raise ProgramError('Too many communication errors, stopped at address: 0x%x' % offset, 'program')
+            phase.bytes += size
+            if n + 1 < phase.total:
+                self._notify('program', n + 1, phase.total)
         # Finish signalling program complete
-        yk_bl._raw_sendreceive([YKBL_CMD_PROGRAM_COMPLETE])
-        printout('done.')
-
-        # Verify the written flash
-        printout('7. Verifying the written data...', end='')
-        offset = devmemaddress
-        for chunk in (flashbuffer[pos:pos + 56] for pos in range(0, len(flashbuffer), 56)):
-            sendpacket = struct.pack('<BLB', YKBL_CMD_GET_DATA, offset, len(chunk))
-            recvpacket = yk_bl._raw_sendreceive(list(struct.unpack('<%iB' % len(sendpacket), sendpacket)))
-            recvunpacked = struct.unpack_from('<BHBBBBB%iB' % 56, struct.pack('<%iB' % len(recvpacket), *recvpacket))
-            for i, j in zip(chunk, recvunpacked[7:]):
-                if i != j and i != 0xff and i != 0x3f:
-                    printout()
-                    printerr('> Data inconsistency detected at the offset: 0x%x.' % offset)
-                    sys.exit(1)
-            offset += 56
-        printout('done.')
-
-        # Sign flash
-        printout('8. Signing image...', end='')
-        yk_bl._raw_sendreceive([YKBL_CMD_SIGN_FLASH])
-        printout('done.')
-
-        # Finally reboot the device to start the user application
-        printout('9. Resetting device...', end='')
+        self.bootloader._command(YKBL_CMD_PROGRAM_COMPLETE, YKBL_COMMAND_TIMEOUT, 0)
+        self._end(phase)
+
+    def verify(self):
+        '''Read the programmed chunks back and compare them to the image'''
+        phase = self._begin('verify', len(self.chunks))
+        readback = bytearray(self.memlength)
+        self.bootloader.read_flash(self.memaddress, self.chunks, readback, self.window)
+        phase.bytes = sum(size for pos, size in self.chunks)
+        self._end(phase)
+        self._compare(readback)
+
+    def _compare(self, readback):
+        '''Raise a VerifyError listing the mismatching ranges, only the chunks in self.chunks were read back'''
+        image = self.image.buffer
+        end = 0
+        # the blank chunks were not read, take them from the image
+        for pos, size in self.chunks + [(self.memlength, 0)]:
+            if pos > end:
+                readback[end:pos] = image[end:pos]
+            end = pos + size
+        offsets = mismatch_ranges(image, readback)
+        if offsets:
+            ranges = [(self.memaddress + pos, size) for pos, size in offsets]
+            raise VerifyError('Data inconsistency detected at the offset: 0x%x (%i mismatching ranges, %i bytes).' %
+                              (ranges[0][0], len(ranges), mismatch_count(image, readback, offsets)),
+                              'verify', ranges[0][0], ranges)
+
+    def dump(self):
+        '''Read the whole programmable region back, streamed into the dump_path file or else into dump_buffer'''
+        phase = self._begin('dump', 1)
+        chunks = [(pos, min(YKBL_CHUNK_SIZE, self.memlength - pos))
+                  for pos in range(0, self.memlength, YKBL_CHUNK_SIZE)]
+        if self.dump_path is None:
+            self.dump_buffer = bytearray(self.memlength)
+            self.bootloader.read_flash(self.memaddress, chunks, self.dump_buffer, self.window, 'dump')
+        else:
+            with open(self.dump_path, 'w+b') as f:
+                f.truncate(self.memlength)
+                mapped = mmap.mmap(f.fileno(), self.memlength)
+                try:
+                    self.bootloader.read_flash(self.memaddress, chunks, mapped, self.window, 'dump')
+                    mapped.flush()
+                finally:
+                    mapped.close()
+        phase.bytes = self.memlength
+        self._end(phase)
+
+    def flash(self):
+        '''Parse, erase, program and verify as overlapping stages of one phase
+
+        The erase command goes first and the device erases while the HEX file is parsed.
+        The chunks the parser moved past are then programmed with up to window packets in
+        flight, every chunk being read back verify_lag chunks later or after PROGRAM_COMPLETE,
+        the read back flash is compared to the image once everything was read.  A packet whose
+        write failed is written again after the backoff.  Program replies do not tell which
+        packet they answer, so on a missing reply the other packets in flight are sent again
+        but for the program ones: their chunks are confirmed by the read back, a chunk reading
+        back differently is programmed, completed and read again on its own.  Every packet gets
+        policy.retries retries, MAX_PROGRAM_ERRORS overall.  Should the file go back to chunks
+        already programmed, the flash is erased and rewritten by the sequential phases.  The stages are reported, and notified, once the phase completes.
+        '''
+        self._notify('flash', 0, None)
+        engine = self.bootloader._engine
+        stages = [PhaseReport(name) for name in ('parse', 'erase', 'program', 'verify')]
+        parse, erase, program, verify = stages
+        spans = dict((stage.name, [None, None]) for stage in stages)
+        spans['erase'][0] = _clock()
+        engine.load(YKBL_OPCODE_PACKET, YKBL_CMD_ERASE_DEVICE)
+        engine.write()
+        spans['parse'][0] = _clock()
+        counts = self._parse(spans['parse'])
+        settled, erased = 0, None
+        for settled in counts:
+            erased = engine.poll(1, learn=False)
+            if erased is not None:
+                break
+        if erased is None:
+            remaining = spans['erase'][0] + YKBL_ERASE_TIMEOUT - _clock()
+            erased = engine.poll(max(1, int(remaining * 1000)), learn=False)
+        erase.packets = 1
+        if erased is None:
+            # lost on the way, the transport resends it the usual way
+            engine.flush()
+            erase.packets += 1
+            erase.retries += 1
+            self.bootloader._command(YKBL_CMD_ERASE_DEVICE, YKBL_ERASE_TIMEOUT)
+        spans['erase'][1] = _clock()
+
+        flashview = memoryview(self.image.buffer)
+        readback = bytearray(self.memlength)
+        memaddress = self.memaddress
+        packets = self._flash_packets(itertools.chain((settled,), counts))
+        inflight, resend = collections.deque(), collections.deque()
+        # failed attempts of every packet, each has its own retries as in the sequential phases
+        failures = collections.defaultdict(int)
+        while True:
+            while len(inflight) < self.window:
+                packet = resend.popleft() if resend else next(packets, None)
+                if packet is None:
+                    break
+                try:
+                    self._flash_write(packet, flashview, spans)
+                except (IOError, OSError) as e:
+                    # not sent, only this packet is written again
+                    stage = verify if packet[0] == YKBL_CMD_GET_DATA else program
+                    time.sleep(engine.policy.backoff(self._flash_retry(packet, failures, stage, e)))
+                    resend.appendleft(packet)
+                    continue
+                inflight.append(packet)
+            if not inflight:
+                break
+            command, pos, size = packet = inflight.popleft()
+            try:
+                # program complete writes the last row, not a round trip to learn from
+                timeout = YKBL_COMMAND_TIMEOUT if command == YKBL_CMD_PROGRAM_COMPLETE else None
+                reply = reply_buffer(engine.read(timeout))
+                # the reply echoes the address, a late reply to a packet sent again is not the expected one
+                if command == YKBL_CMD_GET_DATA and YKBL_GET_DATA_PACKET.unpack_from(reply)[1] != memaddress + pos:
+                    raise IOError('unexpected get data reply')
+            except (IOError, OSError) as e:
+                stage = verify if command == YKBL_CMD_GET_DATA else program
+                time.sleep(engine.policy.backoff(self._flash_retry(packet, failures, stage, e)))
+                # a missing reply shifts the later ones: the late replies are dropped and the packets
+                # in flight sent again, but for the program packets which the read back confirms
+                while engine.inflight and engine.poll(engine.timeout, learn=False) is not None:
+                    pass
+                engine.flush()
+                inflight.appendleft(packet)
+                resend.extendleft(reversed([pending for pending in inflight if pending[0] != YKBL_CMD_PROGRAM_DEVICE]))
+                inflight.clear()
+                continue
+            if command == YKBL_CMD_GET_DATA:
+                readback[pos:pos + size] = reply[YKBL_GET_DATA_REPLY_OFFSET:YKBL_GET_DATA_REPLY_OFFSET + size]
+                verify.packets += 1
+                verify.bytes += size
+                spans['verify'][1] = _clock()
+                packet = (YKBL_CMD_PROGRAM_DEVICE, pos, size)
+                if readback[pos:pos + size] != flashview[pos:pos + size] and failures[packet] < engine.policy.retries:
+                    # lost or not written out of the row buffer, this chunk alone is programmed again,
+                    # once out of retries the mismatch is reported by the comparison
+                    self._flash_retry(packet, failures, program, 'read back differs')
+                    resend.extend((packet, (YKBL_CMD_PROGRAM_COMPLETE, 0, 0), (YKBL_CMD_GET_DATA, pos, size)))
+            else:
+                program.packets += 1
+                if command == YKBL_CMD_PROGRAM_DEVICE:
+                    program.bytes += size
+                    self._notify('flash', program.packets, None)
+                else:
+                    spans['program'][1] = _clock()
+
+        parse.bytes = self.image.data_bytes
+        program.total = verify.total = len(self.chunks)
+        self._notify('flash', program.total, program.total)
+        earlier = []
+        for stage in stages:
+            span = spans[stage.name]
+            if span[0] is not None:
+                stage.duration = span[1] - span[0]
+                stage.overlap = _overlap(span, earlier)
+                earlier.append(span)
+            self.report.append(stage)
+            self._notify(stage.name, 0, stage.total)
+            self._notify(stage.name, stage.total, stage.total)
+        if self.image.reordered:
+            # the file went back to chunks already programmed, start over from the complete image
+            self.erase()
+            self.program()
+            self.verify()
+        else:
+            self._compare(readback)
+
+    def _parse(self, span):
+        '''Parse the Intel HEX file, yields the settled chunk counts as IntelHexImage.iter_load does'''
+        layout = (self.memaddress, self.memlength, self.bytesperaddress, YKBL_CHUNK_SIZE)
+        key, lines = None, self.infile
         try:
-            yk_bl._raw_sendreceive([YKBL_CMD_RESET_DEVICE])
+            if self.images is not None:
+                self.image = self.images.get(*layout[:3])
+            elif self.cache is not None:
+                lines = self.infile.readlines()
+                key = self.cache.key(ykcache_digest(lines), *layout)
+                self.image = self.cache.get(key, *layout)
+                self.cache_hit = self.image is not None
+            if self.image is not None:
+                counts = (len(self.image.chunkmap),)
+            else:
+                self.image = IntelHexImage(self.memaddress, self.memlength, self.bytesperaddress,
+                                           chunksize=YKBL_CHUNK_SIZE)
+                counts = self.image.iter_load(lines, YKBL_PARSE_BATCH)
+            for settled in counts:
+                yield settled
+        except IntelHexError as e:
+            raise FirmwareImageError(str(e), 'parse')
+        if key is not None and not self.cache_hit:
+            self.cache.put(key, self.image)
+        span[1] = _clock()
+        self.chunks = self.image.populated_chunks()
+
+    def _flash_packets(self, counts):
+        '''Yields the (command, offset, size) packets of the program and verify stages in wire order'''
+        chunkmap, chunksize, length = self.image.chunkmap, self.image.chunksize, self.image.length
+        lag = self.verify_lag
+        programmed = collections.deque()
+        done = 0
+        for settled in counts:
+            for chunk in range(done, settled):
+                if chunkmap[chunk]:
+                    pos = chunk * chunksize
+                    size = min(chunksize, length - pos)
+                    yield YKBL_CMD_PROGRAM_DEVICE, pos, size
+                    programmed.append((pos, size))
+                    if lag is not None and len(programmed) > lag:
+                        pos, size = programmed.popleft()
+                        yield YKBL_CMD_GET_DATA, pos, size
+            done = max(done, settled)
+        yield YKBL_CMD_PROGRAM_COMPLETE, 0, 0
+        for pos, size in programmed:
+            yield YKBL_CMD_GET_DATA, pos, size
+
+    def _flash_retry(self, packet, failures, stage, error):
+        '''Account a failed attempt at a flash packet, returns the attempt number for the backoff
+
+        Raises ProgramError once the packet ran out of retries or MAX_PROGRAM_ERRORS were needed.
+        '''
+        engine = self.bootloader._engine
+        command, pos, size = packet
+        attempt = failures[packet]
+        if attempt >= engine.policy.retries or sum(failures.values()) >= self.MAX_PROGRAM_ERRORS:
+            raise ProgramError('Too many communication errors, stopped at address: 0x%x (%s)' %
+                               (self.memaddress + pos, error), stage.name)
+        failures[packet] = attempt + 1
+        stage.retries += 1
+        engine.retries += 1
+        if engine.metrics is not None:
+            engine.metrics.retry(command)
+        return attempt
+
+    def _flash_write(self, packet, flashview, spans):
+        command, pos, size = packet
+        engine = self.bootloader._engine
+        if command == YKBL_CMD_GET_DATA:
+            engine.load(YKBL_GET_DATA_PACKET, command, self.memaddress + pos, size)
+            span = spans['verify']
+        else:
+            if command == YKBL_CMD_PROGRAM_DEVICE:
+                engine.load(YKBL_PROGRAM_PACKET, command, self.memaddress + pos, size * self.bytesperaddress, 0, 0)
+                engine.load_payload(YKBL_PROGRAM_DATA_OFFSET, flashview[pos:pos + size])
+            else:
+                engine.load(YKBL_OPCODE_PACKET, command)
+            span = spans['program']
+        if span[0] is None:
+            span[0] = _clock()
+        engine.write()
+
+    def sign(self):
+        phase = self._begin('sign')
+        self.bootloader._command(YKBL_CMD_SIGN_FLASH, YKBL_COMMAND_TIMEOUT, 0)
+        self._end(phase)
+
+    def reset(self):
+        '''Reboot the device into the new application, no reply is expected'''
+        phase = self._begin('reset')
+        requested = _clock()
+        try:
+            self.bootloader._send(YKBL_CMD_RESET_DEVICE)
         except (IOError, OSError):
             pass
-        printout('done.')
+        if self.wait_reset:
+            # not an error, the update is complete even if the application is slow to come up
+            try:
+                phase.latency = wait_for_device(YKUSH_USB_VID, YKUSH_USB_PID_LIST, self.device_serial,
+                                                self.reenumerate_timeout, self.backend, since=requested)[1]
+            except WaitTimeout:
+                pass
+        self._end(phase)
+
+
+class _SerializedBackend(object):
+    '''Backend wrapper serializing enumerate and open, hidapi does not guarantee their thread safety'''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.usinghid = backend.usinghid
+
+    def hotplug_token(self):
+        return getattr(self.backend, 'hotplug_token', lambda: None)()
+
+    def enumerate(self, vid=0, pid=0):
+        with self._lock:
+            return list(self.backend.enumerate(vid, pid))
+
+    def open(self, path):
+        with self._lock:
+            return self.backend.open(path)
+
+
+class FleetRollout(object):
+    '''Flash many devices concurrently, each one handled by its own FirmwareUpdater matched by serial
+
+    The HEX file is parsed once, or taken from the ykcache.ImageCache cache if given, and shared;
+    at most jobs devices are updated at the same time.
+    on_done(serial, result) is called as every device completes, result being the summary
+    dictionary also returned by run().  With metrics enabled every device gets its own
+    hidmetrics.Metrics labelled with its serial, collected in the metrics list.
+    '''
+
+    def __init__(self, infile, serials=None, jobs=4, backend=None, on_done=None, metrics=False, cache=None, **kwargs):
+        self.images = FirmwareImageSet(infile, cache)
+        self.serials = serials
+        self.jobs = jobs
+        self.backend = _SerializedBackend(get_backend(backend))
+        self.on_done = on_done
+        self.kwargs = kwargs
+        self.results = []
+        self.metrics = [] if metrics else None
+
+    def discover(self):
+        '''Returns the serial numbers of every device found, in application or bootloader mode'''
+        serials = []
+        for device in self.backend.enumerate(YKUSH_USB_VID, 0):
+            if device['product_id'] in YKUSH_USB_PID_LIST + YKUSH_USB_PID_BL_LIST and \
+                    device['serial_number'] not in serials:
+                serials.append(device['serial_number'])
+        return serials
+
+    def _update(self, serial):
+        metrics = None
+        if self.metrics is not None:
+            metrics = Metrics({'serial': serial})
+            self.metrics.append(metrics)
+        updater = FirmwareUpdater(None, serial=serial, backend=self.backend, images=self.images, metrics=metrics,
+                                  **self.kwargs)
+        start = _clock()
+        result = {'serial': serial, 'success': True, 'error': None}
+        try:
+            updater.run()
+        except (FirmwareUpdateError, IOError, OSError) as e:
+            result.update(success=False, error=str(e))
+        result['duration'] = _clock() - start
+        result['report'] = updater.report_dict()
+        if self.on_done:
+            self.on_done(serial, result)
+        return result
+
+    def run(self):
+        '''Update every device, returns the per device summaries in serial order'''
+        from concurrent.futures import ThreadPoolExecutor
+        serials = self.serials or self.discover()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.jobs, len(serials) or 1))) as executor:
+            self.results = list(executor.map(self._update, serials))
+        return self.results
+
+
+def _cache(args):
+    return None if args.no_cache else ImageCache(args.cache or default_cache_dir())
+
+
+def fleet_main(args):
+    '''Command line fleet rollout, prints one line per device and a summary'''
+    import json
+    lock = threading.Lock()
+
+    def on_done(serial, result):
+        with lock:
+            printout('  %-20s %-7s %8.3f s  %s' % (serial, 'ok' if result['success'] else 'FAILED',
+                                                  result['duration'], result['error'] or ''))
+
+    start = _clock()
+    rollout = FleetRollout(args.infile, serials=args.serial, jobs=args.jobs, on_done=on_done,
+                           metrics=bool(args.metrics), pipeline=not args.sequential, cache=_cache(args),
+                           verify_lag=args.verify_lag)
+    results = rollout.run()
+    elapsed = _clock() - start
+    failed = [result for result in results if not result['success']]
+    printout('%i devices updated, %i failed, %.3f s total, %.2f devices/minute' %
+             (len(results) - len(failed), len(failed), elapsed, len(results) * 60 / elapsed if elapsed else 0))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'duration': elapsed, 'devices': results}, f, indent=2)
+    if args.metrics:
+        write_prometheus(args.metrics, rollout.metrics)
+    return 1 if failed or not results else 0
+
+
+def _print_ranges(e, limit=16):
+    for address, size in getattr(e, 'ranges', [])[:limit]:
+        printerr('>   0x%x to 0x%x, %i bytes' % (address, address + size, size))
+    if len(getattr(e, 'ranges', [])) > limit:
+        printerr('>   ... %i more ranges' % (len(e.ranges) - limit))
+
+
+def dump_main(args):
+    '''Command line flash readback into a raw binary file, compared to the HEX file if given'''
+    titles = {
+        'enumerate': '1. Enumerating devices...',
+        'enter_bootloader': '2. Opening device in bootloader mode...',
+        'query': '3. Querying device programmable region...',
+        'dump': '4. Reading the flash back...',
+        'reset': '5. Resetting device...',
+        'parse': '6. Importing .hex file...',
+    }
+
+    def progress(phase, done, total):
+        if done == 0:
+            printout(titles[phase], end='')
+        elif done == total:
+            printout('done.')
+
+    updater = FirmwareUpdater(args.infile, serial=args.serial and args.serial[0], progress=progress,
+                              cache=_cache(args), dump_path=args.dump)
+    try:
+        updater.run(updater.DUMP_PHASES + (('parse',) if args.infile else ()))
+    except FirmwareUpdateError as e:
+        printout()
+        printerr('> %s' % e)
+        return 1
+    dump = updater.report[updater.DUMP_PHASES.index('dump')]
+    printout('  0x%x to 0x%x written to %s in %.3f s, %.0f B/s' %
+             (updater.memaddress, updater.memaddress + updater.memlength, args.dump, dump.duration, dump.rate))
+    if not args.infile:
+        return 0
+    with open(args.dump, 'rb') as f:
+        flash = f.read()
+    ranges = mismatch_ranges(updater.image.buffer, flash)
+    if not ranges:
+        printout('  the flash matches %s' % args.infile.name)
+        return 0
+    printerr('> the flash differs from %s at %i ranges, %i bytes:' %
+             (args.infile.name, len(ranges), mismatch_count(updater.image.buffer, flash, ranges)))
+    _print_ranges(VerifyError('', ranges=[(updater.memaddress + pos, size) for pos, size in ranges]))
+    return 1
+
+
+def main():
+    import json
+    import argparse
+
+    # Parser definition
+    parser = argparse.ArgumentParser(description='Yepkit firmware update tool **YKUSH PREVIEW VERSION**')
+    parser.add_argument('infile', type=argparse.FileType('rb'), nargs='?',
+                        help='the input Intel HEX filename, optional with --dump')
+    parser.add_argument('-s', '--serial', default=None, action='append',
+                        help='the USB device serial number string, repeat it to update several devices')
+    parser.add_argument('-r', '--report', default=None, help='write the per phase timing report to this JSON file')
+    parser.add_argument('-a', '--all', action='store_true', help='update every device found (fleet rollout)')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='devices updated concurrently in a fleet rollout')
+    parser.add_argument('-m', '--metrics', default=None, help='write the transport metrics to this Prometheus text file')
+    parser.add_argument('--sequential', action='store_true',
+                        help='run parse, erase, program and verify one after the other instead of overlapping them')
+    parser.add_argument('--verify-lag', type=int, default=None, metavar='CHUNKS',
+                        help='read every chunk back once CHUNKS more chunks were programmed, it must cover the '
+                        'bootloader flash row (default: after programming completes)')
+    parser.add_argument('--cache', default=None,
+                        help='parsed image cache directory (default: $YKUSH_IMAGE_CACHE or ~/.cache/pykfirmware)')
+    parser.add_argument('--no-cache', action='store_true', help='always parse the HEX file, without using the cache')
+    parser.add_argument('--dump', default=None, help='read the device flash back into this raw binary file instead '
+                        'of updating it, then compare it to infile if given')
+    args = parser.parse_args()
+    if args.dump:
+        printout('%s\n%s' % (parser.description, 'Flash readback:'))
+        sys.exit(dump_main(args))
+    if args.infile is None:
+        parser.error('the infile argument is required')
+    if args.all or (args.serial and len(args.serial) > 1):
+        printout('%s\n%s' % (parser.description, 'Fleet rollout, up to %i devices at a time:' % args.jobs))
+        sys.exit(fleet_main(args))
+    printout('%s\n%s' % (parser.description, 'Progress status (9 steps):'))
+
+    titles = {
+        'enumerate': '1. Enumerating devices...',
+        'enter_bootloader': '2. Opening device in bootloader mode...',
+        'query': '3. Querying device programmable region...',
+        'flash': '4-7. Importing, erasing, programming and verifying at once, please wait..',
+        'parse': '4. Importing .hex file...',
+        'erase': '5. Erasing device before programming...',
+        'program': '6. Programming device, please wait..',
+        'verify': '7. Verifying the written data...',
+        'sign': '8. Signing image...',
+        'reset': '9. Resetting device...',
+    }
+
+    def progress(phase, done, total):
+        if done == 0:
+            printout(titles[phase], end='')
+        elif done == total:
+            if phase == 'enumerate' and updater.app:
+                printout('device located, bootloader operating more requested.')
+            elif phase == 'enter_bootloader':
+                printout('selected device serial number = %s' % updater.device_serial)
+            elif phase == 'query':
+                printout('0x%x to 0x%x' % (updater.memaddress, updater.memaddress + updater.memlength))
+            elif phase == 'parse' and updater.cache_hit:
+                printout('done, cached image.')
+            elif phase in ('program', 'verify'):
+                skipped = len(updater.image.chunkmap) - len(updater.chunks)
+                printout('done, %i packets sent, %i blank packets skipped.' % (len(updater.chunks), skipped))
+            else:
+                printout('done.')
+        elif phase in ('program', 'flash') and done % 3 == 0:
+            printout('.', end='')
+
+    metrics = Metrics() if args.metrics else None
+    updater = FirmwareUpdater(args.infile, serial=args.serial and args.serial[0], progress=progress, metrics=metrics,
+                              pipeline=not args.sequential, cache=_cache(args), verify_lag=args.verify_lag)
+    try:
+        updater.run()
+    except FirmwareUpdateError as e:
+        printout()
+        printerr('> %s' % e)
+        _print_ranges(e)
+        if isinstance(e, BootloaderNotFound):
+            printerr('> Note: the tool only works on early development firmware versions (>=v2)')
+        sys.exit(1)
+    finally:
+        # the metrics of a failed update are the most interesting ones
+        if metrics is not None:
+            metrics.labels['serial'] = updater.device_serial or args.serial and args.serial[0] or ''
+            write_prometheus(args.metrics, [metrics])
+    for phase in updater.report:
+        printout('  %-16s %8.3f s %6i packets %4i retries %10.0f B/s%s%s' %
+                 (phase.name, phase.duration, phase.packets, phase.retries, phase.rate,
+                  '' if phase.latency is None else '  re-enumerated in %.3f s' % phase.latency,
+                  '  overlapped %.3f s' % phase.overlap if phase.overlap else ''))
+    printout('  %-16s %8.3f s' % ('total', updater.report_dict()['duration']))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(updater.report_dict(), f, indent=2)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,163 @@
+# coding: utf-8
+"""
+Drift free LED animation engine for the NavVis XMas_Tree
+
+A Timeline is a declarative list of frames (LED1 state, LED2 state, duration
+in seconds), optionally preceded by an intro played once.  The Animator
+schedules every frame against absolute time.monotonic() deadlines, so USB
+latency never accumulates: the measured command latency (EWMA) is used to
+send each frame early enough to land on its deadline, and frames whose slot
+has already passed are dropped, their LED states coalesced into the next
+frame that is shown.
+
+    XT = XMas_Tree.XMas_Tree()
+    stats = Animator(XT).play(blink_timeline(), cycles=3)
+    print(stats)
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import math
+import time
+import collections
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# A frame state of None leaves the LED unchanged
+Frame = collections.namedtuple('Frame', 'led1 led2 duration')
+
+
+class Timeline(object):
+    '''Frames played in order, the intro once and the body once per cycle'''
+
+    def __init__(self, frames, intro=()):
+        self.frames = list(frames)
+        self.intro = list(intro)
+
+    @property
+    def cycle_duration(self):
+        return sum(frame.duration for frame in self.frames)
+
+
+def blink_timeline():
+    '''The blink.py pattern, the LEDs alternate with a duty cycle sweeping around 0.3 s'''
+    intro = [Frame(True, False, 1.0), Frame(False, True, 1.0)]
+    frames = []
+    for i in range(10):
+        frames.append(Frame(True, False, 0.3 + 0.01 * i))
+        frames.append(Frame(False, True, 0.3 - 0.01 * i))
+    return Timeline(frames, intro)
+
+
+class AnimationStats(object):
+    '''Achieved frame rate and lateness of the shown frames, kept in constant memory'''
+
+    def __init__(self):
+        self.frames = 0
+        self.dropped = 0
+        self.elapsed = 0.0
+        self.max_lateness = 0.0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, lateness):
+        # Welford running mean and variance
+        self.frames += 1
+        delta = lateness - self._mean
+        self._mean += delta / self.frames
+        self._m2 += delta * (lateness - self._mean)
+        self.max_lateness = max(self.max_lateness, lateness)
+
+    @property
+    def frame_rate(self):
+        return self.frames / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mean_lateness(self):
+        return self._mean
+
+    @property
+    def jitter(self):
+        '''Standard deviation of the frame lateness in seconds'''
+        return math.sqrt(self._m2 / self.frames) if self.frames else 0.0
+
+    def __str__(self):
+        return ('%i frames (%i dropped) in %.3f s, %.2f fps, lateness mean %.2f ms max %.2f ms, jitter %.2f ms' %
+                (self.frames, self.dropped, self.elapsed, self.frame_rate,
+                 self._mean * 1000, self.max_lateness * 1000, self.jitter * 1000))
+
+
+class Animator(object):
+    '''Plays timelines on a XMas_Tree against monotonic deadlines'''
+
+    def __init__(self, xmastree, latency_gain=0.125, clock=_clock, sleep=time.sleep):
+        self._xmastree = xmastree
+        self._gain = latency_gain
+        self._clock = clock
+        self._sleep = sleep
+        self._state = [None, None]
+        # estimated time between sending a frame and the device applying it
+        self.latency = 0.0
+
+    def _show(self, led1, led2):
+        opcodes = []
+        if led1 is not None and led1 != self._state[0]:
+            opcodes.append(0x40 if led1 else 0x41)
+        if led2 is not None and led2 != self._state[1]:
+            opcodes.append(0x50 if led2 else 0x51)
+        if opcodes:
+            self._send(opcodes)
+
+    def _send(self, opcodes):
+        '''Send LED opcodes, update the latency estimate and the confirmed LED states'''
+        before = self._clock()
+        results = self._xmastree.send_many(opcodes)
+        self.latency += self._gain * (self._clock() - before - self.latency)
+        for opcode, ok in zip(opcodes, results):
+            # an unconfirmed state is sent again on the next frame
+            self._state[0 if opcode < 0x50 else 1] = (not opcode & 0x01) if ok else None
+
+    def play(self, timeline, cycles=1, on_cycle=None):
+        '''Play the intro then the frames for the given cycles (forever if None), returns AnimationStats
+
+        on_cycle(cycle, stats) is called after every completed cycle.
+        '''
+        stats = AnimationStats()
+        start = self._clock()
+        deadline = start
+        pending = [None, None]
+        cycle = 0
+        frames = timeline.intro
+        while True:
+            for frame in frames:
+                slot, deadline = deadline, deadline + frame.duration
+                if frame.led1 is not None:
+                    pending[0] = frame.led1
+                if frame.led2 is not None:
+                    pending[1] = frame.led2
+                wait = slot - self.latency - self._clock()
+                if wait > 0:
+                    self._sleep(wait)
+                elif self._clock() + self.latency >= deadline:
+                    # the slot is already over, coalesce this frame into the next one
+                    stats.dropped += 1
+                    continue
+                self._show(pending[0], pending[1])
+                stats.add(self._clock() - slot)
+            if frames is not timeline.intro:
+                cycle += 1
+                stats.elapsed = self._clock() - start
+                if on_cycle:
+                    on_cycle(cycle, stats)
+                if cycles is not None and cycle >= cycles:
+                    break
+            frames = timeline.frames
+            if not frames:
+                break
+        # hold the last frame for its whole duration
+        wait = deadline - self._clock()
+        if wait > 0:
+            self._sleep(wait)
+        stats.elapsed = self._clock() - start
+        return stats
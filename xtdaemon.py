@@ -0,0 +1,230 @@
+# coding: utf-8
+"""
+Long lived XMas_Tree daemon serving a line protocol on a Unix domain socket
+
+The daemon keeps every tree open with its shadow LED state, so a client
+command costs one socket round trip instead of a bus enumeration, a device
+open and a firmware version query.  Requests and replies are single text
+lines:
+
+    <serial> <command> [argument ...]     serial is - for the first tree
+    ok [value ...]  or  err <message>
+
+Commands:
+    ping                          ok
+    list                          ok <serial> ...
+    version                       ok <major>.<minor>
+    led1_on led1_off led2_on led2_off
+                                  ok 1|0 (command status)
+    height                        ok <height>
+    send <opcode> ...             ok <result> ... (hexadecimal opcodes, XMas_Tree.send_many)
+    resync                        ok
+
+Start it with "python XMas_Tree.py --daemon", XMas_Tree.py then talks to
+it whenever its socket answers and opens the devices itself otherwise.
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import errno
+import signal
+import socket
+import threading
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+import XMas_Tree
+
+# environment variable overriding the socket path
+XMas_Tree_SOCKET_ENV = 'XMAS_TREE_SOCKET'
+
+_LED_COMMANDS = ('led1_on', 'led1_off', 'led2_on', 'led2_off')
+
+
+def default_socket_path():
+    '''XMAS_TREE_SOCKET, else xmastree.sock in the runtime directory, else a per user /tmp path'''
+    path = os.environ.get(XMas_Tree_SOCKET_ENV)
+    if path:
+        return path
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'xmastree.sock')
+    return '/tmp/xmastree-%s.sock' % (os.getuid() if hasattr(os, 'getuid') else 'user')
+
+
+class DaemonError(Exception):
+    '''The daemon answered a request with an error'''
+
+
+class DeviceNotFound(DaemonError):
+    '''The daemon found no XMas_Tree with the requested serial'''
+
+
+class XMas_TreeService(object):
+    '''Executes protocol requests on lazily opened, shared XMas_Tree instances'''
+
+    def __init__(self, backend=None, shadow=True):
+        self._registry = XMas_Tree.device_registry(backend)
+        self._shadow = shadow
+        self._trees = {}
+        self._lock = threading.Lock()
+
+    def _tree(self, serial):
+        '''Returns (XMas_Tree, lock) of a serial, - being the first tree found'''
+        with self._lock:
+            if serial == '-':
+                device = self._registry.lookup(pids=XMas_Tree.XMas_Tree_USB_PID_LIST)
+                if device is None:
+                    raise XMas_Tree.XMas_TreeNotFound()
+                serial = device['serial_number']
+            if serial not in self._trees:
+                tree = XMas_Tree.XMas_Tree(serial=serial, registry=self._registry, shadow=self._shadow)
+                self._trees[serial] = (tree, threading.Lock())
+            return self._trees[serial]
+
+    def _forget(self, tree):
+        with self._lock:
+            for serial, (known, lock) in list(self._trees.items()):
+                if known is tree:
+                    del self._trees[serial]
+
+    def execute(self, serial, command, args):
+        '''Run one request, returns the reply values as a list of strings'''
+        if command == 'ping':
+            return []
+        if command == 'list':
+            return [device['serial_number'] for device in self._registry.devices()
+                    if device['product_id'] in XMas_Tree.XMas_Tree_USB_PID_LIST]
+        tree, lock = self._tree(serial)
+        with lock:
+            try:
+                return self._call(tree, command, args)
+            except (IOError, OSError):
+                # unplugged or reset, the next request reopens the device
+                self._forget(tree)
+                raise
+
+    def _call(self, tree, command, args):
+        if command in _LED_COMMANDS:
+            return ['%i' % getattr(tree, command)()]
+        if command == 'height':
+            return ['%i' % tree.get_height()]
+        if command == 'version':
+            return ['%i.%i' % tree.get_firmware_version()]
+        if command == 'send':
+            opcodes = [int(arg, 16) for arg in args]
+            for opcode in opcodes:
+                if opcode not in XMas_Tree._REPLY_DECODERS:
+                    raise ValueError('unsupported opcode 0x%.2x' % opcode)
+            results = tree.send_many(opcodes)
+            return ['-' if result is None else '%i.%i' % result if isinstance(result, tuple) else '%i' % result
+                    for result in results]
+        if command == 'resync':
+            tree.resync()
+            return []
+        raise ValueError('unknown command %s' % command)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        service = self.server.service
+        for line in self.rfile:
+            words = line.decode('utf-8', 'replace').split()
+            if not words:
+                continue
+            if len(words) < 2:
+                reply = 'err malformed request'
+            else:
+                try:
+                    reply = ' '.join(['ok'] + service.execute(words[0], words[1], words[2:]))
+                except Exception as e:
+                    reply = 'err %s' % str(e).replace('\n', ' ')
+            self.wfile.write((reply + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class XMas_TreeServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Threaded Unix socket server, one thread per client connection'''
+
+    daemon_threads = True
+
+    def __init__(self, path=None, backend=None, shadow=True):
+        self.path = path or default_socket_path()
+        if os.path.exists(self.path):
+            client = connect(self.path)
+            if client is not None:
+                client.close()
+                raise IOError('a daemon is already listening on %s' % self.path)
+            # left over by a daemon that did not exit cleanly
+            os.unlink(self.path)
+        self.service = XMas_TreeService(backend, shadow)
+        socketserver.UnixStreamServer.__init__(self, self.path, _Handler)
+        os.chmod(self.path, 0o600)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class XMas_TreeClient(object):
+    '''Connection to a running daemon, requests are answered in order'''
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._file = sock.makefile('rb')
+
+    def call(self, serial, command, *args):
+        '''Send one request, returns the reply values as a list of strings or raises DaemonError
+
+        DeviceNotFound, a DaemonError, is raised when the serial is not on the bus.
+        '''
+        self._sock.sendall((' '.join([serial or '-', command] + list(args)) + '\n').encode('utf-8'))
+        reply = self._file.readline().decode('utf-8').split(' ', 1)
+        if not reply[0]:
+            raise IOError('the daemon closed the connection')
+        if reply[0].strip() != 'ok':
+            message = reply[1].strip() if len(reply) > 1 else 'unknown error'
+            if message == str(XMas_Tree.XMas_TreeNotFound()):
+                raise DeviceNotFound(message)
+            raise DaemonError(message)
+        return reply[1].split() if len(reply) > 1 else []
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+def connect(path=None):
+    '''Returns a XMas_TreeClient, None when no daemon listens on the socket'''
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or default_socket_path())
+    except (IOError, OSError) as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.ENOTSOCK):
+            return None
+        raise
+    return XMas_TreeClient(sock)
+
+
+def serve(path=None, backend=None, shadow=True):
+    '''Run the daemon until interrupted or terminated'''
+    server = XMas_TreeServer(path, backend, shadow)
+    # unwind through the finally clause below so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,212 @@
+# coding: utf-8
+"""
+Single threaded I/O multiplexer driving many XMas_Tree devices
+
+The trees are opened non blocking (blocking=False) and registered with a
+DeviceMux.  Commands submitted for a device are queued, written up to a
+window ahead of their replies, and one selector waits on every device
+handle at once, so a single thread keeps all the trees busy:
+
+    trees = [XMas_Tree.XMas_Tree(path=device['path'], blocking=False) for device in ...]
+    mux = DeviceMux()
+    requests = [mux.submit(tree, [0x40, 0x60]) for tree in trees]
+    mux.run()
+    print([request.results for request in requests])
+
+Handles exposing a fileno() (hidraw and emulator backends) are waited on
+with select/poll, the others are polled every poll_interval seconds.
+Commands go straight to the device: the shadow LED state of a tree is
+forgotten (resync) whenever one of its requests completes.
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import time
+import select
+import collections
+try:
+    import selectors
+except ImportError:
+    selectors = None
+import XMas_Tree
+from hidtransport import TransportTimeout, packet_struct
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_OPCODE_PACKET = packet_struct('<B', XMas_Tree.XMas_Tree_USB_PACKET_SIZE)
+
+
+class MuxRequest(object):
+    '''Commands submitted for one device, results are appended in order as the replies arrive'''
+
+    def __init__(self, xmastree, opcodes, callback=None):
+        self.xmastree = xmastree
+        self.opcodes = list(opcodes)
+        self.results = []
+        self.error = None
+        self.callback = callback
+
+    @property
+    def done(self):
+        return self.error is not None or len(self.results) == len(self.opcodes)
+
+
+class _Device(object):
+    '''(request, index) queues of the commands to write and of the commands in flight of one tree'''
+
+    def __init__(self, xmastree, window):
+        self.xmastree = xmastree
+        self.engine = xmastree.engine
+        self.window = window
+        self.queue = collections.deque()
+        self.inflight = collections.deque()
+
+
+class DeviceMux(object):
+    '''Multiplexes the commands of many non blocking XMas_Tree instances on one thread'''
+
+    def __init__(self, window=XMas_Tree.XMas_Tree_BATCH_WINDOW, poll_interval=0.0005):
+        self._window = window
+        self._poll_interval = poll_interval
+        self._devices = {}
+        self._byfd = {}
+        self._polled = []
+        self._selector = selectors.DefaultSelector() if selectors else None
+        self.pending = 0
+
+    def add(self, xmastree, window=None):
+        '''Register a tree opened with blocking=False'''
+        if xmastree in self._devices:
+            return
+        device = self._devices[xmastree] = _Device(xmastree, window or self._window)
+        fd = xmastree.fileno()
+        if fd is None:
+            self._polled.append(device)
+        else:
+            self._byfd[fd] = device
+            if self._selector:
+                self._selector.register(fd, selectors.EVENT_READ, device)
+
+    def remove(self, xmastree):
+        '''Unregister a tree, its unfinished requests fail'''
+        device = self._devices.pop(xmastree)
+        self._fail(device, IOError('device removed from the multiplexer'))
+        if device in self._polled:
+            self._polled.remove(device)
+        else:
+            fd = next(fd for fd, known in self._byfd.items() if known is device)
+            del self._byfd[fd]
+            if self._selector:
+                self._selector.unregister(fd)
+
+    def submit(self, xmastree, opcodes, callback=None):
+        '''Queue single opcode commands for a tree, returns a MuxRequest
+
+        callback(request) is called by run() once every reply arrived or the request failed.
+        '''
+        self.add(xmastree)
+        request = MuxRequest(xmastree, opcodes, callback)
+        device = self._devices[xmastree]
+        for index in range(len(request.opcodes)):
+            device.queue.append((request, index))
+        self.pending += 1
+        if not request.opcodes:
+            self._complete(request)
+        return request
+
+    def _complete(self, request):
+        self.pending -= 1
+        request.xmastree.resync()
+        if request.callback:
+            request.callback(request)
+
+    def _fail(self, device, error):
+        failed = []
+        for request, index in list(device.inflight) + list(device.queue):
+            if request.error is None and not request.done:
+                request.error = error
+                failed.append(request)
+        device.inflight.clear()
+        device.queue.clear()
+        for request in failed:
+            self._complete(request)
+
+    def _fill(self, device):
+        engine = device.engine
+        while device.queue and len(device.inflight) < device.window:
+            request, index = device.queue[0]
+            engine.load(_OPCODE_PACKET, request.opcodes[index])
+            try:
+                engine.write()
+            except (IOError, OSError) as e:
+                engine.flush()
+                self._fail(device, e)
+                return
+            device.inflight.append(device.queue.popleft())
+
+    def _drain(self, device):
+        engine = device.engine
+        while device.inflight:
+            reply = engine.poll()
+            if reply is None:
+                return
+            request, index = device.inflight.popleft()
+            request.results.append(XMas_Tree.decode_reply(request.opcodes[index], reply))
+            if request.done:
+                self._complete(request)
+
+    def _expire(self, now):
+        '''Fail the requests of the devices whose oldest command timed out, returns the next deadline'''
+        nearest = None
+        for device in self._devices.values():
+            deadline = device.engine.deadline
+            if deadline is None or not device.inflight:
+                continue
+            if deadline <= now:
+                device.engine.expire()
+                self._fail(device, TransportTimeout('no reply within %i ms' % device.engine.timeout,
+                                                    device.engine.policy.timeout))
+            elif nearest is None or deadline < nearest:
+                nearest = deadline
+        return nearest
+
+    def _wait(self, timeout):
+        if self._selector:
+            return [key.data for key, events in self._selector.select(timeout)]
+        if not self._byfd:
+            return []
+        return [self._byfd[fd] for fd in select.select(list(self._byfd), [], [], timeout)[0]]
+
+    def run_once(self, timeout=None):
+        '''Write what the windows allow, wait up to timeout seconds for replies and process them'''
+        for device in self._devices.values():
+            if device.queue:
+                self._fill(device)
+        nearest = self._expire(_clock())
+        wait = timeout
+        if nearest is not None:
+            wait = max(0.0, nearest - _clock()) if wait is None else min(wait, max(0.0, nearest - _clock()))
+        if self._polled and any(device.inflight for device in self._polled):
+            wait = self._poll_interval if wait is None else min(wait, self._poll_interval)
+        if not any(device.inflight for device in self._devices.values()):
+            wait = 0.0
+        for device in self._wait(wait) + self._polled:
+            self._drain(device)
+
+    def run(self, timeout=None):
+        '''Process requests until none is pending, or for at most timeout seconds
+
+        Returns True once everything completed.
+        '''
+        end = None if timeout is None else _clock() + timeout
+        while self.pending:
+            remaining = None if end is None else end - _clock()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.run_once(remaining)
+        return True
+
+    def close(self):
+        if self._selector:
+            self._selector.close()
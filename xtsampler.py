@@ -0,0 +1,157 @@
+# coding: utf-8
+"""
+Streaming height sampler for the NavVis XMas_Tree
+
+HeightSampler polls the height sensor (opcode 0x60) at a target rate, or as
+fast as the device answers when no rate is given, and stores every sample
+in a fixed capacity RingBuffer backed by two array.array objects.  Memory
+stays constant however long the sampling runs and windowed statistics are
+computed straight from the arrays:
+
+    sampler = HeightSampler(XMas_Tree.XMas_Tree(), capacity=100000)
+    sampler.run(rate=500, duration=3600)
+    print(sampler.buffer.stats(seconds=60))
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import math
+import time
+from array import array
+from hidtransport import TransportTimeout
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# Height decoded from a truncated reply
+HEIGHT_INVALID = 0xffff
+
+
+class RingBuffer(object):
+    '''Fixed capacity (timestamp, value) storage, the oldest samples are overwritten'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._times = array(str('d'), [0.0]) * capacity
+        self._values = array(str('H'), [0]) * capacity
+        self._next = 0
+        # number of samples ever appended
+        self.total = 0
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def append(self, timestamp, value):
+        i = self._next
+        self._times[i] = timestamp
+        self._values[i] = value
+        self._next = i + 1 if i + 1 < self.capacity else 0
+        self.total += 1
+
+    def _index(self, n):
+        '''Physical index of the n-th oldest stored sample'''
+        return (self._next - len(self) + n) % self.capacity
+
+    def _window_start(self, seconds, count, now):
+        size = len(self)
+        start = 0 if count is None else max(0, size - count)
+        if seconds is not None:
+            # timestamps are monotonic, binary search the first sample inside the window
+            limit = (self._times[self._index(size - 1)] if now is None else now) - seconds
+            lo, hi = start, size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._times[self._index(mid)] < limit:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            start = lo
+        return start, size
+
+    def window(self, seconds=None, count=None, now=None):
+        '''Returns (timestamps, values) arrays of the last count samples and/or the last seconds'''
+        start, size = self._window_start(seconds, count, now)
+        if start == size:
+            return array(str('d')), array(str('H'))
+        first, last = self._index(start), self._index(size - 1) + 1
+        if first < last:
+            return self._times[first:last], self._values[first:last]
+        return self._times[first:] + self._times[:last], self._values[first:] + self._values[:last]
+
+    def stats(self, seconds=None, count=None, now=None, percentiles=(50, 90, 99)):
+        '''Returns count, min, max, mean and the requested percentiles (nearest rank) of a window'''
+        values = self.window(seconds, count, now)[1]
+        result = {'count': len(values)}
+        if not values:
+            return result
+        result['min'] = min(values)
+        result['max'] = max(values)
+        result['mean'] = float(sum(values)) / len(values)
+        if percentiles:
+            ordered = sorted(values)
+            for p in percentiles:
+                # nearest rank: the smallest value with at least p percent of the window at or below it
+                result['p%s' % p] = ordered[max(0, int(math.ceil(p * len(ordered) / 100.0)) - 1)]
+        return result
+
+
+class HeightSampler(object):
+    '''Polls a XMas_Tree height sensor into a RingBuffer'''
+
+    def __init__(self, xmastree, capacity=65536, depth=8, clock=_clock, sleep=time.sleep):
+        self._xmastree = xmastree
+        self.buffer = RingBuffer(capacity)
+        self.errors = 0
+        self._burst = [0x60] * depth
+        self._clock = clock
+        self._sleep = sleep
+
+    def samples(self, rate=None, duration=None, count=None):
+        '''Generator sampling at rate Hz (device maximum if None), yields (timestamp, value)
+
+        Every sample is also appended to the ring buffer, unanswered requests are only
+        counted in errors.  Stops after duration seconds and/or count samples, runs forever
+        otherwise.
+        '''
+        clock = self._clock
+        start = clock()
+        end = start + duration if duration is not None else None
+        taken = 0
+        while (end is None or clock() < end) and (count is None or taken < count):
+            if rate is None:
+                # keep several requests in flight and spread the timestamps over the burst
+                before = clock()
+                values = self._xmastree.send_many(self._burst)
+                after = clock()
+                step = (after - before) / len(values)
+                timestamps = (before + step * (n + 1) for n in range(len(values)))
+            else:
+                deadline = start + taken / float(rate)
+                wait = deadline - clock()
+                if wait > 0:
+                    self._sleep(wait)
+                try:
+                    values = (self._xmastree.get_height(),)
+                except TransportTimeout:
+                    self.errors += 1
+                    continue
+                timestamps = (clock(),)
+            for timestamp, value in zip(timestamps, values):
+                if value is None or value == HEIGHT_INVALID:
+                    self.errors += 1
+                    continue
+                self.buffer.append(timestamp, value)
+                taken += 1
+                yield timestamp, value
+                if taken == count:
+                    # the rest of a burst is dropped
+                    return
+
+    def run(self, rate=None, duration=None, count=None, callback=None):
+        '''Sample like samples() calling callback(timestamp, value) for each, returns the sample count'''
+        taken = 0
+        for timestamp, value in self.samples(rate, duration, count):
+            if callback:
+                callback(timestamp, value)
+            taken += 1
+        return taken
@@ -0,0 +1,184 @@
+# coding: utf-8
+"""
+Script mode of the XMas_Tree command line tool
+
+Runs a stream of commands read from a file or the standard input in a
+single process: the trees are opened on first use and stay open, and
+every command gives one JSON object written on its own line (newline
+delimited JSON) as soon as the command completes.  Script lines are:
+
+    [serial] command [argument ...]
+
+Without a serial the default tree is used, the -s one or else the first
+tree found.  Blank lines and # comments are skipped.
+
+Commands:
+    led1 on|off, led2 on|off      result: the command status, 1 on success
+    height                        result: the tree height
+    firmware                      result: "major.minor"
+    list                          result: the serial numbers of the trees
+    send <opcode> ...             result: one value per hexadecimal opcode
+    resync                        forget the shadow LED state, the next led1 and led2 commands are always sent
+    sleep <duration>              pause, the duration in s, ms or us (s when no unit is given)
+
+The xtdaemon command names (led1_on, version, ...) are accepted as well.
+Every output object holds the line number, the serial (null for the
+default tree), the command and either ok true, the result and the seconds
+taken, or ok false and the error:
+
+    {"command": "led1 on", "line": 1, "ok": true, "result": 1, "seconds": 0.0004, "serial": null}
+    {"command": "frobnicate", "error": "unknown command frobnicate", "line": 2, "ok": false, "serial": null}
+
+A failed command does not stop the script, the exit status tells whether
+any did.  When a daemon answers on its socket the commands go through it,
+unless --direct is given (see xtdaemon.py).
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import sys
+import json
+import time
+import xtdaemon
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_DURATION_UNITS = (('ms', 0.001), ('us', 0.000001), ('s', 1.0))
+
+# script commands and the daemon commands they run, the LED ones also take on or off
+_COMMANDS = {'height': 'height', 'firmware': 'version', 'version': 'version', 'list': 'list', 'send': 'send',
+             'resync': 'resync', 'ping': 'ping'}
+_COMMANDS.update((command, command) for command in xtdaemon._LED_COMMANDS)
+_LEDS = ('led1', 'led2')
+# commands whose result is a list whatever the count of values
+_LISTS = ('list', 'send')
+
+
+class ScriptError(ValueError):
+    '''Malformed script line'''
+
+
+def _seconds(token):
+    for suffix, scale in _DURATION_UNITS:
+        if token.endswith(suffix):
+            token, factor = token[:-len(suffix)], scale
+            break
+    else:
+        factor = 1.0
+    try:
+        value = float(token) * factor
+    except ValueError:
+        raise ScriptError('invalid duration %s' % token)
+    if value < 0:
+        raise ScriptError('negative duration')
+    return value
+
+
+def _known(word):
+    return word in _COMMANDS or word in _LEDS or word == 'sleep'
+
+
+def parse_line(words):
+    '''Returns (serial, command, arguments) of a script line split in words
+
+    serial is None for the default tree, command is a daemon command or sleep
+    with the seconds as argument.
+    '''
+    serial = None
+    if len(words) > 1 and not _known(words[0]):
+        if not _known(words[1]):
+            # neither word is a command, the first one is the likelier typo
+            raise ScriptError('unknown command %s' % words[0])
+        serial, words = words[0], words[1:]
+    command, args = words[0], words[1:]
+    if command in _LEDS:
+        if len(args) != 1 or args[0] not in ('on', 'off'):
+            raise ScriptError('%s takes on or off' % command)
+        return serial, '%s_%s' % (command, args[0]), []
+    if command == 'sleep':
+        if len(args) != 1:
+            raise ScriptError('sleep takes a duration')
+        return serial, command, [_seconds(args[0])]
+    if command not in _COMMANDS:
+        raise ScriptError('unknown command %s' % command)
+    return serial, _COMMANDS[command], args
+
+
+def _value(text):
+    '''Daemon reply value to JSON, - standing for no result'''
+    if text == '-':
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+class ScriptRunner(object):
+    '''Runs script lines through execute(serial, command, args), writing one JSON object per line to output
+
+    execute is XMas_TreeService.execute or a call through a daemon client, both
+    returning the reply values as strings, serial - standing for the first tree.
+    '''
+
+    def __init__(self, execute, output, serial=None, sleep=time.sleep):
+        self._execute = execute
+        self._output = output
+        self._serial = serial
+        self._sleep = sleep
+        self.failed = 0
+
+    def run(self, lines):
+        '''Run every line, returns the count of failed commands'''
+        for number, line in enumerate(lines, 1):
+            words = line.split('#', 1)[0].split()
+            if words:
+                self._output.write(json.dumps(self.run_line(words, number), sort_keys=True) + '\n')
+                self._output.flush()
+        return self.failed
+
+    def run_line(self, words, number=None):
+        '''Run one line split in words, returns its result object'''
+        record = {'line': number, 'serial': self._serial, 'command': ' '.join(words)}
+        start = _clock()
+        try:
+            serial, command, args = parse_line(words)
+            if serial is not None:
+                record['serial'] = serial
+                record['command'] = ' '.join(words[1:])
+            if command == 'sleep':
+                self._sleep(args[0])
+                result = None
+            else:
+                values = [_value(value) for value in self._execute(record['serial'] or '-', command, args)]
+                result = values if command in _LISTS else values[0] if values else None
+        except Exception as e:
+            self.failed += 1
+            record.update(ok=False, error=str(e) or e.__class__.__name__)
+            return record
+        record.update(ok=True, result=result, seconds=_clock() - start)
+        return record
+
+
+def run_script(path, serial=None, socket=None, direct=False, output=None):
+    '''Run the script file at path, - for the standard input, returns the exit status
+
+    The commands go through the daemon when one answers on socket, unless direct is set.
+    '''
+    source = sys.stdin if path == '-' else open(path)
+    client = None if direct else xtdaemon.connect(socket)
+    if client is not None:
+        execute = lambda serial, command, args: client.call(serial, command, *args)  # noqa: E731
+    else:
+        execute = xtdaemon.XMas_TreeService().execute
+    runner = ScriptRunner(execute, output or sys.stdout, serial)
+    try:
+        # readline rather than iteration, the stream is processed as the lines arrive
+        runner.run(iter(source.readline, ''))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if client is not None:
+            client.close()
+    return 1 if runner.failed else 0
@@ -0,0 +1,345 @@
+# coding: utf-8
+"""
+Compiled XMas_Tree light shows played straight from a memory mapped file
+
+A show is described in a small text format and compiled once into a
+binary file of fixed size frames.  The ShowPlayer maps the file and reads
+the LED states and durations of every frame through memoryviews on the
+mapping, so a multi-hour show opens instantly, playback memory does not
+grow with the show length and no frame objects are built while playing.
+Frames are scheduled like xtanimation.Animator does for timelines.
+
+Show description, one frame or keyword per line, # starts a comment:
+
+    intro                   frames played once (optional, must come first)
+        on   off  1s
+        off  on   1s
+    loop                    frames played every cycle
+        repeat 10           repeat blocks nest and are expanded when compiling
+            on   off  300ms
+            off  on   300ms
+        end
+
+A frame is the LED1 state, the LED2 state (on, off or - to leave the LED
+unchanged) and a duration in s, ms or us (seconds when no unit is given).
+Frames before any section keyword belong to the loop.
+
+Binary format, little endian: a 32 byte header (magic "XTSHOW", format
+version u16, intro frame count u32, loop frame count u32, intro and loop
+durations in microseconds u64) then the intro frames and the loop frames,
+8 bytes each (LED1 state u8, LED2 state u8, 2 padding bytes, duration in
+microseconds u32), a state being 0 unchanged, 1 on or 2 off.
+
+    python xtshow.py compile show.txt show.xts
+    python xtshow.py info show.xts
+    python xtshow.py play show.xts [-s SERIAL] [-c CYCLES]
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import sys
+import mmap
+import struct
+from array import array
+from xtanimation import Animator, AnimationStats
+try:
+    _stringTypes = (basestring,)  # noqa: F821
+except NameError:
+    _stringTypes = (str,)
+
+SHOW_MAGIC = b'XTSHOW'
+SHOW_VERSION = 1
+
+# frame LED states
+SHOW_LED_KEEP = 0
+SHOW_LED_ON = 1
+SHOW_LED_OFF = 2
+
+# frame durations are stored as u32 microseconds
+SHOW_MAX_DURATION = 0xffffffff / 1000000.0
+
+_HEADER = struct.Struct('<6sHLLQQ')
+_FRAME = struct.Struct('<BBxxL')
+
+_LED_TOKENS = {'on': SHOW_LED_ON, 'off': SHOW_LED_OFF, '-': SHOW_LED_KEEP}
+_DURATION_UNITS = (('ms', 1000), ('us', 1), ('s', 1000000))
+
+# opcodes to send, indexed by LED1 state * 3 + LED2 state, states being KEEP when already shown
+_BATCHES = [[opcode for opcode in (led1, led2) if opcode]
+            for led1 in (None, 0x40, 0x41) for led2 in (None, 0x50, 0x51)]
+
+
+class ShowSyntaxError(ValueError):
+    '''Malformed show description, line is the 1 based line number of the offending line'''
+
+    def __init__(self, message, line):
+        ValueError.__init__(self, '%s, affected line: %i' % (message, line))
+        self.line = line
+
+
+class ShowFormatError(ValueError):
+    '''The file is not a compiled show of a supported version'''
+
+
+def _duration(token, line):
+    for suffix, scale in _DURATION_UNITS:
+        if token.endswith(suffix):
+            token, factor = token[:-len(suffix)], scale
+            break
+    else:
+        factor = 1000000
+    try:
+        value = float(token) * factor
+    except ValueError:
+        raise ShowSyntaxError('Invalid duration', line)
+    if not 0 <= value <= 0xffffffff:
+        raise ShowSyntaxError('Duration out of range (0 to %.0f s)' % SHOW_MAX_DURATION, line)
+    return int(round(value))
+
+
+def parse_show(lines):
+    '''Parse an iterable of description lines, returns the (intro, loop) blocks
+
+    A block is a list of (led1, led2, microseconds) frames and (count, block) repeats.
+    '''
+    intro, loop = [], []
+    stack = [loop]
+    section = None
+    ln = 0
+    for text in lines:
+        ln += 1
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        words = text.split('#', 1)[0].split()
+        if not words:
+            continue
+        keyword = words[0].lower()
+        if keyword in ('intro', 'loop'):
+            if len(stack) > 1:
+                raise ShowSyntaxError('Section inside a repeat block', ln)
+            if keyword == 'intro' and (section is not None or loop):
+                raise ShowSyntaxError('The intro must come first', ln)
+            section = keyword
+            stack = [intro if keyword == 'intro' else loop]
+        elif keyword == 'repeat':
+            if len(words) != 2 or not words[1].isdigit():
+                raise ShowSyntaxError('Expecting repeat <count>', ln)
+            block = []
+            stack[-1].append((int(words[1]), block))
+            stack.append(block)
+        elif keyword == 'end':
+            if len(stack) == 1:
+                raise ShowSyntaxError('end without repeat', ln)
+            stack.pop()
+        else:
+            if len(words) != 3 or words[0].lower() not in _LED_TOKENS or words[1].lower() not in _LED_TOKENS:
+                raise ShowSyntaxError('Expecting <led1> <led2> <duration>', ln)
+            stack[-1].append((_LED_TOKENS[words[0].lower()], _LED_TOKENS[words[1].lower()], _duration(words[2], ln)))
+    if len(stack) > 1:
+        raise ShowSyntaxError('repeat without end', ln)
+    return intro, loop
+
+
+def _expand(block):
+    '''Yields the frames of a block, repeats expanded lazily'''
+    for item in block:
+        if len(item) == 2:
+            for _ in range(item[0]):
+                for frame in _expand(item[1]):
+                    yield frame
+        else:
+            yield item
+
+
+def _state(led):
+    return SHOW_LED_KEEP if led is None else SHOW_LED_ON if led else SHOW_LED_OFF
+
+
+def write_show(path, intro, loop):
+    '''Write iterables of (led1 state, led2 state, microseconds) frames, returns the (intro, loop) frame counts
+
+    Frames are streamed to the file, the header is completed last.
+    '''
+    counts = [0, 0]
+    durations = [0, 0]
+    with open(path, 'wb') as f:
+        f.write(b'\0' * _HEADER.size)
+        for section, frames in enumerate((intro, loop)):
+            for led1, led2, microseconds in frames:
+                f.write(_FRAME.pack(led1, led2, microseconds))
+                counts[section] += 1
+                durations[section] += microseconds
+        f.seek(0)
+        f.write(_HEADER.pack(SHOW_MAGIC, SHOW_VERSION, counts[0], counts[1], durations[0], durations[1]))
+    return tuple(counts)
+
+
+def compile_show(source, path):
+    '''Compile a description given by file name or as an iterable of lines, returns the frame counts'''
+    if isinstance(source, _stringTypes):
+        with open(source, 'rb') as f:
+            intro, loop = parse_show(f)
+    else:
+        intro, loop = parse_show(source)
+    return write_show(path, _expand(intro), _expand(loop))
+
+
+def compile_timeline(timeline, path):
+    '''Compile an xtanimation.Timeline, returns the frame counts'''
+    def frames(block):
+        for frame in block:
+            if not 0 <= frame.duration <= SHOW_MAX_DURATION:
+                raise ValueError('frame duration %r out of range' % frame.duration)
+            yield _state(frame.led1), _state(frame.led2), int(round(frame.duration * 1000000))
+    return write_show(path, frames(timeline.intro), frames(timeline.frames))
+
+
+class ShowFile(object):
+    '''Compiled show mapped read only
+
+    leds[8 * n] and leds[8 * n + 1] are the LED states of frame n and
+    durations[2 * n + 1] its duration in microseconds, intro frames first.
+    '''
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            if size < _HEADER.size:
+                raise ShowFormatError('%s is not a compiled show' % path)
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        magic, version, self.intro_count, self.frame_count, intro_us, cycle_us = _HEADER.unpack_from(self._map)
+        if magic != SHOW_MAGIC:
+            self.close()
+            raise ShowFormatError('%s is not a compiled show' % path)
+        if version != SHOW_VERSION or size != _HEADER.size + _FRAME.size * (self.intro_count + self.frame_count):
+            self.close()
+            raise ShowFormatError('%s has an unsupported version or is truncated' % path)
+        self.intro_duration = intro_us / 1000000.0
+        self.cycle_duration = cycle_us / 1000000.0
+        self.leds = memoryview(self._map)[_HEADER.size:]
+        if sys.byteorder == 'little':
+            self.durations = self.leds.cast(str('I'))
+        else:
+            # the durations are little endian, play from a converted copy
+            self.durations = array(str('I'), bytes(self.leds))
+            self.durations.byteswap()
+
+    def close(self):
+        for name in ('durations', 'leds'):
+            view = getattr(self, name, None)
+            if isinstance(view, memoryview):
+                view.release()
+        if getattr(self, '_map', None) is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ShowPlayer(Animator):
+    '''Animator playing compiled shows, timelines are still played by Animator.play'''
+
+    def play(self, show, cycles=1, on_cycle=None):
+        '''Play the intro then the loop of a ShowFile for the given cycles (forever if None), returns AnimationStats
+
+        on_cycle(cycle, stats) is called after every completed cycle.
+        '''
+        if not isinstance(show, ShowFile):
+            return Animator.play(self, show, cycles, on_cycle)
+        clock = self._clock
+        leds = show.leds
+        durations = show.durations
+        state = self._state
+        stats = AnimationStats()
+        start = clock()
+        deadline = start
+        pending1 = pending2 = SHOW_LED_KEEP
+        cycle = 0
+        first, last = 0, show.intro_count
+        intro = True
+        while True:
+            for index in range(first, last):
+                slot = deadline
+                deadline += durations[2 * index + 1] * 0.000001
+                if leds[8 * index]:
+                    pending1 = leds[8 * index]
+                if leds[8 * index + 1]:
+                    pending2 = leds[8 * index + 1]
+                wait = slot - self.latency - clock()
+                if wait > 0:
+                    self._sleep(wait)
+                elif clock() + self.latency >= deadline:
+                    # the slot is already over, coalesce this frame into the next one
+                    stats.dropped += 1
+                    continue
+                batch = _BATCHES[(pending1 if pending1 and state[0] != (pending1 == SHOW_LED_ON) else 0) * 3 +
+                                 (pending2 if pending2 and state[1] != (pending2 == SHOW_LED_ON) else 0)]
+                if batch:
+                    self._send(batch)
+                stats.add(clock() - slot)
+            if not intro:
+                cycle += 1
+                stats.elapsed = clock() - start
+                if on_cycle:
+                    on_cycle(cycle, stats)
+                if cycles is not None and cycle >= cycles:
+                    break
+            intro = False
+            first, last = show.intro_count, show.intro_count + show.frame_count
+            if first == last:
+                break
+        # hold the last frame for its whole duration
+        wait = deadline - clock()
+        if wait > 0:
+            self._sleep(wait)
+        stats.elapsed = clock() - start
+        return stats
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='XMas_Tree light show compiler and player.')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('compile', help='compile a show description')
+    command.add_argument('source', help='show description')
+    command.add_argument('output', help='compiled show file')
+    command = commands.add_parser('info', help='describe a compiled show')
+    command.add_argument('show', help='compiled show file')
+    command = commands.add_parser('play', help='play a compiled show')
+    command.add_argument('show', help='compiled show file')
+    command.add_argument('-s', '--serial', help='serial number of the XMas_Tree to use')
+    command.add_argument('-c', '--cycles', type=int, default=1, help='loop cycles, 0 plays forever')
+    args = parser.parse_args()
+    try:
+        if args.command == 'compile':
+            intro, frames = compile_show(args.source, args.output)
+            print('%s: %i intro frames, %i loop frames' % (args.output, intro, frames))
+        elif args.command == 'info':
+            with ShowFile(args.show) as show:
+                print('%s: %i intro frames (%.3f s), %i loop frames (%.3f s per cycle)' %
+                      (args.show, show.intro_count, show.intro_duration, show.frame_count, show.cycle_duration))
+        elif args.command == 'play':
+            import XMas_Tree
+            with ShowFile(args.show) as show:
+                player = ShowPlayer(XMas_Tree.XMas_Tree(serial=args.serial))
+                player.play(show, cycles=args.cycles or None,
+                            on_cycle=lambda cycle, stats: print('cycle %i: %s' % (cycle, stats)))
+        else:
+            parser.print_help()
+    except (ShowSyntaxError, ShowFormatError, IOError) as e:
+        parser.exit(1, 'Error: %s\n' % e)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# coding: utf-8
+"""
+Content addressed on disk cache of parsed firmware images
+
+Flashing the same build again, or onto many devices, does not need to
+parse the Intel HEX file again: the flash image parsed for a device
+memory layout is kept in a cache directory, keyed by the SHA-256 of the
+HEX file and the layout (address, length, bytes per address and chunk
+size).  Every entry is one file:
+
+    header, the raw flash image, the populated chunk bitmap (bit n of
+    byte n // 8 set for chunk n)
+
+Entries are mapped with mmap when loaded, the image buffer being a read
+only view of the mapping.  The header holds a CRC-32 of the rest of the
+file, a damaged or truncated entry is dropped and counts as a miss.
+Entries are written to a temporary file renamed in place, so concurrent
+processes never see a partial one.  The directory is bounded in size:
+storing an entry evicts the least recently used ones, a hit refreshing
+the entry modification time.
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+import tempfile
+from ykhex import IntelHexImage
+
+# environment variable overriding the default cache directory
+YKCACHE_DIR_ENV = 'YKUSH_IMAGE_CACHE'
+YKCACHE_MAX_BYTES = 64 * 1024 * 1024
+YKCACHE_SUFFIX = '.img'
+
+# magic, version, address, length, bytes per address, chunk size, data bytes, records,
+# start flags, start segment CS, IP, start linear EIP, CRC-32 of what follows the header
+_HEADER = struct.Struct('<6sHLLHHLLBxHHLL')
+_MAGIC = b'YKIMG\x00'
+_VERSION = 1
+_START_SEGMENT = 0x01
+_START_LINEAR = 0x02
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def default_cache_dir():
+    '''YKUSH_IMAGE_CACHE, else pykfirmware in the user cache directory'''
+    path = os.environ.get(YKCACHE_DIR_ENV)
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pykfirmware')
+
+
+def digest(data):
+    '''Content hash of a HEX file given as bytes or as a list of bytes lines'''
+    h = hashlib.sha256()
+    for part in ([data] if isinstance(data, bytes) else data):
+        h.update(part if isinstance(part, bytes) else part.encode('ascii'))
+    return h.hexdigest()
+
+
+def _bitmap(chunkmap):
+    bitmap = bytearray((len(chunkmap) + 7) // 8)
+    for n, used in enumerate(chunkmap):
+        if used:
+            bitmap[n >> 3] |= 1 << (n & 7)
+    return bitmap
+
+
+class ImageCache(object):
+    '''Directory of parsed images, at most max_bytes of entries'''
+
+    def __init__(self, path=None, max_bytes=YKCACHE_MAX_BYTES):
+        self.path = path or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, digest, address, length, bytesperaddress, chunksize):
+        return '%s-%x-%x-%i-%i' % (digest, address, length, bytesperaddress, chunksize)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + YKCACHE_SUFFIX)
+
+    def get(self, key, address, length, bytesperaddress, chunksize):
+        '''Returns the cached IntelHexImage of key, None on a miss'''
+        path = self._entry(key)
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        image = self._image(mapped, address, length, bytesperaddress, chunksize)
+        if image is None:
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+            self._remove(path)
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            # the modification time orders the entries for eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+        return image
+
+    def _image(self, mapped, address, length, bytesperaddress, chunksize):
+        chunks = (length + chunksize - 1) // chunksize
+        if len(mapped) != _HEADER.size + length + (chunks + 7) // 8:
+            return None
+        (magic, version, entryaddress, entrylength, entrybytesperaddress, entrychunksize, data_bytes, records,
+         flags, cs, ip, eip, crc) = _HEADER.unpack_from(mapped)
+        if magic != _MAGIC or version != _VERSION or \
+                (entryaddress, entrylength, entrybytesperaddress, entrychunksize) != \
+                (address, length, bytesperaddress, chunksize):
+            return None
+        try:
+            view = memoryview(mapped)
+        except TypeError:
+            # Python 2 mmap objects only have the old buffer interface, fall back to a copy
+            view = memoryview(bytearray(mapped))
+        if zlib.crc32(view[_HEADER.size:]) & 0xffffffff != crc:
+            return None
+        image = IntelHexImage(address, length, bytesperaddress, chunksize=chunksize,
+                              buffer=view[_HEADER.size:_HEADER.size + length])
+        bitmap = view[_HEADER.size + length:]
+        image.chunkmap = bytearray((bitmap[n >> 3] >> (n & 7)) & 1 for n in range(chunks))
+        image.data_bytes = data_bytes
+        image.records = records
+        image.start_segment = (cs, ip) if flags & _START_SEGMENT else None
+        image.start_linear = eip if flags & _START_LINEAR else None
+        return image
+
+    def put(self, key, image):
+        '''Store a parsed image then evict the least recently used entries above max_bytes
+
+        Errors are ignored, the cache being an optimization only.
+        '''
+        body = bytes(image.buffer) + bytes(_bitmap(image.chunkmap))
+        flags = (_START_SEGMENT if image.start_segment else 0) | (_START_LINEAR if image.start_linear is not None else 0)
+        cs, ip = image.start_segment or (0, 0)
+        header = _HEADER.pack(_MAGIC, _VERSION, image.address, image.length, image.bytesperaddress, image.chunksize,
+                              image.data_bytes, image.records, flags, cs, ip, image.start_linear or 0,
+                              zlib.crc32(body) & 0xffffffff)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header + body)
+            _replace(temp, self._entry(key))
+        except (IOError, OSError):
+            self._remove(temp)
+            return
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        '''Remove the least recently used entries until the cache fits in max_bytes'''
+        entries = []
+        try:
+            for name in os.listdir(self.path):
+                if name.endswith(YKCACHE_SUFFIX):
+                    path = os.path.join(self.path, name)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            return
+        total = sum(size for mtime, size, path in entries)
+        keep = keep and self._entry(keep)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                self._remove(path)
+                total -= size
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def load(self, lines, address, length, bytesperaddress, chunksize):
+        '''Returns the image of the HEX bytes lines from the cache, parsing and storing it on a miss'''
+        key = self.key(digest(lines), address, length, bytesperaddress, chunksize)
+        image = self.get(key, address, length, bytesperaddress, chunksize)
+        if image is None:
+            image = IntelHexImage(address, length, bytesperaddress, chunksize=chunksize).load(lines)
+            self.put(key, image)
+        return image
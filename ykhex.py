@@ -0,0 +1,158 @@
+# coding: utf-8
+"""
+Intel HEX parser writing straight into a preallocated flash image
+
+Each record is decoded once with binascii.unhexlify, its checksum is
+validated with a byte sum over the decoded bytes (the two's complement
+checksum makes a valid record sum to zero) and data records are copied
+through a memoryview into the bytearray holding the device flash image.
+
+The image also keeps a chunk map telling which chunksize bytes chunks
+were populated by data records, so programmers can skip blank flash.
+iter_load parses incrementally, reporting the chunks the parser moved
+past, so a programmer can stream them to the device while parsing goes on.
+
+Supported record types:
+    00 data, 01 end of file, 02 extended segment address,
+    03 start segment address, 04 extended linear address,
+    05 start linear address
+
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+import struct
+import binascii
+
+# Flash erased pattern used to fill the image before loading
+HEX_FILL_PATTERN = b'\x3f\xff'
+# Default chunk granularity, the bootloader program/get data payload size
+HEX_CHUNK_SIZE = 56
+
+_RECORD_HEADER = struct.Struct('>BHB')  # size, address, type
+_RECORD_U16 = struct.Struct('>H')
+_RECORD_U16U16 = struct.Struct('>HH')
+_RECORD_U32 = struct.Struct('>L')
+
+
+class IntelHexError(ValueError):
+    '''Malformed Intel HEX input, line is the 1 based line number of the offending record'''
+
+    def __init__(self, message, line):
+        ValueError.__init__(self, '%s, affected line: %i' % (message, line))
+        self.line = line
+
+
+class IntelHexImage(object):
+    '''Flash image of the address..address+length region loaded from Intel HEX records'''
+
+    def __init__(self, address, length, bytesperaddress=1, fill=HEX_FILL_PATTERN, chunksize=HEX_CHUNK_SIZE,
+                 buffer=None):
+        '''buffer, if given, holds an already loaded image (such as a mapped ykcache entry) and is not filled'''
+        self.address = address
+        self.length = length
+        self.bytesperaddress = bytesperaddress
+        self.chunksize = chunksize
+        if buffer is None:
+            buffer = (bytearray(fill) * (length // len(fill) + 1))[:length]
+        self.buffer = buffer
+        # one byte per chunk, non zero once a data record touched the chunk
+        self.chunkmap = bytearray((length + chunksize - 1) // chunksize)
+        # CS:IP of a type 03 record and EIP of a type 05 record, if any
+        self.start_segment = None
+        self.start_linear = None
+        self.records = 0
+        self.data_bytes = 0
+        # set by iter_load when a data record lands in a chunk already reported as settled
+        self.reordered = False
+
+    @classmethod
+    def from_file(cls, filename, address, length, bytesperaddress=1, fill=HEX_FILL_PATTERN, chunksize=HEX_CHUNK_SIZE):
+        '''Parse a HEX file given by name or as an open file object'''
+        image = cls(address, length, bytesperaddress, fill, chunksize)
+        if hasattr(filename, 'read'):
+            return image.load(filename)
+        with open(filename, 'rb') as f:
+            return image.load(f)
+
+    def load(self, lines):
+        '''Parse an iterable of text or bytes records into the image, returns self'''
+        for settled in self.iter_load(lines, 0):
+            pass
+        return self
+
+    def iter_load(self, lines, batch=64):
+        '''Parse records into the image, yielding the count of leading chunks the parser moved past
+
+        A count is yielded every batch data records (only once at the end if batch is 0) and
+        when the input is exhausted, then it covers every chunk.  Chunks below the count are
+        settled as long as the records come in address order, as HEX files normally do; a
+        record going back into a settled chunk sets the reordered attribute.
+        '''
+        buf = self.buffer
+        chunkmap = self.chunkmap
+        chunksize = self.chunksize
+        base = 0
+        ln = 0
+        settled = 0
+        countdown = batch
+        for rec in lines:
+            ln += 1
+            rec = rec.strip()
+            if not rec:
+                continue
+            if rec[:1] not in (':', b':'):
+                raise IntelHexError('Unrecognized Intel HEX format', ln)
+            try:
+                # bytearray so the bytes index as integers on Python 2 as well
+                raw = bytearray(binascii.unhexlify(rec[1:]))
+            except (binascii.Error, TypeError, ValueError):
+                raise IntelHexError('Unrecognized Intel HEX format', ln)
+            if len(raw) < 5 or len(raw) != raw[0] + 5:
+                raise IntelHexError('Record length mismatch', ln)
+            if sum(raw) & 0xff:
+                raise IntelHexError('Checksum mismatch', ln)
+            rsize, raddr, rtype = _RECORD_HEADER.unpack_from(raw)
+            self.records += 1
+            if rtype == 0x00:
+                if rsize % self.bytesperaddress:
+                    raise IntelHexError('Expecting a multiple of %i byte(s) record' % self.bytesperaddress, ln)
+                mstart = base + raddr - self.address
+                mend = min(mstart + rsize, self.length)
+                if mstart < 0:
+                    # clip records starting below the programmable region
+                    skip, mstart = -mstart, 0
+                else:
+                    skip = 0
+                if mstart < mend:
+                    buf[mstart:mend] = memoryview(raw)[4 + skip:4 + skip + mend - mstart]
+                    self.data_bytes += mend - mstart
+                    for chunk in range(mstart // chunksize, (mend - 1) // chunksize + 1):
+                        chunkmap[chunk] = 1
+                    if mstart // chunksize < settled:
+                        self.reordered = True
+                    elif batch:
+                        countdown -= 1
+                        if not countdown:
+                            countdown = batch
+                            settled = mstart // chunksize
+                            yield settled
+            elif rtype == 0x01:
+                break
+            elif rtype == 0x02:
+                base = _RECORD_U16.unpack_from(raw, 4)[0] << 4
+            elif rtype == 0x03:
+                self.start_segment = _RECORD_U16U16.unpack_from(raw, 4)
+            elif rtype == 0x04:
+                base = _RECORD_U16.unpack_from(raw, 4)[0] << 16
+            elif rtype == 0x05:
+                self.start_linear = _RECORD_U32.unpack_from(raw, 4)[0]
+            else:
+                raise IntelHexError('Unknown record type 0x%.2x' % rtype, ln)
+        yield len(chunkmap)
+
+    def populated_chunks(self):
+        '''Returns the (offset, length) of every chunk touched by data records, in address order'''
+        chunksize = self.chunksize
+        return [(n * chunksize, min(chunksize, self.length - n * chunksize))
+                for n, used in enumerate(self.chunkmap) if used]